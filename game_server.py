@@ -15,6 +15,7 @@ import uvicorn
 
 from agents import SupervisorAgent, IntentAgent, RuleAgent, NarrativeAgent, WorldAgent
 from models.game_models import GameState, PlayerCharacter, Location, Combat
+from model_protocol_server import shutdown_model_server
 
 # Configure logging
 logging.basicConfig(
@@ -44,6 +45,9 @@ class GameServer:
             allow_headers=["*"],  # Allow all headers
         )
         
+        # Release pooled model backend connections on shutdown
+        self.app.add_event_handler("shutdown", shutdown_model_server)
+        
         # Modified to support multiple connections per user
         self.active_connections: Dict[str, List[WebSocket]] = {}
         self.game_state = GameState()
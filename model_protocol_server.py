@@ -7,15 +7,28 @@ model providers and handles context management, caching, and error handling.
 """
 
 import os
+import re
 import json
 import time
 import asyncio
 import logging
-from typing import Dict, Any, List, Optional, Union, Callable
+from typing import Dict, Any, List, Optional, Union, Callable, Tuple, Awaitable, AsyncIterator, Iterator, Deque, Set, FrozenSet
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from concurrent.futures import Future, ThreadPoolExecutor
+import gzip
 import hashlib
+import math
+import heapq
+import random
+import sqlite3
+import sys
+import threading
+import zlib
 import aiohttp
-from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import google.generativeai as genai # For Gemini
 
 # Import the centralized app_config for API keys
@@ -28,9 +41,189 @@ logging.basicConfig(
 )
 logger = logging.getLogger('model_protocol_server')
 
+class ModelProtocolError(Exception):
+    """Base class for errors raised by the Model Protocol Server"""
+
+class BackendUnavailableError(ModelProtocolError):
+    """Raised when a backend's circuit is open and no fallback can serve the request"""
+
+class ModelTimeoutError(ModelProtocolError, TimeoutError):
+    """Raised when a model call does not finish before its deadline"""
+
+class ContextBudgetError(ModelProtocolError):
+    """Raised when required prompt context does not fit the model's token budget"""
+
+class CallOutcome:
+    """Mutable record of whether a backend call had to fall back to mock output"""
+    
+    def __init__(self):
+        self.failed = False
+        self.error: Optional[str] = None
+        self.usage: Optional[Dict[str, int]] = None
+        self.usage_estimated = False
+        # Set when a backend served mock output (no API key configured or a fallback)
+        self.mocked = False
+
+# Outcome of the backend call running in the current task, if one is being tracked
+_call_outcome: ContextVar[Optional[CallOutcome]] = ContextVar("call_outcome", default=None)
+
+# Caller the model request running in the current task is accounted to
+_request_caller: ContextVar[Optional[str]] = ContextVar("request_caller", default=None)
+
+# Absolute time.monotonic() deadline of the model request running in the current task
+_request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+# Outcomes of the prompts of the batch running in the current task, in prompt order
+_batch_outcomes: ContextVar[Optional[List[CallOutcome]]] = ContextVar("batch_outcomes", default=None)
+
+def _remaining_time() -> Optional[float]:
+    """
+    Get the time left before the current request's deadline
+    
+    Returns:
+        Seconds remaining (never negative), or None if no deadline is set
+    """
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+@contextmanager
+def _deadline_scope(timeout: Optional[float]) -> Iterator[None]:
+    """
+    Set the request deadline for model calls made inside the block
+    
+    An enclosing deadline that expires sooner is kept.
+    
+    Args:
+        timeout: Seconds from now, or None to leave the current deadline as is
+    """
+    if timeout is None:
+        yield
+        return
+    deadline = time.monotonic() + timeout
+    current = _request_deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _request_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+@contextmanager
+def _caller_scope(caller: Optional[str]) -> Iterator[None]:
+    """
+    Account model calls made inside the block to a caller
+    
+    Args:
+        caller: Caller name (e.g. the agent making the request), or None
+    """
+    token = _request_caller.set(caller)
+    try:
+        yield
+    finally:
+        _request_caller.reset(token)
+
+@contextmanager
+def _batch_item_scope(index: int) -> Iterator[None]:
+    """
+    Track outcome reports made inside the block against one prompt of the current batch
+    
+    Args:
+        index: Position of the prompt in the batch
+    """
+    outcomes = _batch_outcomes.get()
+    if outcomes is None:
+        yield
+        return
+    token = _call_outcome.set(outcomes[index])
+    try:
+        yield
+    finally:
+        _call_outcome.reset(token)
+
+async def _await_within_deadline(awaitable: Awaitable[Any]) -> Any:
+    """
+    Await a model call, cancelling it if the request deadline expires
+    
+    Args:
+        awaitable: Model call to await
+        
+    Returns:
+        Result of the call
+        
+    Raises:
+        ModelTimeoutError: If the deadline expired first
+    """
+    remaining = _remaining_time()
+    if remaining is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=remaining)
+    except asyncio.TimeoutError:
+        raise ModelTimeoutError("Model call did not finish before its deadline") from None
+
+def _report_backend_failure(error: str) -> None:
+    """
+    Mark the current backend call as failed
+    
+    Backends degrade to mock responses instead of raising, so this is how
+    the circuit breakers learn that a provider did not actually answer.
+    
+    Args:
+        error: Short description of the failure
+    """
+    outcome = _call_outcome.get()
+    if outcome is not None:
+        outcome.failed = True
+        outcome.error = error
+
+def _report_mock_response() -> None:
+    """Mark the current backend call as answered with mock output"""
+    outcome = _call_outcome.get()
+    if outcome is not None:
+        outcome.mocked = True
+
+def _report_usage(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+    """
+    Record the token usage of the current backend call
+    
+    Args:
+        prompt_tokens: Input tokens, including any served from a prompt cache
+        completion_tokens: Output tokens
+        cached_tokens: Input tokens read from a provider-side prompt cache
+    """
+    outcome = _call_outcome.get()
+    if outcome is not None:
+        outcome.usage = {
+            "prompt_tokens": int(prompt_tokens or 0),
+            "completion_tokens": int(completion_tokens or 0),
+            "cached_tokens": int(cached_tokens or 0)
+        }
+
 class ModelBackend(ABC):
     """Abstract base class for model backends"""
     
+    # Maximum prompt plus completion tokens the model accepts
+    context_window: int = 8192
+    # Average characters per token, used when estimating prompt size
+    chars_per_token: float = 4.0
+    
+    def estimate_tokens(self, text: str) -> int:
+        """
+        Estimate how many tokens a text uses with this backend's model
+        
+        Args:
+            text: Text to measure
+            
+        Returns:
+            Estimated token count
+        """
+        if not text:
+            return 0
+        return int(len(text) / self.chars_per_token) + 1
+    
     @abstractmethod
     async def generate(self, 
                        prompt: str, 
@@ -68,87 +261,89 @@ class ModelBackend(ABC):
             Generated JSON response
         """
         pass
-
-class OpenAIBackend(ModelBackend):
-    """OpenAI API backend implementation"""
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-4"):
+    async def generate_batch(self, 
+                             prompts: List[str], 
+                             params: Dict[str, Any], 
+                             system_prompt: Optional[str] = None) -> List[str]:
         """
-        Initialize OpenAI backend
+        Generate responses for several prompts sharing the same parameters
+        
+        Backends without a multi-prompt call run the prompts concurrently.
         
         Args:
-            api_key: OpenAI API key (defaults to OPENAI_API_KEY env var)
-            model: Model to use (defaults to gpt-4)
+            prompts: The input prompts
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated text responses, in prompt order
         """
-        self.api_key = api_key # API key is now passed in
-        if not self.api_key:
-            logger.warning("No OpenAI API key provided. Using mock responses.")
-        
-        self.model = model
-        self.base_url = "https://api.openai.com/v1/chat/completions"
+        async def generate_one(index: int, prompt: str) -> str:
+            with _batch_item_scope(index):
+                return await self.generate(prompt, params, system_prompt)
         
-    async def generate(self, 
-                       prompt: str, 
-                       params: Dict[str, Any], 
-                       system_prompt: Optional[str] = None) -> str:
+        return list(await asyncio.gather(
+            *(generate_one(index, prompt) for index, prompt in enumerate(prompts))
+        ))
+    
+    async def generate_with_json_batch(self, 
+                                       prompts: List[str], 
+                                       json_schema: Dict[str, Any], 
+                                       params: Dict[str, Any],
+                                       system_prompt: Optional[str] = None) -> List[Dict[str, Any]]:
         """
-        Generate a response from OpenAI
-        Includes handling for an optional system prompt.
+        Generate JSON responses for several prompts sharing the same schema and parameters
         
         Args:
-            prompt: The input prompt
+            prompts: The input prompts
+            json_schema: JSON schema for the expected responses
             params: Generation parameters
+            system_prompt: Optional system prompt or instruction
             
         Returns:
-            Generated text response
+            Generated JSON responses, in prompt order
         """
-        if not self.api_key:
-            return self._mock_generate(prompt)
-        
-        # Set up the request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        async def generate_one(index: int, prompt: str) -> Dict[str, Any]:
+            with _batch_item_scope(index):
+                return await self.generate_with_json(prompt, json_schema, params, system_prompt)
         
-        # Prepare messages
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
+        return list(await asyncio.gather(
+            *(generate_one(index, prompt) for index, prompt in enumerate(prompts))
+        ))
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Generate a response from the model as a stream of text chunks
         
-        # Set up parameters
-        request_params = {
-            "model": params.get("model", self.model),
-            "messages": messages,
-            "temperature": params.get("temperature", 0.7),
-            "max_tokens": params.get("max_tokens", 1000),
-            "top_p": params.get("top_p", 1.0),
-            "frequency_penalty": params.get("frequency_penalty", 0.0),
-            "presence_penalty": params.get("presence_penalty", 0.0)
-        }
+        Backends without native streaming yield the whole response at once.
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=request_params) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"OpenAI API error: {response.status} - {error_text}")
-                        return self._mock_generate(prompt)
-                    
-                    result = await response.json()
-                    return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            logger.error(f"Error calling OpenAI API: {str(e)}")
-            return self._mock_generate(prompt)
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Text chunks in generation order
+        """
+        yield await self.generate(prompt, params, system_prompt)
     
-    async def generate_with_json(self, 
-                               prompt: str, 
-                               json_schema: Dict[str, Any], 
-                               params: Dict[str, Any],
-                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+    async def generate_with_json_stream(self, 
+                                        prompt: str, 
+                                        json_schema: Dict[str, Any], 
+                                        params: Dict[str, Any],
+                                        system_prompt: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
         """
-        Generate a JSON response from OpenAI
+        Generate a JSON response as a stream of completed top-level fields
+        
+        The response is streamed as text and parsed incrementally. Fields the
+        stream left unfinished are recovered by the repair pass once it ends.
+        If the output cannot be parsed the call is reported as failed; a mock
+        response is yielded only if no real field was streamed, so the two are
+        never mixed in one object.
         
         Args:
             prompt: The input prompt
@@ -156,54 +351,34 @@ class OpenAIBackend(ModelBackend):
             params: Generation parameters
             system_prompt: Optional system prompt or instruction
             
-        Returns:
-            Generated JSON response
+        Yields:
+            (field name, value) pairs in completion order
         """
-        if not self.api_key:
-            return self._mock_generate_json(prompt, json_schema)
-        
-        # Set up the request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        # Prepare messages
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        
-        # Set up parameters
-        request_params = {
-            "model": params.get("model", self.model),
-            "messages": messages,
-            "temperature": params.get("temperature", 0.7),
-            "max_tokens": params.get("max_tokens", 1000),
-            "top_p": params.get("top_p", 1.0),
-            "frequency_penalty": params.get("frequency_penalty", 0.0),
-            "presence_penalty": params.get("presence_penalty", 0.0),
-            "response_format": {"type": "json_object"}
-        }
+        parser = IncrementalJSONParser()
+        async for chunk in self.generate_stream(_json_schema_prompt(prompt, json_schema), params, system_prompt):
+            for field in parser.feed(chunk):
+                yield field
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=request_params) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"OpenAI API error: {response.status} - {error_text}")
-                        return self._mock_generate_json(prompt, json_schema)
-                    
-                    result = await response.json()
-                    content = result["choices"][0]["message"]["content"]
-                    return json.loads(content)
-        except Exception as e:
-            logger.error(f"Error calling OpenAI API: {str(e)}")
-            return self._mock_generate_json(prompt, json_schema)
+        result = parser.result()
+        if result is None:
+            logger.error(f"Failed to parse streamed JSON response: {parser.text[:500]}")
+            _report_backend_failure("unparseable JSON response")
+            if parser.fields:
+                # Keep the real fields already streamed rather than mixing in mock values
+                return
+            result = self._mock_generate_json(prompt, json_schema)
+        for key, value in result.items():
+            if key not in parser.fields:
+                yield key, value
+    
+    async def close(self) -> None:
+        """Release any network resources held by the backend"""
+        pass
     
     def _mock_generate(self, prompt: str) -> str:
         """Generate a mock response for testing"""
         logger.info("Using mock response generator")
+        _report_mock_response()
         
         if "attack" in prompt.lower():
             return "You swing your sword with precision, striking the goblin for 8 damage."
@@ -221,6 +396,7 @@ class OpenAIBackend(ModelBackend):
     def _mock_generate_json(self, prompt: str, schema: Dict[str, Any]) -> Dict[str, Any]:
         """Generate a mock JSON response for testing"""
         logger.info("Using mock JSON response generator")
+        _report_mock_response()
         
         if "intent" in prompt.lower():
             return {
@@ -265,239 +441,866 @@ class OpenAIBackend(ModelBackend):
             # Return a basic structure that matches the schema
             return {key: "mock value" for key in schema.get("properties", {}).keys()}
 
-class AnthropicBackend(ModelBackend):
-    """Anthropic API backend implementation"""
+async def _iter_sse_data(response: aiohttp.ClientResponse) -> AsyncIterator[str]:
+    """
+    Iterate over the data payloads of a server-sent events response
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "claude-3-opus-20240229"):
-        """
-        Initialize Anthropic backend
+    Args:
+        response: Streaming HTTP response
         
-        Args:
-            api_key: Anthropic API key (defaults to ANTHROPIC_API_KEY env var)
-            model: Model to use (defaults to claude-3-opus)
-        """
-        self.api_key = api_key # API key is now passed in
-        if not self.api_key:
-            logger.warning("No Anthropic API key provided. Using mock responses.")
+    Yields:
+        Contents of each "data:" line
+    """
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8").strip()
+        if line.startswith("data:"):
+            yield line[len("data:"):].strip()
+
+def _iter_mock_chunks(text: str) -> Iterator[str]:
+    """Split mock text into word-sized chunks to imitate token streaming"""
+    for match in re.finditer(r"\S+\s*", text):
+        yield match.group(0)
+
+# Generation parameter carrying the stable, cacheable part of a prompt
+PROMPT_PREFIX_PARAM = "prompt_prefix"
+
+def _split_prompt(prompt: str, params: Dict[str, Any]) -> Tuple[Optional[str], str]:
+    """
+    Split a request into its stable prompt prefix and the per-turn suffix
+    
+    Args:
+        prompt: The per-turn prompt
+        params: Generation parameters, possibly carrying a prompt prefix
         
-        self.model = model
-        self.base_url = "https://api.anthropic.com/v1/messages"
+    Returns:
+        Tuple of (prefix or None, suffix)
+    """
+    return params.get(PROMPT_PREFIX_PARAM) or None, prompt
+
+def _join_prompt(prompt: str, params: Dict[str, Any]) -> str:
+    """Full prompt text for backends without structured prefix support"""
+    prefix, suffix = _split_prompt(prompt, params)
+    return f"{prefix}\n\n{suffix}" if prefix else suffix
+
+_JSON_DECODER = json.JSONDecoder()
+_CODE_FENCE = re.compile(r"```[A-Za-z]*[ \t]*\n?")
+
+def _json_schema_prompt(prompt: str, json_schema: Dict[str, Any]) -> str:
+    """Prompt asking for a JSON object that follows the schema"""
+    return f"{prompt}\n\nRespond with a JSON object that follows this schema:\n{json.dumps(json_schema, indent=2)}"
+
+def _strip_code_fence(text: str) -> str:
+    """Get the contents of the first Markdown code fence, tolerating a missing closing fence"""
+    match = _CODE_FENCE.search(text)
+    if match is None:
+        return text
+    body = text[match.end():]
+    end = body.find("```")
+    return body if end < 0 else body[:end]
+
+def _scan_json(text: str) -> Tuple[str, List[str], bool, List[int]]:
+    """
+    Scan possibly truncated JSON text
+    
+    Args:
+        text: JSON text starting at its opening bracket
         
-    async def generate(self, 
-                       prompt: str, 
-                       params: Dict[str, Any], 
-                       system_prompt: Optional[str] = None) -> str:
+    Returns:
+        Tuple of (text with trailing commas removed, closers still owed in
+        nesting order, whether it ends inside a string, offsets the text can
+        be cut back to at a value boundary)
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    cuts: List[int] = []
+    in_string = False
+    escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+            out.append(ch)
+            cuts.append(len(out))
+            continue
+        elif ch in "}]":
+            # Drop a trailing comma before the closer
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if closers:
+                closers.pop()
+        elif ch == ",":
+            cuts.append(len(out))
+        out.append(ch)
+    return "".join(out), closers, in_string, cuts
+
+def _repair_json(text: str, max_attempts: int = 16) -> Optional[Any]:
+    """
+    Recover JSON from model output with code fences, surrounding prose,
+    trailing commas or a truncated ending
+    
+    Truncated output is closed off, cutting back to the last complete
+    value if the cut-off token cannot be completed.
+    
+    Args:
+        text: Raw model output
+        max_attempts: Maximum number of cut points to try
+        
+    Returns:
+        Parsed value, or None if nothing could be recovered
+    """
+    text = _strip_code_fence(text)
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    try:
+        # Ignore anything after a complete value
+        return _JSON_DECODER.raw_decode(text)[0]
+    except json.JSONDecodeError:
+        pass
+    
+    cleaned, closers, in_string, cuts = _scan_json(text)
+    candidate = cleaned
+    if in_string:
+        # Drop a dangling escape before closing the string
+        if (len(cleaned) - len(cleaned.rstrip("\\"))) % 2:
+            candidate = cleaned[:-1]
+        candidate += '"'
+    candidates = [(candidate, closers)]
+    for cut in reversed(cuts[-max_attempts:]):
+        prefix, prefix_closers, prefix_in_string, _ = _scan_json(cleaned[:cut])
+        if not prefix_in_string:
+            candidates.append((prefix, prefix_closers))
+    
+    for candidate, candidate_closers in candidates:
+        candidate = candidate.rstrip()
+        if candidate.endswith(","):
+            candidate = candidate[:-1]
+        try:
+            return json.loads(candidate + "".join(reversed(candidate_closers)))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def _parse_json_text(text: str) -> Optional[Any]:
+    """
+    Parse model output as JSON, falling back to the repair pass
+    
+    Args:
+        text: Raw model output
+        
+    Returns:
+        Parsed value, or None if the output is not recoverable JSON
+    """
+    try:
+        return json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        pass
+    return _repair_json(text or "")
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for a streamed JSON object
+    
+    Text is fed in as it arrives and each top-level field is returned as
+    soon as its value closes, so callers can act on early fields while
+    later ones are still being generated. Text before the opening brace
+    (prose or a code fence) is skipped.
+    """
+    
+    def __init__(self):
+        self.text = ""
+        self.fields: Dict[str, Any] = {}
+        self.complete = False
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = 0
+    
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
         """
-        Generate a response from Anthropic
-        Includes handling for an optional system prompt.
+        Add streamed text
         
         Args:
-            prompt: The input prompt
-            params: Generation parameters
+            chunk: Next piece of the response
             
         Returns:
-            Generated text response
+            (field name, value) pairs completed by this chunk
         """
-        if not self.api_key:
-            return self._mock_generate(prompt)
-        
-        # Set up the request
-        headers = {
-            "Content-Type": "application/json",
-            "x-api-key": self.api_key,
-            "anthropic-version": "2023-06-01"
-        }
-        
-        # Set up parameters
-        request_params = {
-            "model": params.get("model", self.model),
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": params.get("max_tokens", 1000),
-            "temperature": params.get("temperature", 0.7),
-            "top_p": params.get("top_p", 1.0),
-        }
-        if system_prompt:
-            request_params["system"] = system_prompt
-        
+        self.text += chunk
+        completed: List[Tuple[str, Any]] = []
+        text = self.text
+        i = self._pos
+        while i < len(text) and not self.complete:
+            ch = text[i]
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                    self._member_start = i + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_member(text[self._member_start:i], completed)
+                    self.complete = True
+            elif ch == "," and self._depth == 1:
+                self._close_member(text[self._member_start:i], completed)
+                self._member_start = i + 1
+            i += 1
+        self._pos = i
+        return completed
+    
+    def _close_member(self, member: str, completed: List[Tuple[str, Any]]) -> None:
+        """Parse one top-level "key": value member"""
+        if not member.strip():
+            return
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=request_params) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Anthropic API error: {response.status} - {error_text}")
-                        return self._mock_generate(prompt)
-                    
-                    result = await response.json()
-                    return result["content"][0]["text"]
-        except Exception as e:
-            logger.error(f"Error calling Anthropic API: {str(e)}")
-            return self._mock_generate(prompt)
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            # Left for the repair pass over the full text
+            return
+        for key, value in parsed.items():
+            self.fields[key] = value
+            completed.append((key, value))
     
-    async def generate_with_json(self, 
-                               prompt: str, 
-                               json_schema: Dict[str, Any], 
-                               params: Dict[str, Any],
-                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+    def result(self) -> Optional[Dict[str, Any]]:
         """
-        Generate a JSON response from Anthropic
+        Get the full object once the stream has ended
         
-        Args:
-            prompt: The input prompt
-            json_schema: JSON schema for the expected response
-            params: Generation parameters
-            system_prompt: Optional system prompt or instruction
+        Returns:
+            Parsed (or repaired) object, or None if the text is not a recoverable JSON object
+        """
+        parsed = _parse_json_text(self.text)
+        return parsed if isinstance(parsed, dict) else None
+
+# Python types accepted for each JSON schema type (bool is excluded from the numeric types)
+_SCHEMA_TYPES: Dict[str, Tuple[type, ...]] = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "object": (dict,),
+    "array": (list,),
+    "null": (type(None),),
+}
+
+# Check appended to a compiled schema: (value, path, errors) -> whether to keep checking
+_SchemaCheck = Callable[[Any, str, List[Tuple[str, str]]], bool]
+
+class CompiledSchema:
+    """
+    JSON schema compiled into a tree of checks
+    
+    Covers the subset of JSON Schema used for model responses: type (or a
+    list of types), properties, required, additionalProperties, items, enum,
+    const, minimum/maximum, minLength/maxLength and minItems/maxItems.
+    Other keywords are ignored.
+    """
+    
+    def __init__(self, schema: Dict[str, Any]):
+        """
+        Compile a schema
+        
+        Args:
+            schema: JSON schema for a response object
+        """
+        self.schema = schema
+        self.properties: Dict[str, Any] = schema.get("properties", {})
+        self.required: List[str] = list(schema.get("required", []))
+        # Response schemas often leave the root type implicit
+        self._check = self._compile(schema if "type" in schema else dict(schema, type="object"))
+    
+    def _compile(self, schema: Dict[str, Any]) -> Callable[[Any, str, List[Tuple[str, str]]], None]:
+        """Build the check function for one (sub)schema"""
+        checks: List[_SchemaCheck] = []
+        
+        schema_type = schema.get("type")
+        if schema_type is not None:
+            names = [schema_type] if isinstance(schema_type, str) else list(schema_type)
+            allowed = tuple(t for name in names for t in _SCHEMA_TYPES.get(name, ()))
+            allows_bool = "boolean" in names
+            expected = " or ".join(names)
+            
+            def check_type(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if isinstance(value, allowed) and (allows_bool or not isinstance(value, bool)):
+                    return True
+                errors.append((path, f"expected {expected}, got {type(value).__name__}"))
+                return False
+            checks.append(check_type)
+        
+        if "enum" in schema:
+            options = schema["enum"]
+            
+            def check_enum(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if value not in options:
+                    errors.append((path, f"must be one of {json.dumps(options)}"))
+                return True
+            checks.append(check_enum)
+        
+        if "const" in schema:
+            constant = schema["const"]
+            
+            def check_const(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if value != constant:
+                    errors.append((path, f"must be {json.dumps(constant)}"))
+                return True
+            checks.append(check_const)
+        
+        bounds = [(keyword, schema[keyword]) for keyword in ("minimum", "maximum") if keyword in schema]
+        if bounds:
+            def check_bounds(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    for keyword, limit in bounds:
+                        if value < limit if keyword == "minimum" else value > limit:
+                            errors.append((path, f"must be {'>=' if keyword == 'minimum' else '<='} {limit}"))
+                return True
+            checks.append(check_bounds)
+        
+        for low, high, sized_type, unit in (("minLength", "maxLength", str, "characters"),
+                                            ("minItems", "maxItems", list, "items")):
+            if low in schema or high in schema:
+                checks.append(self._compile_size(schema.get(low), schema.get(high), sized_type, unit))
+        
+        if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+            properties = {
+                key: self._compile(subschema) for key, subschema in schema.get("properties", {}).items()
+            }
+            required = list(schema.get("required", []))
+            additional = schema.get("additionalProperties", True)
+            additional_check = self._compile(additional) if isinstance(additional, dict) else None
+            
+            def check_object(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if not isinstance(value, dict):
+                    return True
+                prefix = f"{path}." if path else ""
+                for key in required:
+                    if key not in value:
+                        errors.append((prefix + key, "missing required field"))
+                for key, item in value.items():
+                    check = properties.get(key, additional_check)
+                    if check is not None:
+                        check(item, prefix + key, errors)
+                    elif additional is False and key not in properties:
+                        errors.append((prefix + key, "unexpected field"))
+                return True
+            checks.append(check_object)
+        
+        if isinstance(schema.get("items"), dict):
+            item_check = self._compile(schema["items"])
+            
+            def check_items(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+                if isinstance(value, list):
+                    for index, item in enumerate(value):
+                        item_check(item, f"{path}[{index}]", errors)
+                return True
+            checks.append(check_items)
+        
+        def check(value: Any, path: str, errors: List[Tuple[str, str]]) -> None:
+            for step in checks:
+                if not step(value, path, errors):
+                    return
+        return check
+    
+    @staticmethod
+    def _compile_size(low: Optional[int], high: Optional[int], sized_type: type, unit: str) -> _SchemaCheck:
+        """Build a length check for strings or arrays"""
+        def check_size(value: Any, path: str, errors: List[Tuple[str, str]]) -> bool:
+            if isinstance(value, sized_type):
+                if low is not None and len(value) < low:
+                    errors.append((path, f"must have at least {low} {unit}"))
+                if high is not None and len(value) > high:
+                    errors.append((path, f"must have at most {high} {unit}"))
+            return True
+        return check_size
+    
+    def validate(self, value: Any) -> List[Tuple[str, str]]:
+        """
+        Validate a response
+        
+        Args:
+            value: Parsed response
             
         Returns:
-            Generated JSON response
+            (path, message) pairs, empty if the response is valid; a path of
+            "" means the response as a whole is invalid
         """
-        if not self.api_key:
-            return self._mock_generate_json(prompt, json_schema)
+        errors: List[Tuple[str, str]] = []
+        self._check(value, "", errors)
+        return errors
+    
+    @staticmethod
+    def error_fields(errors: List[Tuple[str, str]]) -> List[str]:
+        """
+        Get the top-level fields affected by validation errors
         
-        # Set up the request
-        headers = {
-            "Content-Type": "application/json",
-            "x-api-key": self.api_key,
-            "anthropic-version": "2023-06-01"
+        Args:
+            errors: Errors from validate()
+            
+        Returns:
+            Field names in first-error order (empty if the whole response is invalid)
+        """
+        fields: List[str] = []
+        for path, _ in errors:
+            if not path:
+                return []
+            field = re.split(r"[.\[]", path, 1)[0]
+            if field not in fields:
+                fields.append(field)
+        return fields
+    
+    def subschema(self, fields: List[str]) -> Dict[str, Any]:
+        """
+        Get a schema for an object holding only the given fields
+        
+        Args:
+            fields: Top-level field names
+            
+        Returns:
+            Object schema restricted to those fields, all required
+        """
+        return {
+            "type": "object",
+            "properties": {field: self.properties.get(field, {}) for field in fields},
+            "required": list(fields)
         }
+
+# Compiled schemas keyed by their canonical JSON, most recently used last
+_COMPILED_SCHEMAS: "OrderedDict[str, CompiledSchema]" = OrderedDict()
+_COMPILED_SCHEMA_LIMIT = 128
+
+def _compile_schema(schema: Dict[str, Any]) -> CompiledSchema:
+    """
+    Get the compiled form of a schema, compiling it on first use
+    
+    Args:
+        schema: JSON schema
         
-        # Add JSON schema to prompt
-        schema_prompt = f"{prompt}\n\nRespond with a JSON object that follows this schema:\n{json.dumps(json_schema, indent=2)}"
+    Returns:
+        Compiled schema
+    """
+    key = json.dumps(schema, sort_keys=True)
+    compiled = _COMPILED_SCHEMAS.get(key)
+    if compiled is None:
+        compiled = CompiledSchema(schema)
+        _COMPILED_SCHEMAS[key] = compiled
+        if len(_COMPILED_SCHEMAS) > _COMPILED_SCHEMA_LIMIT:
+            _COMPILED_SCHEMAS.popitem(last=False)
+    else:
+        _COMPILED_SCHEMAS.move_to_end(key)
+    return compiled
+
+class HTTPSessionPool:
+    """
+    Lazily created, shared aiohttp session for a model backend
+    
+    Reusing one session keeps TCP/TLS connections alive between requests
+    instead of paying a new handshake on every call.
+    """
+    
+    def __init__(self,
+                 limit: int = 100,
+                 limit_per_host: int = 20,
+                 keepalive_timeout: float = 30.0,
+                 dns_cache_ttl: int = 300,
+                 connect_timeout: float = 10.0,
+                 read_timeout: float = 60.0):
+        """
+        Initialize the session pool
         
-        # Set up parameters
-        request_params = {
-            "model": params.get("model", self.model),
-            "messages": [{"role": "user", "content": schema_prompt}],
-            "max_tokens": params.get("max_tokens", 1000),
-            "temperature": params.get("temperature", 0.7),
-            "top_p": params.get("top_p", 1.0),
-        }
-        if system_prompt:
-            request_params["system"] = system_prompt
+        Args:
+            limit: Maximum number of open connections across all hosts
+            limit_per_host: Maximum number of open connections per host
+            keepalive_timeout: Seconds an idle connection is kept open
+            dns_cache_ttl: Seconds resolved DNS entries are cached
+            connect_timeout: Seconds allowed to acquire and open a connection
+            read_timeout: Seconds allowed between reads of a response (also
+                bounds the gap between chunks of a streamed response)
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared session, creating it on first use
+        
+        Returns:
+            Open aiohttp client session
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=self.connect_timeout,
+                sock_read=self.read_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+    
+    async def close(self) -> None:
+        """Close the shared session and its pooled connections"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+class RetryPolicy:
+    """
+    Retry policy for transient model API failures
+    
+    Retries use exponential backoff with full jitter, honor Retry-After
+    headers, and stop once the overall deadline would be exceeded.
+    """
+    
+    # Timeouts, conflicts, rate limits, overload and transient server errors
+    RETRYABLE_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504, 529})
+    
+    def __init__(self,
+                 max_attempts: int = 3,
+                 base_delay: float = 0.5,
+                 max_delay: float = 8.0,
+                 deadline: float = 30.0,
+                 max_retry_after: float = 20.0):
+        """
+        Initialize retry policy
+        
+        Args:
+            max_attempts: Total attempts including the first one
+            base_delay: Backoff ceiling for the first retry in seconds
+            max_delay: Upper bound of the backoff ceiling in seconds
+            deadline: Overall time budget for all attempts in seconds
+            max_retry_after: Longest Retry-After value that is honored
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.max_retry_after = max_retry_after
+    
+    def is_retryable_status(self, status: Optional[int]) -> bool:
+        """Check whether an HTTP status code is worth retrying"""
+        return status in self.RETRYABLE_STATUSES
+    
+    def is_retryable_error(self, error: BaseException) -> bool:
+        """
+        Check whether an exception raised by a client call is worth retrying
+        
+        Connection errors and timeouts are retried. SDK exceptions carrying an
+        HTTP status code (such as google.api_core errors) are classified by it.
+        """
+        if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError, ConnectionError)):
+            return True
+        return self.is_retryable_status(getattr(error, "code", None))
+    
+    def get_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Get the delay before the next attempt
+        
+        Args:
+            attempt: Number of attempts made so far (1 after the first failure)
+            retry_after: Server-requested delay in seconds, if any
+            
+        Returns:
+            Delay in seconds
+        """
+        if retry_after is not None and retry_after <= self.max_retry_after:
+            return retry_after
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+    
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """
+        Parse a Retry-After header given as seconds or an HTTP date
         
+        Args:
+            value: Header value
+            
+        Returns:
+            Delay in seconds, or None if absent or unparseable
+        """
+        if not value:
+            return None
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, headers=headers, json=request_params) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Anthropic API error: {response.status} - {error_text}")
-                        return self._mock_generate_json(prompt, json_schema)
-                    
-                    result = await response.json()
-                    content = result["content"][0]["text"]
-                    
-                    # Extract JSON from the response
-                    try:
-                        # Try to find JSON block in the response
-                        if "```json" in content:
-                            json_str = content.split("```json")[1].split("```")[0].strip()
-                        else:
-                            # Just try to parse the whole thing
-                            json_str = content
-                        
-                        return json.loads(json_str)
-                    except json.JSONDecodeError:
-                        logger.error(f"Failed to parse JSON from Anthropic response: {content}")
-                        return self._mock_generate_json(prompt, json_schema)
-        except Exception as e:
-            logger.error(f"Error calling Anthropic API: {str(e)}")
-            return self._mock_generate_json(prompt, json_schema)
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at is None:
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
     
-    def _mock_generate(self, prompt: str) -> str:
-        """Generate a mock response for testing"""
-        logger.info("Using mock response generator")
+    async def call(self, func: Callable[[], Awaitable[Any]], provider_name: str) -> Any:
+        """
+        Run a client call, retrying retryable failures
         
-        if "attack" in prompt.lower():
-            return "You swing your sword with precision, striking the goblin for 8 damage."
-        elif "cast" in prompt.lower():
-            return "You channel arcane energy, casting a powerful fireball that deals 15 damage to the enemies."
-        elif "move" in prompt.lower():
-            return "You move cautiously through the dungeon, finding yourself in a new chamber with flickering torches."
-        elif "examine" in prompt.lower():
-            return "You carefully examine your surroundings. The room is dusty with cobwebs in the corners. There's an old chest against the far wall and a wooden door to the north."
-        elif "talk" in prompt.lower():
-            return "The merchant smiles at you. 'Welcome traveler! I have many fine wares for sale. What catches your eye?'"
-        else:
-            return "The Dungeon Master considers your action carefully..."
+        Args:
+            func: Zero-argument coroutine function performing the call
+            provider_name: Provider name for log messages
+            
+        Returns:
+            Result of the first successful attempt
+            
+        Raises:
+            Exception: The last error once retries are exhausted or not allowed
+        """
+        deadline = time.monotonic() + self.deadline
+        request_deadline = _request_deadline.get()
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except Exception as e:
+                attempt += 1
+                delay = self.get_delay(attempt)
+                if (not self.is_retryable_error(e) or attempt >= self.max_attempts
+                        or time.monotonic() + delay > deadline):
+                    _report_backend_failure(f"{provider_name}: {str(e)}")
+                    raise
+                logger.warning(f"{provider_name} API call failed ({str(e)}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+@asynccontextmanager
+async def _post_with_retry(session_pool: HTTPSessionPool,
+                           url: str,
+                           headers: Dict[str, str],
+                           payload: Dict[str, Any],
+                           retry_policy: RetryPolicy,
+                           provider_name: str) -> AsyncIterator[Optional[aiohttp.ClientResponse]]:
+    """
+    POST a JSON payload, retrying transient failures
     
-    def _mock_generate_json(self, prompt: str, schema: Dict[str, Any]) -> Dict[str, Any]:
-        """Generate a mock JSON response for testing"""
-        logger.info("Using mock JSON response generator")
+    Args:
+        session_pool: Session pool to send the request through
+        url: Endpoint URL
+        headers: Request headers
+        payload: JSON request body
+        retry_policy: Retry policy to apply
+        provider_name: Provider name for log messages
         
-        if "intent" in prompt.lower():
-            return {
-                "success": True,
-                "confidence": 0.9,
-                "parsed_intent": {
-                    "action": "attack" if "attack" in prompt.lower() else "examine",
-                    "target_id": "monster_1" if "attack" in prompt.lower() else "location",
-                    "target_name": "goblin" if "attack" in prompt.lower() else "room"
-                }
-            }
-        elif "rule" in prompt.lower():
-            return {
-                "success": True,
-                "narrative_summary": "You attack the goblin and hit for 8 damage.",
-                "game_state_changes": {
-                    "current_location": {
-                        "monsters": [
-                            {"id": "monster_1", "hp": 7, "max_hp": 15}
-                        ]
-                    }
-                }
-            }
-        elif "narrative" in prompt.lower():
-            return {
-                "narrative": "You swing your sword with precision, striking the goblin for 8 damage. The creature howls in pain but remains standing, its red eyes fixed on you with malice."
-            }
-        elif "world" in prompt.lower():
-            return {
-                "success": True,
-                "game_state_changes": {
-                    "locations": {
-                        "loc_2": {
-                            "id": "loc_2",
-                            "name": "Abandoned Library",
-                            "description": "Dusty bookshelves line the walls of this forgotten library. Ancient tomes and scrolls are scattered across the floor."
-                        }
-                    }
-                }
-            }
+    Yields:
+        The successful (200) response, or None if every attempt failed or the
+        error was not retryable
+        
+    Raises:
+        ModelTimeoutError: If the request deadline has already expired
+    """
+    deadline = time.monotonic() + retry_policy.deadline
+    request_deadline = _request_deadline.get()
+    if request_deadline is not None:
+        deadline = min(deadline, request_deadline)
+    attempt = 0
+    while True:
+        retry_after = None
+        # Never let a single attempt outlive the caller's deadline
+        remaining = _remaining_time()
+        if remaining is not None and remaining <= 0:
+            _report_backend_failure(f"{provider_name}: request deadline expired")
+            raise ModelTimeoutError(f"{provider_name} request deadline expired before sending")
+        try:
+            session = session_pool.get_session()
+            if remaining is not None:
+                # Keep the session's connect/read limits and only tighten the total
+                timeout = session.timeout
+                total = remaining if timeout.total is None else min(timeout.total, remaining)
+                response = await session.post(url, headers=headers, json=payload,
+                                              timeout=aiohttp.ClientTimeout(
+                                                  total=total,
+                                                  connect=timeout.connect,
+                                                  sock_read=timeout.sock_read,
+                                                  sock_connect=timeout.sock_connect
+                                              ))
+            else:
+                response = await session.post(url, headers=headers, json=payload)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = str(e) or e.__class__.__name__
+            logger.error(f"Error calling {provider_name} API: {last_error}")
+            retryable = True
         else:
-            # Return a basic structure that matches the schema
-            return {key: "mock value" for key in schema.get("properties", {}).keys()}
+            if response.status == 200:
+                try:
+                    yield response
+                finally:
+                    response.release()
+                return
+            
+            error_text = await response.text()
+            response.release()
+            logger.error(f"{provider_name} API error: {response.status} - {error_text}")
+            retryable = retry_policy.is_retryable_status(response.status)
+            last_error = f"HTTP {response.status}"
+            retry_after = RetryPolicy.parse_retry_after(response.headers.get("Retry-After"))
+        
+        attempt += 1
+        if not retryable or attempt >= retry_policy.max_attempts:
+            _report_backend_failure(f"{provider_name}: {last_error}")
+            yield None
+            return
+        
+        delay = retry_policy.get_delay(attempt, retry_after)
+        if time.monotonic() + delay > deadline:
+            logger.warning(f"{provider_name} retry deadline reached after {attempt} attempts")
+            _report_backend_failure(f"{provider_name}: {last_error}")
+            yield None
+            return
+        
+        logger.info(f"Retrying {provider_name} request in {delay:.2f}s (attempt {attempt + 1})")
+        await asyncio.sleep(delay)
 
-class LocalModelBackend(ModelBackend):
-    """Local model backend implementation (using a local API or library)"""
+class OpenAIBackend(ModelBackend):
+    """OpenAI API backend implementation"""
     
-    def __init__(self, model_path: str = ""):
+    context_window = 128000
+    # Name used in retry and error logs
+    provider_name = "OpenAI"
+    
+    def __init__(self, 
+                 api_key: Optional[str] = None, 
+                 model: str = "gpt-4",
+                 session_pool: Optional[HTTPSessionPool] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 base_url: Optional[str] = None):
         """
-        Initialize local model backend
+        Initialize OpenAI backend
         
         Args:
-            model_path: Path to the local model
+            api_key: OpenAI API key (defaults to OPENAI_API_KEY env var)
+            model: Model to use (defaults to gpt-4)
+            session_pool: Shared HTTP session pool (created if not provided)
+            retry_policy: Retry policy for failed requests (defaults to RetryPolicy())
+            base_url: API endpoint URL (defaults to the public API)
         """
-        self.model_path = model_path
-        logger.info(f"Initializing local model backend with path: {model_path}")
-        logger.warning("Local model backend is using mock responses for now")
+        self.api_key = api_key # API key is now passed in
+        if not self.api_key:
+            logger.warning("No OpenAI API key provided. Using mock responses.")
+        
+        self.model = model
+        self.base_url = base_url or "https://api.openai.com/v1/chat/completions"
+        self.session_pool = session_pool or HTTPSessionPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+    
+    async def close(self) -> None:
+        """Close the pooled HTTP session"""
+        await self.session_pool.close()
+    
+    def _build_messages(self, 
+                        prompt: str, 
+                        params: Dict[str, Any], 
+                        system_prompt: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Build chat messages with the stable parts of the request first
+        
+        OpenAI caches prompts by exact prefix automatically, so the system
+        prompt and the caller's stable prompt prefix lead the request and
+        only the per-turn suffix varies at the end.
+        
+        Args:
+            prompt: The per-turn prompt
+            params: Generation parameters, possibly carrying a prompt prefix
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Chat messages
+        """
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": _join_prompt(prompt, params)})
+        return messages
     
+    def _report_result_usage(self, result: Dict[str, Any]) -> None:
+        """Report the token usage returned with a chat completion"""
+        usage = result.get("usage")
+        if usage:
+            _report_usage(
+                usage.get("prompt_tokens", 0),
+                usage.get("completion_tokens", 0),
+                (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+            )
+        
     async def generate(self, 
                        prompt: str, 
                        params: Dict[str, Any], 
                        system_prompt: Optional[str] = None) -> str:
         """
-        Generate a response from local model
+        Generate a response from OpenAI
+        Includes handling for an optional system prompt.
         
         Args:
             prompt: The input prompt
             params: Generation parameters
-            system_prompt: Optional system prompt (may be ignored by mock)
             
         Returns:
             Generated text response
         """
-        # This is a placeholder for actual local model implementation
-        # In a real implementation, this would use a library like transformers
-        return self._mock_generate(prompt)
+        if not self.api_key:
+            return self._mock_generate(prompt)
+        
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(prompt, params, system_prompt),
+            "temperature": params.get("temperature", 0.7),
+            "max_tokens": params.get("max_tokens", 1000),
+            "top_p": params.get("top_p", 1.0),
+            "frequency_penalty": params.get("frequency_penalty", 0.0),
+            "presence_penalty": params.get("presence_penalty", 0.0)
+        }
+        
+        try:
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is None:
+                    return self._mock_generate(prompt)
+                
+                result = await response.json()
+                self._report_result_usage(result)
+                return result["choices"][0]["message"]["content"]
+        except Exception as e:
+            logger.error(f"Error calling {self.provider_name} API: {str(e)}")
+            return self._mock_generate(prompt)
     
     async def generate_with_json(self, 
                                prompt: str, 
@@ -505,418 +1308,4176 @@ class LocalModelBackend(ModelBackend):
                                params: Dict[str, Any],
                                system_prompt: Optional[str] = None) -> Dict[str, Any]:
         """
-        Generate a JSON response from local model
+        Generate a JSON response from OpenAI
         
         Args:
             prompt: The input prompt
             json_schema: JSON schema for the expected response
             params: Generation parameters
-            system_prompt: Optional system prompt (may be ignored by mock)
+            system_prompt: Optional system prompt or instruction
             
         Returns:
             Generated JSON response
         """
-        # This is a placeholder for actual local model implementation
-        return self._mock_generate_json(prompt, json_schema)
-    
-    def _mock_generate(self, prompt: str) -> str:
-        """Generate a mock response for testing"""
-        logger.info("Using mock response generator")
+        if not self.api_key:
+            return self._mock_generate_json(prompt, json_schema)
         
-        if "attack" in prompt.lower():
-            return "You swing your sword with precision, striking the goblin for 8 damage."
-        elif "cast" in prompt.lower():
-            return "You channel arcane energy, casting a powerful fireball that deals 15 damage to the enemies."
-        elif "move" in prompt.lower():
-            return "You move cautiously through the dungeon, finding yourself in a new chamber with flickering torches."
-        elif "examine" in prompt.lower():
-            return "You carefully examine your surroundings. The room is dusty with cobwebs in the corners. There's an old chest against the far wall and a wooden door to the north."
-        elif "talk" in prompt.lower():
-            return "The merchant smiles at you. 'Welcome traveler! I have many fine wares for sale. What catches your eye?'"
-        else:
-            return "The Dungeon Master considers your action carefully..."
-    
-    def _mock_generate_json(self, prompt: str, schema: Dict[str, Any]) -> Dict[str, Any]:
-        """Generate a mock JSON response for testing"""
-        logger.info("Using mock JSON response generator")
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
         
-        if "intent" in prompt.lower():
-            return {
-                "success": True,
-                "confidence": 0.9,
-                "parsed_intent": {
-                    "action": "attack" if "attack" in prompt.lower() else "examine",
-                    "target_id": "monster_1" if "attack" in prompt.lower() else "location",
-                    "target_name": "goblin" if "attack" in prompt.lower() else "room"
-                }
-            }
-        elif "rule" in prompt.lower():
-            return {
-                "success": True,
-                "narrative_summary": "You attack the goblin and hit for 8 damage.",
-                "game_state_changes": {
-                    "current_location": {
-                        "monsters": [
-                            {"id": "monster_1", "hp": 7, "max_hp": 15}
-                        ]
-                    }
-                }
-            }
-        elif "narrative" in prompt.lower():
-            return {
-                "narrative": "You swing your sword with precision, striking the goblin for 8 damage. The creature howls in pain but remains standing, its red eyes fixed on you with malice."
-            }
-        elif "world" in prompt.lower():
-            return {
-                "success": True,
-                "game_state_changes": {
-                    "locations": {
-                        "loc_2": {
-                            "id": "loc_2",
-                            "name": "Abandoned Library",
-                            "description": "Dusty bookshelves line the walls of this forgotten library. Ancient tomes and scrolls are scattered across the floor."
-                        }
-                    }
-                }
-            }
-        else:
-            # Return a basic structure that matches the schema
-            return {key: "mock value" for key in schema.get("properties", {}).keys()}
-
-class GeminiBackend(ModelBackend):
-    """Google Gemini API backend implementation"""
-
-    def __init__(self, api_key: Optional[str] = None, model: str = "gemini-1.5-flash-latest"):
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(prompt, params, system_prompt),
+            "temperature": params.get("temperature", 0.7),
+            "max_tokens": params.get("max_tokens", 1000),
+            "top_p": params.get("top_p", 1.0),
+            "frequency_penalty": params.get("frequency_penalty", 0.0),
+            "presence_penalty": params.get("presence_penalty", 0.0),
+            "response_format": {"type": "json_object"}
+        }
+        
+        try:
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is None:
+                    return self._mock_generate_json(prompt, json_schema)
+                
+                result = await response.json()
+                self._report_result_usage(result)
+                content = result["choices"][0]["message"]["content"]
+                parsed = _parse_json_text(content)
+                if parsed is None:
+                    logger.error(f"Failed to parse JSON from {self.provider_name} response: {content[:500]}")
+                    _report_backend_failure(f"{self.provider_name}: unparseable JSON response")
+                    return self._mock_generate_json(prompt, json_schema)
+                return parsed
+        except Exception as e:
+            logger.error(f"Error calling {self.provider_name} API: {str(e)}")
+            return self._mock_generate_json(prompt, json_schema)
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
         """
-        Initialize Gemini backend
-
+        Stream a response from OpenAI using server-sent events
+        
         Args:
-            api_key: Google API key
-            model: Model to use (e.g., "gemini-1.5-flash-latest", "gemini-pro")
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Text chunks as they arrive
         """
-        self.api_key = api_key # API key is now passed in
-        self.model_name = model
-        self.client = None
-
         if not self.api_key:
-            logger.warning("No Google API key provided for Gemini. Using mock responses.")
-        else:
-            try:
-                genai.configure(api_key=self.api_key)
-                # System instruction is handled differently for Gemini 1.5 models
-                # It's a param to GenerativeModel, so we'll handle it in generate methods
-                self.client = genai.GenerativeModel(self.model_name)
-                logger.info(f"Gemini client configured successfully for model {self.model_name}.")
-            except Exception as e:
-                logger.error(f"Failed to configure Gemini client: {e}", exc_info=True)
-                self.client = None # Ensure client is None if setup fails
-
-    async def generate(self, 
-                       prompt: str, 
-                       params: Dict[str, Any], 
-                       system_prompt: Optional[str] = None) -> str:
-        if not self.client or not self.api_key: # Check if client initialized and key exists
-            return self._mock_generate(prompt)
-
-        generation_config = genai.types.GenerationConfig(
-            candidate_count=params.get("candidate_count", 1),
-            max_output_tokens=params.get("max_tokens", 1000),
-            temperature=params.get("temperature", 0.7),
-            top_p=params.get("top_p", 1.0)
-        )
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+            return
         
-        # For Gemini 1.5 models, system_instruction is part of the model config
-        # For older models, it's typically prepended or part of chat history.
-        # This example assumes we might re-init or use a specific client if system_prompt changes often.
-        # For simplicity, if system_prompt is provided and model is 1.5, we use it.
-        model_to_use = self.client
-        if system_prompt and ("1.5" in self.model_name or "gemini-pro" in self.model_name): # Gemini Pro also supports system instructions in chat
-            # This is a simplified way; for frequent system_prompt changes, consider chat sessions
-            # or re-initializing the model if it's a one-off with system_instruction.
-            # For chat structure:
-            # contents = []
-            # if system_prompt: contents.append({'role': 'system', 'parts': [{'text': system_prompt}]})
-            # contents.append({'role': 'user', 'parts': [{'text': prompt}]})
-            # For gemini-1.5-*:
-            if "1.5" in self.model_name:
-                 model_to_use = genai.GenerativeModel(self.model_name, system_instruction=system_prompt)
-            else: # gemini-pro (non-1.5)
-                 prompt = f"{system_prompt}\n\nUser: {prompt}\nAssistant:" # Basic prepend
-
-        try:
-            response = await model_to_use.generate_content_async(
-                prompt, # Or `contents` if using chat structure
-                generation_config=generation_config
-            )
-            return response.text
-        except Exception as e:
-            logger.error(f"Error calling Gemini API: {str(e)}", exc_info=True)
-            return self._mock_generate(prompt)
-
-    async def generate_with_json(self, 
-                               prompt: str, 
-                               json_schema: Dict[str, Any], 
-                               params: Dict[str, Any],
-                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
-        if not self.client or not self.api_key:
-            return self._mock_generate_json(prompt, json_schema)
-
-        # Instruct Gemini to respond in JSON format, including the schema
-        # This is a common way to guide models for JSON output.
-        json_prompt = (
-            f"{prompt}\n\n"
-            "Please provide your response strictly in JSON format. "
-            "The JSON object must conform to the following schema:\n"
-            f"{json.dumps(json_schema, indent=2)}"
-        )
-
-        generation_config_params = {
-            "candidate_count": params.get("candidate_count", 1),
-            "max_output_tokens": params.get("max_tokens", 2048), # JSON can be verbose
-            "temperature": params.get("temperature", 0.5), # Lower temp for structured output
-            "top_p": params.get("top_p", 1.0)
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
         }
-        # For Gemini 1.5 models, we can specify response_mime_type
-        if "1.5" in self.model_name:
-            generation_config_params["response_mime_type"] = "application/json"
         
-        generation_config = genai.types.GenerationConfig(**generation_config_params)
-
-        model_to_use = self.client
-        if system_prompt and ("1.5" in self.model_name or "gemini-pro" in self.model_name):
-            if "1.5" in self.model_name:
-                 model_to_use = genai.GenerativeModel(self.model_name, system_instruction=system_prompt)
-            else: # gemini-pro (non-1.5)
-                 json_prompt = f"{system_prompt}\n\nUser: {json_prompt}\nAssistant:"
-
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(prompt, params, system_prompt),
+            "temperature": params.get("temperature", 0.7),
+            "max_tokens": params.get("max_tokens", 1000),
+            "top_p": params.get("top_p", 1.0),
+            "frequency_penalty": params.get("frequency_penalty", 0.0),
+            "presence_penalty": params.get("presence_penalty", 0.0),
+            "stream": True
+        }
+        
+        streamed_any = False
         try:
-            response = await model_to_use.generate_content_async(
-                json_prompt,
-                generation_config=generation_config
-            )
-            # Gemini (especially with response_mime_type) should return clean JSON.
-            # If not, we might need to extract from ```json ... ``` blocks.
-            raw_text = response.text
-            if "```json" in raw_text:
-                raw_text = raw_text.split("```json")[1].split("```")[0].strip()
-            elif raw_text.startswith("```") and raw_text.endswith("```"): # Handle if only ``` not ```json
-                raw_text = raw_text[3:-3].strip()
-            return json.loads(raw_text)
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON from Gemini response: {response.text[:500]}... Error: {e}", exc_info=True)
-            return self._mock_generate_json(prompt, json_schema)
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is not None:
+                    async for data in _iter_sse_data(response):
+                        if data == "[DONE]":
+                            break
+                        event = json.loads(data)
+                        if not event.get("choices"):
+                            continue
+                        content = event["choices"][0].get("delta", {}).get("content")
+                        if content:
+                            streamed_any = True
+                            yield content
         except Exception as e:
-            logger.error(f"Error calling Gemini API for JSON: {str(e)}", exc_info=True)
-            return self._mock_generate_json(prompt, json_schema)
-
-    def _mock_generate(self, prompt: str) -> str:
-        logger.info("Using Gemini mock response generator")
-        return f"Mock Gemini response for: {prompt}"
-
-    def _mock_generate_json(self, prompt: str, schema: Dict[str, Any]) -> Dict[str, Any]:
-        logger.info("Using Gemini mock JSON response generator")
-        return {key: f"mock gemini value for {key}" for key in schema.get("properties", {}).keys()}
+            # A stream cut off mid-response must not be cached or counted as a success
+            logger.error(f"Error streaming from {self.provider_name} API: {str(e)}")
+            _report_backend_failure(f"{self.provider_name}: {str(e)}")
+        
+        # Fall back to mock output only if nothing was streamed yet
+        if not streamed_any:
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
 
-class ResponseCache:
-    """Cache for model responses to avoid redundant API calls"""
+class AnthropicBackend(ModelBackend):
+    """Anthropic API backend implementation"""
     
-    def __init__(self, max_size: int = 1000, ttl: int = 3600):
+    provider_name = "Anthropic"
+    context_window = 200000
+    chars_per_token = 3.5
+    
+    def __init__(self, 
+                 api_key: Optional[str] = None, 
+                 model: str = "claude-3-opus-20240229",
+                 session_pool: Optional[HTTPSessionPool] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 base_url: Optional[str] = None,
+                 prompt_caching: bool = True):
         """
-        Initialize response cache
+        Initialize Anthropic backend
         
         Args:
-            max_size: Maximum number of items in cache
-            ttl: Time to live in seconds
+            api_key: Anthropic API key (defaults to ANTHROPIC_API_KEY env var)
+            model: Model to use (defaults to claude-3-opus)
+            session_pool: Shared HTTP session pool (created if not provided)
+            retry_policy: Retry policy for failed requests (defaults to RetryPolicy())
+            base_url: API endpoint URL (defaults to the public API)
+            prompt_caching: Mark the system prompt and prompt prefix as cacheable
         """
-        self.cache = {}
-        self.max_size = max_size
-        self.ttl = ttl
-        self.access_times = {}
+        self.api_key = api_key # API key is now passed in
+        if not self.api_key:
+            logger.warning("No Anthropic API key provided. Using mock responses.")
+        
+        self.model = model
+        self.base_url = base_url or "https://api.anthropic.com/v1/messages"
+        self.session_pool = session_pool or HTTPSessionPool()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.prompt_caching = prompt_caching
     
-    def get(self, key: str) -> Optional[Any]:
+    async def close(self) -> None:
+        """Close the pooled HTTP session"""
+        await self.session_pool.close()
+    
+    def _build_system(self, system_prompt: str) -> Union[str, List[Dict[str, Any]]]:
         """
-        Get item from cache
+        Build the system field, marked as a prompt cache breakpoint
         
         Args:
-            key: Cache key
+            system_prompt: System prompt or instruction
             
         Returns:
-            Cached item or None if not found
+            System prompt string, or a cacheable text block
         """
-        if key in self.cache:
-            # Check if item has expired
-            if time.time() - self.access_times[key]["created"] > self.ttl:
-                # Remove expired item
-                del self.cache[key]
-                del self.access_times[key]
-                return None
-            
-            # Update last access time
-            self.access_times[key]["accessed"] = time.time()
-            return self.cache[key]
+        if not self.prompt_caching:
+            return system_prompt
+        return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    
+    def _build_messages(self, prompt: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Build the user message, splitting a stable prompt prefix into its own block
         
-        return None
+        The prefix block carries a cache breakpoint, so turns that share the
+        system prompt and prefix only pay full input processing for the suffix.
+        
+        Args:
+            prompt: The per-turn prompt
+            params: Generation parameters, possibly carrying a prompt prefix
+            
+        Returns:
+            Messages list
+        """
+        prefix, suffix = _split_prompt(prompt, params)
+        if not prefix:
+            return [{"role": "user", "content": suffix}]
+        if not self.prompt_caching:
+            return [{"role": "user", "content": _join_prompt(prompt, params)}]
+        return [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": suffix}
+            ]
+        }]
     
-    def set(self, key: str, value: Any) -> None:
+    def _report_result_usage(self, usage: Optional[Dict[str, Any]]) -> None:
+        """Report Anthropic token usage, counting prompt cache reads and writes as input"""
+        if usage:
+            cached = usage.get("cache_read_input_tokens") or 0
+            _report_usage(
+                (usage.get("input_tokens") or 0) + cached + (usage.get("cache_creation_input_tokens") or 0),
+                usage.get("output_tokens") or 0,
+                cached
+            )
+        
+    async def generate(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       system_prompt: Optional[str] = None) -> str:
         """
-        Set item in cache
+        Generate a response from Anthropic
+        Includes handling for an optional system prompt.
         
         Args:
-            key: Cache key
-            value: Value to cache
+            prompt: The input prompt
+            params: Generation parameters
+            
+        Returns:
+            Generated text response
         """
-        # Check if cache is full
-        if len(self.cache) >= self.max_size:
-            # Remove least recently used item
-            lru_key = min(self.access_times.items(), key=lambda x: x[1]["accessed"])[0]
-            del self.cache[lru_key]
-            del self.access_times[lru_key]
+        if not self.api_key:
+            return self._mock_generate(prompt)
         
-        # Add new item
-        self.cache[key] = value
-        self.access_times[key] = {
-            "created": time.time(),
-            "accessed": time.time()
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01"
         }
+        
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(prompt, params),
+            "max_tokens": params.get("max_tokens", 1000),
+            "temperature": params.get("temperature", 0.7),
+            "top_p": params.get("top_p", 1.0),
+        }
+        if system_prompt:
+            request_params["system"] = self._build_system(system_prompt)
+        
+        try:
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is None:
+                    return self._mock_generate(prompt)
+                
+                result = await response.json()
+                self._report_result_usage(result.get("usage"))
+                return result["content"][0]["text"]
+        except Exception as e:
+            logger.error(f"Error calling {self.provider_name} API: {str(e)}")
+            return self._mock_generate(prompt)
+    
+    async def generate_with_json(self, 
+                               prompt: str, 
+                               json_schema: Dict[str, Any], 
+                               params: Dict[str, Any],
+                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a JSON response from Anthropic
+        
+        Args:
+            prompt: The input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated JSON response
+        """
+        if not self.api_key:
+            return self._mock_generate_json(prompt, json_schema)
+        
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01"
+        }
+        
+        # Add JSON schema to prompt
+        schema_prompt = _json_schema_prompt(prompt, json_schema)
+        
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(schema_prompt, params),
+            "max_tokens": params.get("max_tokens", 1000),
+            "temperature": params.get("temperature", 0.7),
+            "top_p": params.get("top_p", 1.0),
+        }
+        if system_prompt:
+            request_params["system"] = self._build_system(system_prompt)
+        
+        try:
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is None:
+                    return self._mock_generate_json(prompt, json_schema)
+                
+                result = await response.json()
+                self._report_result_usage(result.get("usage"))
+                content = result["content"][0]["text"]
+                
+                # Extract JSON from the response, repairing fences and truncation
+                parsed = _parse_json_text(content)
+                if parsed is None:
+                    logger.error(f"Failed to parse JSON from {self.provider_name} response: {content}")
+                    _report_backend_failure(f"{self.provider_name}: unparseable JSON response")
+                    return self._mock_generate_json(prompt, json_schema)
+                return parsed
+        except Exception as e:
+            logger.error(f"Error calling {self.provider_name} API: {str(e)}")
+            return self._mock_generate_json(prompt, json_schema)
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Stream a response from Anthropic using server-sent events
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Text chunks as they arrive
+        """
+        if not self.api_key:
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+            return
+        
+        # Set up the request
+        headers = {
+            "Content-Type": "application/json",
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01"
+        }
+        
+        # Set up parameters
+        request_params = {
+            "model": params.get("model", self.model),
+            "messages": self._build_messages(prompt, params),
+            "max_tokens": params.get("max_tokens", 1000),
+            "temperature": params.get("temperature", 0.7),
+            "top_p": params.get("top_p", 1.0),
+            "stream": True
+        }
+        if system_prompt:
+            request_params["system"] = self._build_system(system_prompt)
+        
+        streamed_any = False
+        try:
+            async with _post_with_retry(self.session_pool, self.base_url, headers, request_params,
+                                        self.retry_policy, self.provider_name) as response:
+                if response is not None:
+                    usage: Dict[str, Any] = {}
+                    async for data in _iter_sse_data(response):
+                        event = json.loads(data)
+                        if event.get("type") == "content_block_delta":
+                            text = event.get("delta", {}).get("text")
+                            if text:
+                                streamed_any = True
+                                yield text
+                        elif event.get("type") == "message_start":
+                            usage.update(event.get("message", {}).get("usage") or {})
+                        elif event.get("type") == "message_delta":
+                            usage.update(event.get("usage") or {})
+                            self._report_result_usage(usage)
+                        elif event.get("type") == "message_stop":
+                            break
+                        elif event.get("type") == "error":
+                            logger.error(f"{self.provider_name} stream error: {event.get('error')}")
+                            _report_backend_failure(f"{self.provider_name}: stream error {event.get('error')}")
+                            break
+        except Exception as e:
+            # A stream cut off mid-response must not be cached or counted as a success
+            logger.error(f"Error streaming from {self.provider_name} API: {str(e)}")
+            _report_backend_failure(f"{self.provider_name}: {str(e)}")
+        
+        # Fall back to mock output only if nothing was streamed yet
+        if not streamed_any:
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+
+class LocalModelBackend(OpenAIBackend):
+    """
+    Local model backend for a self-hosted OpenAI-compatible inference server
+    
+    Talks to servers such as llama.cpp server or vLLM over the chat
+    completions API, so requests never leave the deployment. Connections are
+    pooled, and concurrent prompts are sent in parallel up to the server's
+    slot count, where the server's continuous batching runs them together.
+    Batches from the request batcher go through the same chat completions
+    path unless completions_url is set, in which case each batch is sent as
+    one prompt array to the completions API. Without a base_url the backend
+    serves mock responses.
+    """
+    
+    provider_name = "Local"
+    # Typical llama.cpp/vLLM context size; override with context_window in config
+    context_window = 8192
+    
+    def __init__(self, 
+                 model_path: str = "",
+                 base_url: Optional[str] = None,
+                 model: Optional[str] = None,
+                 api_key: Optional[str] = None,
+                 session_pool: Optional[HTTPSessionPool] = None,
+                 retry_policy: Optional[RetryPolicy] = None,
+                 parallel_slots: int = 4,
+                 profile_window: int = 256,
+                 completions_url: Optional[str] = None):
+        """
+        Initialize local model backend
+        
+        Args:
+            model_path: Path or name of the served model (used as the model name if model is not set)
+            base_url: Chat completions URL of the local server (e.g. "http://127.0.0.1:8080/v1/chat/completions")
+            model: Model name to request (vLLM requires the served model name)
+            api_key: API key, if the server was started with one
+            session_pool: Shared HTTP session pool (created if not provided)
+            retry_policy: Retry policy for failed requests (defaults to RetryPolicy())
+            parallel_slots: Requests sent to the server at once (match its parallel slot count)
+            profile_window: Number of recent calls kept for the latency/throughput profile
+            completions_url: Completions URL to send request batches to as one multi-prompt
+                call (e.g. "http://127.0.0.1:8080/v1/completions"). Opt-in: the completions API
+                applies no chat template and no response_format, so batched prompts reach the
+                model in a different format than single ones. None keeps batches on the chat API
+        """
+        super().__init__(
+            api_key=api_key or "local",
+            model=model or model_path or "local",
+            session_pool=session_pool,
+            retry_policy=retry_policy,
+            base_url=base_url
+        )
+        self.model_path = model_path
+        self.parallel_slots = parallel_slots
+        self.completions_url = completions_url
+        self._slots = asyncio.Semaphore(parallel_slots)
+        self._in_flight = 0
+        # (finished at, latency, completion tokens) of recent successful calls
+        self._profile: Deque[Tuple[float, float, int]] = deque(maxlen=profile_window)
+        
+        if base_url:
+            logger.info(f"Initializing local model backend at {base_url}")
+        else:
+            self.api_key = None  # Routes every call to the mock generators
+            logger.warning("No local model server configured (base_url). Using mock responses.")
+    
+    async def _profiled(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a call in a server slot and add it to the latency/throughput profile
+        
+        The call's outcome is tracked separately so failed calls (which fall
+        back to mock output) stay out of the profile, then merged into the
+        outcome of the enclosing request.
+        """
+        outer = _call_outcome.get()
+        outcome = CallOutcome()
+        async with self._slots:
+            self._in_flight += 1
+            token = _call_outcome.set(outcome)
+            started = time.monotonic()
+            try:
+                result = await call()
+            finally:
+                _call_outcome.reset(token)
+                self._in_flight -= 1
+        
+        if outer is not None:
+            if outcome.failed:
+                outer.failed = True
+                outer.error = outcome.error
+            outer.mocked = outer.mocked or outcome.mocked
+            if outcome.usage is not None:
+                outer.usage = outcome.usage
+        if self.api_key and not outcome.failed:
+            finished = time.monotonic()
+            completion_tokens = (outcome.usage or {}).get("completion_tokens")
+            if not completion_tokens:
+                text = result if isinstance(result, str) else json.dumps(result)
+                completion_tokens = self.estimate_tokens(text)
+            self._profile.append((finished, finished - started, completion_tokens))
+        return result
+    
+    async def generate(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       system_prompt: Optional[str] = None) -> str:
+        """
+        Generate a response from the local model server
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated text response
+        """
+        return await self._profiled(lambda: super(LocalModelBackend, self).generate(prompt, params, system_prompt))
+    
+    async def generate_with_json(self, 
+                               prompt: str, 
+                               json_schema: Dict[str, Any], 
+                               params: Dict[str, Any],
+                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a JSON response from the local model server
+        
+        Args:
+            prompt: The input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated JSON response
+        """
+        return await self._profiled(
+            lambda: super(LocalModelBackend, self).generate_with_json(prompt, json_schema, params, system_prompt)
+        )
+    
+    async def _complete_batch(self, 
+                              prompts: List[str], 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> Optional[List[str]]:
+        """
+        Send several prompts in one request to the server's completions endpoint
+        
+        llama.cpp server and vLLM accept a prompt array and schedule the
+        prompts together. The completions API applies no chat template, so
+        the system prompt and prompt prefix are joined into plain text.
+        
+        Args:
+            prompts: The input prompts
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Completion texts in prompt order, or None if the request failed
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        texts = [_join_prompt(prompt, params) for prompt in prompts]
+        if system_prompt:
+            texts = [f"{system_prompt}\n\n{text}" for text in texts]
+        request_params = {
+            "model": params.get("model", self.model),
+            "prompt": texts,
+            "temperature": params.get("temperature", 0.7),
+            "max_tokens": params.get("max_tokens", 1000),
+            "top_p": params.get("top_p", 1.0),
+            "frequency_penalty": params.get("frequency_penalty", 0.0),
+            "presence_penalty": params.get("presence_penalty", 0.0)
+        }
+        
+        async with self._slots:
+            self._in_flight += len(prompts)
+            started = time.monotonic()
+            try:
+                async with _post_with_retry(self.session_pool, self.completions_url, headers, request_params,
+                                            self.retry_policy, self.provider_name) as response:
+                    if response is None:
+                        return None
+                    result = await response.json()
+                choices = sorted(result["choices"], key=lambda choice: choice.get("index", 0))
+                outputs = [choice["text"] for choice in choices]
+            except Exception as e:
+                logger.error(f"Error calling {self.provider_name} completions API: {str(e)}")
+                _report_backend_failure(f"{self.provider_name}: {str(e)}")
+                return None
+            finally:
+                self._in_flight -= len(prompts)
+        
+        if len(outputs) != len(prompts):
+            logger.error(f"{self.provider_name} returned {len(outputs)} completions for {len(prompts)} prompts")
+            _report_backend_failure(f"{self.provider_name}: incomplete batch response")
+            return None
+        finished = time.monotonic()
+        for output in outputs:
+            self._profile.append((finished, finished - started, self.estimate_tokens(output)))
+        return outputs
+    
+    async def generate_batch(self, 
+                             prompts: List[str], 
+                             params: Dict[str, Any], 
+                             system_prompt: Optional[str] = None) -> List[str]:
+        """
+        Generate responses for several prompts, in one multi-prompt request if completions_url is set
+        
+        Args:
+            prompts: The input prompts
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated text responses, in prompt order
+        """
+        if len(prompts) < 2 or not self.api_key or not self.completions_url:
+            return await super().generate_batch(prompts, params, system_prompt)
+        
+        outputs = await self._complete_batch(prompts, params, system_prompt)
+        if outputs is not None:
+            return outputs
+        results = []
+        for index, prompt in enumerate(prompts):
+            with _batch_item_scope(index):
+                results.append(self._mock_generate(prompt))
+        return results
+    
+    async def generate_with_json_batch(self, 
+                                       prompts: List[str], 
+                                       json_schema: Dict[str, Any], 
+                                       params: Dict[str, Any],
+                                       system_prompt: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Generate JSON responses for several prompts, in one multi-prompt request if completions_url is set
+        
+        Args:
+            prompts: The input prompts
+            json_schema: JSON schema for the expected responses
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated JSON responses, in prompt order
+        """
+        if len(prompts) < 2 or not self.api_key or not self.completions_url:
+            return await super().generate_with_json_batch(prompts, json_schema, params, system_prompt)
+        
+        outputs = await self._complete_batch(
+            [_json_schema_prompt(prompt, json_schema) for prompt in prompts], params, system_prompt
+        )
+        results = []
+        for index, prompt in enumerate(prompts):
+            with _batch_item_scope(index):
+                parsed = _parse_json_text(outputs[index]) if outputs is not None else None
+                if outputs is not None and parsed is None:
+                    logger.error(f"Failed to parse JSON from {self.provider_name} response: {outputs[index][:500]}")
+                    _report_backend_failure(f"{self.provider_name}: unparseable JSON response")
+                results.append(parsed if parsed is not None else self._mock_generate_json(prompt, json_schema))
+        return results
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Stream a response from the local model server
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Text chunks in generation order
+        """
+        async with self._slots:
+            self._in_flight += 1
+            try:
+                async for chunk in super().generate_stream(prompt, params, system_prompt):
+                    yield chunk
+            finally:
+                self._in_flight -= 1
+    
+    def get_profile(self) -> Dict[str, Any]:
+        """
+        Get the latency/throughput profile of recent calls
+        
+        Returns:
+            Latency percentiles, per-request decode speed and aggregate
+            throughput over the profile window
+        """
+        profile: Dict[str, Any] = {
+            "parallel_slots": self.parallel_slots,
+            "in_flight": self._in_flight,
+            "samples": len(self._profile)
+        }
+        if not self._profile:
+            return profile
+        
+        latencies = sorted(latency for _, latency, _ in self._profile)
+        tokens = sum(count for _, _, count in self._profile)
+        # Calls overlap, so throughput is measured over the wall-clock span of the window
+        span = self._profile[-1][0] - (self._profile[0][0] - self._profile[0][1])
+        profile.update({
+            "latency_p50": latencies[len(latencies) // 2],
+            "latency_p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "tokens_per_second_per_request": tokens / max(sum(latencies), 1e-9),
+            "throughput_tokens_per_second": tokens / max(span, 1e-9),
+            "requests_per_second": len(self._profile) / max(span, 1e-9)
+        })
+        return profile
+
+class GeminiBackend(ModelBackend):
+    """Google Gemini API backend implementation"""
+
+    def __init__(self, 
+                 api_key: Optional[str] = None, 
+                 model: str = "gemini-1.5-flash-latest",
+                 retry_policy: Optional[RetryPolicy] = None,
+                 request_timeout: float = 60.0,
+                 model_cache_size: int = 32):
+        """
+        Initialize Gemini backend
+
+        Args:
+            api_key: Google API key
+            model: Model to use (e.g., "gemini-1.5-flash-latest", "gemini-pro")
+            retry_policy: Retry policy for failed requests (defaults to RetryPolicy())
+            request_timeout: Seconds allowed for a single generate_content_async call
+            model_cache_size: Number of GenerativeModel clients (one per system instruction) to keep
+        """
+        self.api_key = api_key # API key is now passed in
+        self.model_name = model
+        self.context_window = 1048576 if "1.5" in model else 32768
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.request_timeout = request_timeout
+        self.model_cache_size = model_cache_size
+        # Clients keyed by system instruction, in LRU order
+        self._models: "OrderedDict[Optional[str], Any]" = OrderedDict()
+
+        if not self.api_key:
+            logger.warning("No Google API key provided for Gemini. Using mock responses.")
+        else:
+            try:
+                genai.configure(api_key=self.api_key)
+                # System instruction is handled differently for Gemini 1.5 models
+                # It's a param to GenerativeModel, so clients are built per instruction in _get_model
+                logger.info(f"Gemini client configured successfully for model {self.model_name}.")
+            except Exception as e:
+                logger.error(f"Failed to configure Gemini client: {e}", exc_info=True)
+                self.api_key = None # Routes every call to the mock generators
+
+    def _get_model(self, system_instruction: Optional[str]) -> Any:
+        """
+        Get a GenerativeModel configured for a system instruction
+        
+        Agents reuse a handful of fixed system prompts, so clients are cached
+        (bounded, least recently used evicted) instead of being built on every
+        call. The generation config is passed per call, so temperature or
+        token limit changes do not create new clients.
+        
+        Args:
+            system_instruction: System instruction (None for the plain model)
+            
+        Returns:
+            GenerativeModel for the instruction
+        """
+        model = self._models.get(system_instruction)
+        if model is not None:
+            self._models.move_to_end(system_instruction)
+            return model
+        
+        model = genai.GenerativeModel(self.model_name, system_instruction=system_instruction)
+        self._models[system_instruction] = model
+        if len(self._models) > self.model_cache_size:
+            self._models.popitem(last=False)
+        return model
+
+    def _report_response_usage(self, response: Any) -> None:
+        """Report the token usage attached to a Gemini response, if any"""
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            _report_usage(
+                getattr(usage, "prompt_token_count", 0),
+                getattr(usage, "candidates_token_count", 0),
+                getattr(usage, "cached_content_token_count", 0)
+            )
+
+    def _call_timeout(self) -> float:
+        """Timeout for one SDK call, capped by the current request deadline"""
+        remaining = _remaining_time()
+        if remaining is None:
+            return self.request_timeout
+        return min(self.request_timeout, remaining)
+
+    async def generate(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       system_prompt: Optional[str] = None) -> str:
+        if not self.api_key: # No key, or the client failed to configure
+            return self._mock_generate(prompt)
+
+        prompt = _join_prompt(prompt, params)  # Keep the stable prefix first
+
+        generation_config_params = {
+            "candidate_count": params.get("candidate_count", 1),
+            "max_output_tokens": params.get("max_tokens", 1000),
+            "temperature": params.get("temperature", 0.7),
+            "top_p": params.get("top_p", 1.0)
+        }
+        
+        # For Gemini 1.5 models, system_instruction is part of the model,
+        # so each distinct system prompt gets its own (cached) client.
+        # Older models get the system prompt prepended to the user prompt.
+        system_instruction = None
+        if system_prompt and ("1.5" in self.model_name or "gemini-pro" in self.model_name): # Gemini Pro also supports system instructions in chat
+            if "1.5" in self.model_name:
+                 system_instruction = system_prompt
+            else: # gemini-pro (non-1.5)
+                 prompt = f"{system_prompt}\n\nUser: {prompt}\nAssistant:" # Basic prepend
+        model_to_use = self._get_model(system_instruction)
+        generation_config = genai.types.GenerationConfig(**generation_config_params)
+
+        try:
+            response = await self.retry_policy.call(
+                lambda: asyncio.wait_for(
+                    model_to_use.generate_content_async(
+                        prompt, # Or `contents` if using chat structure
+                        generation_config=generation_config
+                    ),
+                    timeout=self._call_timeout()
+                ),
+                "Gemini"
+            )
+            self._report_response_usage(response)
+            return response.text
+        except Exception as e:
+            logger.error(f"Error calling Gemini API: {str(e)}", exc_info=True)
+            return self._mock_generate(prompt)
+
+    async def generate_with_json(self, 
+                               prompt: str, 
+                               json_schema: Dict[str, Any], 
+                               params: Dict[str, Any],
+                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+        if not self.api_key:
+            return self._mock_generate_json(prompt, json_schema)
+
+        prompt = _join_prompt(prompt, params)  # Keep the stable prefix first
+
+        # Instruct Gemini to respond in JSON format, including the schema
+        # This is a common way to guide models for JSON output.
+        json_prompt = (
+            f"{prompt}\n\n"
+            "Please provide your response strictly in JSON format. "
+            "The JSON object must conform to the following schema:\n"
+            f"{json.dumps(json_schema, indent=2)}"
+        )
+
+        generation_config_params = {
+            "candidate_count": params.get("candidate_count", 1),
+            "max_output_tokens": params.get("max_tokens", 2048), # JSON can be verbose
+            "temperature": params.get("temperature", 0.5), # Lower temp for structured output
+            "top_p": params.get("top_p", 1.0)
+        }
+        # For Gemini 1.5 models, we can specify response_mime_type
+        if "1.5" in self.model_name:
+            generation_config_params["response_mime_type"] = "application/json"
+        
+        system_instruction = None
+        if system_prompt and ("1.5" in self.model_name or "gemini-pro" in self.model_name):
+            if "1.5" in self.model_name:
+                 system_instruction = system_prompt
+            else: # gemini-pro (non-1.5)
+                 json_prompt = f"{system_prompt}\n\nUser: {json_prompt}\nAssistant:"
+        model_to_use = self._get_model(system_instruction)
+        generation_config = genai.types.GenerationConfig(**generation_config_params)
+
+        try:
+            response = await self.retry_policy.call(
+                lambda: asyncio.wait_for(
+                    model_to_use.generate_content_async(json_prompt, generation_config=generation_config),
+                    timeout=self._call_timeout()
+                ),
+                "Gemini"
+            )
+            self._report_response_usage(response)
+            # Gemini (especially with response_mime_type) should return clean JSON.
+            # If not, the repair pass handles ```json ... ``` blocks and truncation.
+            parsed = _parse_json_text(response.text)
+            if parsed is None:
+                logger.error(f"Failed to parse JSON from Gemini response: {response.text[:500]}...")
+                _report_backend_failure("Gemini: unparseable JSON response")
+                return self._mock_generate_json(prompt, json_schema)
+            return parsed
+        except Exception as e:
+            logger.error(f"Error calling Gemini API for JSON: {str(e)}", exc_info=True)
+            return self._mock_generate_json(prompt, json_schema)
+
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        if not self.api_key:
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+            return
+
+        prompt = _join_prompt(prompt, params)  # Keep the stable prefix first
+
+        generation_config_params = {
+            "candidate_count": params.get("candidate_count", 1),
+            "max_output_tokens": params.get("max_tokens", 1000),
+            "temperature": params.get("temperature", 0.7),
+            "top_p": params.get("top_p", 1.0)
+        }
+        
+        system_instruction = None
+        if system_prompt and ("1.5" in self.model_name or "gemini-pro" in self.model_name):
+            if "1.5" in self.model_name:
+                 system_instruction = system_prompt
+            else: # gemini-pro (non-1.5)
+                 prompt = f"{system_prompt}\n\nUser: {prompt}\nAssistant:"
+        model_to_use = self._get_model(system_instruction)
+        generation_config = genai.types.GenerationConfig(**generation_config_params)
+
+        streamed_any = False
+        try:
+            response = await self.retry_policy.call(
+                lambda: asyncio.wait_for(
+                    model_to_use.generate_content_async(prompt, generation_config=generation_config, stream=True),
+                    timeout=self._call_timeout()
+                ),
+                "Gemini"
+            )
+            async for chunk in response:
+                if chunk.text:
+                    streamed_any = True
+                    yield chunk.text
+            self._report_response_usage(response)
+        except Exception as e:
+            # A stream cut off mid-response must not be cached or counted as a success
+            logger.error(f"Error streaming from Gemini API: {str(e)}", exc_info=True)
+            _report_backend_failure(f"Gemini: {str(e)}")
+        
+        # Fall back to mock output only if nothing was streamed yet
+        if not streamed_any:
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+
+    def _mock_generate(self, prompt: str) -> str:
+        logger.info("Using Gemini mock response generator")
+        _report_mock_response()
+        return f"Mock Gemini response for: {prompt}"
+
+    def _mock_generate_json(self, prompt: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+        logger.info("Using Gemini mock JSON response generator")
+        _report_mock_response()
+        return {key: f"mock gemini value for {key}" for key in schema.get("properties", {}).keys()}
+
+def _sample(spec: Union[float, Dict[str, Any]], rng: random.Random) -> float:
+    """
+    Draw a non-negative value from a distribution spec
+    
+    A spec is either a number (always returned) or a dict naming the
+    distribution and its parameters, with optional "min"/"max" clamps:
+    {"distribution": "fixed", "value"}, {"distribution": "uniform", "low", "high"},
+    {"distribution": "normal", "mean", "stddev"},
+    {"distribution": "lognormal", "median", "sigma"} or
+    {"distribution": "exponential", "mean"}.
+    
+    Args:
+        spec: Distribution spec
+        rng: Random source
+        
+    Returns:
+        Sampled value
+    """
+    if not isinstance(spec, dict):
+        return max(0.0, float(spec))
+    
+    distribution = spec.get("distribution", "fixed")
+    if distribution == "fixed":
+        value = spec["value"]
+    elif distribution == "uniform":
+        value = rng.uniform(spec["low"], spec["high"])
+    elif distribution == "normal":
+        value = rng.gauss(spec["mean"], spec["stddev"])
+    elif distribution == "lognormal":
+        value = rng.lognormvariate(math.log(spec["median"]), spec["sigma"])
+    elif distribution == "exponential":
+        value = rng.expovariate(1.0 / spec["mean"])
+    else:
+        raise ValueError(f"Unknown distribution: {distribution}")
+    
+    value = max(value, spec.get("min", 0.0))
+    if "max" in spec:
+        value = min(value, spec["max"])
+    return value
+
+class SyntheticBackend(ModelBackend):
+    """
+    Provider-like backend with synthetic latency and failures for load testing
+    
+    Latency, time to first token, streaming cadence, response length and
+    injected errors and timeouts are drawn from configurable distributions.
+    Each call gets its own random source seeded from the backend seed, the
+    prompt and how many times that prompt has been sent, so a load test
+    replays identically however its requests interleave. Injected failures
+    behave like the real backends (the call is reported as failed and falls
+    back to mock output) unless error_mode is "raise".
+    """
+    
+    _WORDS = (
+        "the goblin raises its blade while torchlight flickers across damp stone "
+        "walls and a distant bell tolls as the party weighs the cost of every step "
+        "forward into the ruined keep where old magic lingers in the dust"
+    ).split()
+    
+    def __init__(self,
+                 model: str = "synthetic",
+                 latency: Optional[Union[float, Dict[str, Any]]] = None,
+                 time_to_first_token: Optional[Union[float, Dict[str, Any]]] = None,
+                 tokens_per_second: float = 50.0,
+                 response_tokens: Optional[Union[float, Dict[str, Any]]] = None,
+                 error_rate: float = 0.0,
+                 timeout_rate: float = 0.0,
+                 timeout_duration: float = 300.0,
+                 error_mode: str = "degrade",
+                 seed: int = 0,
+                 max_tracked_prompts: int = 100000):
+        """
+        Initialize synthetic backend
+        
+        Args:
+            model: Model name reported in backend info
+            latency: Distribution of non-streamed call latency in seconds
+                (defaults to lognormal, median 0.5s)
+            time_to_first_token: Distribution of the delay before the first
+                streamed chunk (defaults to lognormal, median 0.3s)
+            tokens_per_second: Streaming cadence after the first chunk
+            response_tokens: Distribution of response length in tokens
+                (defaults to lognormal, median 60)
+            error_rate: Fraction of calls that fail like a provider error
+            timeout_rate: Fraction of calls that hang for timeout_duration
+            timeout_duration: Seconds an injected timeout hangs before failing
+            error_mode: "degrade" to report the failure and return mock output
+                like the real backends, "raise" to raise ModelProtocolError
+            seed: Seed making every draw reproducible
+            max_tracked_prompts: Distinct prompts whose send counts are kept; the
+                least recently sent are forgotten beyond this, restarting their count
+        """
+        if error_mode not in ("degrade", "raise"):
+            raise ValueError("error_mode must be 'degrade' or 'raise'")
+        self.model = model
+        self.latency = latency if latency is not None else {"distribution": "lognormal", "median": 0.5, "sigma": 0.4}
+        self.time_to_first_token = (time_to_first_token if time_to_first_token is not None
+                                    else {"distribution": "lognormal", "median": 0.3, "sigma": 0.4})
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = (response_tokens if response_tokens is not None
+                                else {"distribution": "lognormal", "median": 60, "sigma": 0.5, "min": 1})
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_duration = timeout_duration
+        self.error_mode = error_mode
+        self.seed = seed
+        self.max_tracked_prompts = max_tracked_prompts
+        # Send count per prompt digest, least recently sent first
+        self._prompt_counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self.calls = 0
+        self.injected_errors = 0
+        self.injected_timeouts = 0
+    
+    def _rng(self, prompt: str) -> random.Random:
+        """Random source for one call, independent of how calls interleave"""
+        prompt_digest = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        count = self._prompt_counts.pop(prompt_digest, 0)
+        self._prompt_counts[prompt_digest] = count + 1
+        if len(self._prompt_counts) > self.max_tracked_prompts:
+            self._prompt_counts.popitem(last=False)
+        self.calls += 1
+        digest = hashlib.blake2b(f"{self.seed}:{count}:".encode() + prompt_digest, digest_size=8).digest()
+        return random.Random(int.from_bytes(digest, "big"))
+    
+    async def _inject_failure(self, rng: random.Random) -> bool:
+        """
+        Apply injected errors and timeouts to the current call
+        
+        Returns:
+            True if the call failed and should degrade to mock output
+            
+        Raises:
+            ModelProtocolError: If the call failed and error_mode is "raise"
+        """
+        roll = rng.random()
+        if roll < self.timeout_rate:
+            self.injected_timeouts += 1
+            await asyncio.sleep(self.timeout_duration)
+            error = "Injected timeout"
+        elif roll < self.timeout_rate + self.error_rate:
+            self.injected_errors += 1
+            await asyncio.sleep(_sample(self.latency, rng) * rng.random())
+            error = "Injected error"
+        else:
+            return False
+        
+        if self.error_mode == "raise":
+            raise ModelProtocolError(error)
+        _report_backend_failure(error)
+        return True
+    
+    def _text(self, rng: random.Random) -> str:
+        """Synthetic response text with a sampled length"""
+        count = max(1, int(_sample(self.response_tokens, rng)))
+        return " ".join(rng.choice(self._WORDS) for _ in range(count))
+    
+    def _value(self, schema: Dict[str, Any], rng: random.Random) -> Any:
+        """Synthetic value matching a JSON schema"""
+        schema_type = schema.get("type", "string")
+        if schema_type == "object":
+            return {key: self._value(prop, rng) for key, prop in schema.get("properties", {}).items()}
+        if schema_type == "array":
+            return [self._value(schema.get("items", {}), rng) for _ in range(rng.randint(1, 3))]
+        if schema_type == "integer":
+            return rng.randint(0, 20)
+        if schema_type == "number":
+            return round(rng.uniform(0, 1), 3)
+        if schema_type == "boolean":
+            return rng.random() < 0.5
+        if "enum" in schema:
+            return rng.choice(schema["enum"])
+        return self._text(rng)
+    
+    async def generate(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       system_prompt: Optional[str] = None) -> str:
+        """
+        Generate a synthetic response after a sampled latency
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Synthetic text response
+        """
+        rng = self._rng(prompt)
+        if await self._inject_failure(rng):
+            return self._mock_generate(prompt)
+        
+        await asyncio.sleep(_sample(self.latency, rng))
+        text = self._text(rng)
+        _report_usage(self.estimate_tokens(_join_prompt(prompt, params)) + self.estimate_tokens(system_prompt or ""),
+                      self.estimate_tokens(text))
+        return text
+    
+    async def generate_with_json(self, 
+                               prompt: str, 
+                               json_schema: Dict[str, Any], 
+                               params: Dict[str, Any],
+                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a synthetic JSON response matching the schema after a sampled latency
+        
+        Args:
+            prompt: The input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Synthetic JSON response
+        """
+        rng = self._rng(prompt)
+        if await self._inject_failure(rng):
+            return self._mock_generate_json(prompt, json_schema)
+        
+        await asyncio.sleep(_sample(self.latency, rng))
+        result = self._value(dict(json_schema, type="object"), rng)
+        _report_usage(self.estimate_tokens(_join_prompt(prompt, params)) + self.estimate_tokens(system_prompt or ""),
+                      self.estimate_tokens(json.dumps(result)))
+        return result
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Stream a synthetic response with a sampled first-token delay and token cadence
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Word-sized text chunks
+        """
+        rng = self._rng(prompt)
+        if await self._inject_failure(rng):
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+            return
+        
+        await asyncio.sleep(_sample(self.time_to_first_token, rng))
+        text = self._text(rng)
+        first = True
+        for chunk in _iter_mock_chunks(text):
+            if not first:
+                await asyncio.sleep(rng.expovariate(self.tokens_per_second))
+            first = False
+            yield chunk
+        _report_usage(self.estimate_tokens(_join_prompt(prompt, params)) + self.estimate_tokens(system_prompt or ""),
+                      self.estimate_tokens(text))
+    
+    async def generate_with_json_stream(self, 
+                                        prompt: str, 
+                                        json_schema: Dict[str, Any], 
+                                        params: Dict[str, Any],
+                                        system_prompt: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Stream a synthetic JSON response, yielding each top-level field as its text completes
+        
+        Args:
+            prompt: The input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            (field name, value) pairs in completion order
+        """
+        rng = self._rng(prompt)
+        if await self._inject_failure(rng):
+            for field in self._mock_generate_json(prompt, json_schema).items():
+                yield field
+            return
+        
+        await asyncio.sleep(_sample(self.time_to_first_token, rng))
+        text = json.dumps(self._value(dict(json_schema, type="object"), rng))
+        parser = IncrementalJSONParser()
+        first = True
+        for chunk in _iter_mock_chunks(text):
+            if not first:
+                await asyncio.sleep(rng.expovariate(self.tokens_per_second))
+            first = False
+            for field in parser.feed(chunk):
+                yield field
+        _report_usage(self.estimate_tokens(_join_prompt(prompt, params)) + self.estimate_tokens(system_prompt or ""),
+                      self.estimate_tokens(text))
+    
+    def get_profile(self) -> Dict[str, Any]:
+        """
+        Get the configured behaviour and injection counters
+        
+        Returns:
+            Synthetic profile settings and counters
+        """
+        return {
+            "latency": self.latency,
+            "time_to_first_token": self.time_to_first_token,
+            "tokens_per_second": self.tokens_per_second,
+            "response_tokens": self.response_tokens,
+            "error_rate": self.error_rate,
+            "timeout_rate": self.timeout_rate,
+            "seed": self.seed,
+            "calls": self.calls,
+            "injected_errors": self.injected_errors,
+            "injected_timeouts": self.injected_timeouts
+        }
+
+class Cassette:
+    """
+    On-disk recording of model traffic
+    
+    Each request/response pair is one JSON line, gzip-compressed when the
+    path ends in ".gz". Entries are keyed by a digest of the backend name,
+    prompt, system prompt, parameters and schema, and responses recorded for
+    the same key are replayed in the order they were recorded.
+    """
+    
+    def __init__(self, path: str = "data/model_cassette.jsonl.gz"):
+        """
+        Initialize cassette
+        
+        Args:
+            path: Cassette file (gzip-compressed if it ends in ".gz")
+        """
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(backend_name: str, 
+            prompt: str, 
+            params: Dict[str, Any], 
+            system_prompt: Optional[str] = None,
+            json_schema: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Get the cassette key of a request
+        
+        Returns:
+            Hex digest identifying the request
+        """
+        request = json.dumps([backend_name, prompt, system_prompt, params, json_schema], sort_keys=True)
+        return hashlib.blake2b(request.encode(), digest_size=16).hexdigest()
+    
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+    
+    def load(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Read all recorded entries
+        
+        Returns:
+            Entries grouped by key, in recording order
+        """
+        entries: Dict[str, List[Dict[str, Any]]] = {}
+        if not os.path.exists(self.path):
+            logger.warning(f"Cassette {self.path} does not exist, nothing to replay")
+            return entries
+        with self._open("r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"Loaded {sum(len(v) for v in entries.values())} recorded responses from {self.path}")
+        return entries
+    
+    def append(self, entry: Dict[str, Any]) -> None:
+        """
+        Append one entry to the cassette
+        
+        Args:
+            entry: JSON-serializable entry including its "key"
+        """
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = self._open("a")
+            self._file.write(line)
+            self._file.flush()
+    
+    def close(self) -> None:
+        """Close the cassette file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class CassetteBackend(ModelBackend):
+    """
+    Backend wrapper that records traffic to, or replays it from, a cassette
+    
+    In record mode calls go to the wrapped backend and every answered
+    request is written to the cassette with its latency (and chunk timing
+    for streams). In replay mode recorded responses are served without
+    touching the network, after their original latency multiplied by
+    time_scale.
+    """
+    
+    def __init__(self,
+                 name: str,
+                 cassette: Cassette,
+                 mode: str,
+                 backend: Optional[ModelBackend] = None,
+                 entries: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+                 time_scale: float = 1.0,
+                 on_miss: str = "error"):
+        """
+        Initialize cassette backend
+        
+        Args:
+            name: Name of the backend being recorded or replayed
+            cassette: Cassette to record to or replay from
+            mode: "record" or "replay"
+            backend: Wrapped backend (required to record or pass misses through)
+            entries: Recorded entries for replay (from Cassette.load())
+            time_scale: Multiplier for recorded timing (1.0 original, 0 instant)
+            on_miss: Replay of an unrecorded request: "error" raises
+                ModelProtocolError, "mock" serves mock output, "passthrough"
+                calls the wrapped backend
+        """
+        if mode not in ("record", "replay"):
+            raise ValueError("mode must be 'record' or 'replay'")
+        if on_miss not in ("error", "mock", "passthrough"):
+            raise ValueError("on_miss must be 'error', 'mock' or 'passthrough'")
+        self.name = name
+        self.cassette = cassette
+        self.mode = mode
+        self.backend = backend
+        self.entries = entries or {}
+        self.time_scale = time_scale
+        self.on_miss = on_miss
+        self.model = getattr(backend, "model", "cassette")
+        if backend is not None:
+            self.context_window = backend.context_window
+            self.chars_per_token = backend.chars_per_token
+        self._cursors: Dict[str, int] = {}
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+    
+    def _record(self, 
+                key: str, 
+                prompt: str, 
+                params: Dict[str, Any], 
+                system_prompt: Optional[str],
+                json_schema: Optional[Dict[str, Any]],
+                response: Any,
+                latency: float,
+                chunks: Optional[List[Tuple[float, str]]] = None) -> None:
+        """Write an answered request to the cassette (failed calls are skipped)"""
+        outcome = _call_outcome.get()
+        if outcome is not None and outcome.failed:
+            return
+        entry = {
+            "key": key,
+            "backend": self.name,
+            "prompt": prompt,
+            "system_prompt": system_prompt,
+            "params": params,
+            "schema": json_schema,
+            "response": response,
+            "latency": round(latency, 4)
+        }
+        if chunks is not None:
+            entry["chunks"] = [[round(offset, 4), text] for offset, text in chunks]
+        if outcome is not None and outcome.usage is not None:
+            entry["usage"] = outcome.usage
+        try:
+            self.cassette.append(entry)
+            self.recorded += 1
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Error recording to cassette: {str(e)}")
+    
+    def _next_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        """Next recorded entry for a key; the last one repeats once all were served"""
+        recorded = self.entries.get(key)
+        if not recorded:
+            return None
+        index = self._cursors.get(key, 0)
+        self._cursors[key] = index + 1
+        self.replayed += 1
+        entry = recorded[min(index, len(recorded) - 1)]
+        if entry.get("usage"):
+            _report_usage(**entry["usage"])
+        return entry
+    
+    def _miss(self, key: str) -> None:
+        """Handle a replay miss that is not passed through"""
+        self.misses += 1
+        if self.on_miss == "error":
+            raise ModelProtocolError(f"No recorded response for request {key[:8]} on backend '{self.name}'")
+        logger.warning(f"No recorded response for request {key[:8]} on backend '{self.name}'")
+    
+    async def generate(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       system_prompt: Optional[str] = None) -> str:
+        """
+        Generate a response, recording or replaying it
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated (or recorded) text response
+        """
+        key = Cassette.key(self.name, prompt, params, system_prompt)
+        if self.mode == "record":
+            started = time.monotonic()
+            response = await self.backend.generate(prompt, params, system_prompt)
+            self._record(key, prompt, params, system_prompt, None, response, time.monotonic() - started)
+            return response
+        
+        entry = self._next_entry(key)
+        if entry is None:
+            if self.on_miss == "passthrough" and self.backend is not None:
+                self.misses += 1
+                return await self.backend.generate(prompt, params, system_prompt)
+            self._miss(key)
+            return self._mock_generate(prompt)
+        await asyncio.sleep(entry["latency"] * self.time_scale)
+        return entry["response"]
+    
+    async def generate_with_json(self, 
+                               prompt: str, 
+                               json_schema: Dict[str, Any], 
+                               params: Dict[str, Any],
+                               system_prompt: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Generate a JSON response, recording or replaying it
+        
+        Args:
+            prompt: The input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Returns:
+            Generated (or recorded) JSON response
+        """
+        key = Cassette.key(self.name, prompt, params, system_prompt, json_schema)
+        if self.mode == "record":
+            started = time.monotonic()
+            response = await self.backend.generate_with_json(prompt, json_schema, params, system_prompt)
+            self._record(key, prompt, params, system_prompt, json_schema, response, time.monotonic() - started)
+            return response
+        
+        entry = self._next_entry(key)
+        if entry is None:
+            if self.on_miss == "passthrough" and self.backend is not None:
+                self.misses += 1
+                return await self.backend.generate_with_json(prompt, json_schema, params, system_prompt)
+            self._miss(key)
+            return self._mock_generate_json(prompt, json_schema)
+        await asyncio.sleep(entry["latency"] * self.time_scale)
+        return entry["response"]
+    
+    async def generate_stream(self, 
+                              prompt: str, 
+                              params: Dict[str, Any], 
+                              system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Stream a response, recording or replaying its chunk timing
+        
+        Streams share cassette entries with generate(); a response recorded
+        without chunks is replayed as word chunks spread over its latency.
+        
+        Args:
+            prompt: The input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt or instruction
+            
+        Yields:
+            Text chunks in generation order
+        """
+        key = Cassette.key(self.name, prompt, params, system_prompt)
+        if self.mode == "record":
+            started = time.monotonic()
+            chunks: List[Tuple[float, str]] = []
+            async for chunk in self.backend.generate_stream(prompt, params, system_prompt):
+                chunks.append((time.monotonic() - started, chunk))
+                yield chunk
+            self._record(key, prompt, params, system_prompt, None, "".join(text for _, text in chunks),
+                         time.monotonic() - started, chunks)
+            return
+        
+        entry = self._next_entry(key)
+        if entry is None:
+            if self.on_miss == "passthrough" and self.backend is not None:
+                self.misses += 1
+                async for chunk in self.backend.generate_stream(prompt, params, system_prompt):
+                    yield chunk
+                return
+            self._miss(key)
+            for chunk in _iter_mock_chunks(self._mock_generate(prompt)):
+                yield chunk
+            return
+        
+        timed_chunks = entry.get("chunks")
+        if timed_chunks is None:
+            words = list(_iter_mock_chunks(entry["response"]))
+            step = entry["latency"] / max(len(words), 1)
+            timed_chunks = [[step * (i + 1), word] for i, word in enumerate(words)]
+        started = time.monotonic()
+        for offset, text in timed_chunks:
+            delay = offset * self.time_scale - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield text
+    
+    def get_profile(self) -> Dict[str, Any]:
+        """
+        Get cassette mode and counters
+        
+        Returns:
+            Mode, cassette path and record/replay counters
+        """
+        return {
+            "cassette_mode": self.mode,
+            "cassette": self.cassette.path,
+            "time_scale": self.time_scale,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses
+        }
+    
+    async def close(self) -> None:
+        """Close the wrapped backend"""
+        if self.backend is not None:
+            await self.backend.close()
+
+class FrequencySketch:
+    """
+    Approximate access counts for cache admission (TinyLFU)
+    
+    A count-min sketch of small saturating counters. Once the number of
+    recorded accesses reaches the sample size every counter is halved, so
+    frequencies track recent popularity rather than all-time totals.
+    """
+    
+    _MAX_COUNT = 15
+    
+    def __init__(self, capacity: int, depth: int = 4):
+        """
+        Initialize frequency sketch
+        
+        Args:
+            capacity: Number of entries the cache holds (sizes the sketch)
+            depth: Number of hash rows
+        """
+        width = 1
+        while width < max(capacity, 16):
+            width <<= 1
+        self._mask = width - 1
+        self._rows = [[0] * width for _ in range(depth)]
+        self.sample_size = 10 * max(capacity, 16)
+        self._additions = 0
+    
+    def _indexes(self, key: str) -> List[int]:
+        # Double hashing derives one index per row from a single hash
+        h = hash(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+        mask = self._mask
+        return [(h1 + i * h2) & mask for i in range(len(self._rows))]
+    
+    def increment(self, key: str) -> None:
+        """Record an access to a key"""
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self._MAX_COUNT:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._reset()
+    
+    def frequency(self, key: str) -> int:
+        """Estimated recent access count of a key"""
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+    
+    def _reset(self) -> None:
+        """Halve every counter to age out old popularity"""
+        self._rows = [[count >> 1 for count in row] for row in self._rows]
+        self._additions //= 2
+    
+    def clear(self) -> None:
+        """Forget all counts"""
+        self._rows = [[0] * len(row) for row in self._rows]
+        self._additions = 0
+
+class _EncodedValue:
+    """Cached value held as bytes: compact JSON and/or zlib-compressed text"""
+    
+    __slots__ = ("codec", "payload")
+    
+    def __init__(self, codec: str, payload: bytes):
+        self.codec = codec
+        self.payload = payload
+    
+    def decode(self) -> Any:
+        if self.codec == "zstr":
+            return zlib.decompress(self.payload).decode("utf-8")
+        data = zlib.decompress(self.payload) if self.codec == "zjson" else self.payload
+        return json.loads(data)
+
+class ResponseCache:
+    """
+    Cache for model responses to avoid redundant API calls
+    
+    Entries live in an OrderedDict kept in least- to most-recently-used order,
+    so lookups, inserts and LRU eviction are all O(1). Expiry times are kept
+    in a min-heap, and expired entries are reclaimed on every access instead
+    of only when they happen to be read.
+    
+    With admission enabled, a new entry only replaces the LRU victim of a
+    full cache if its key has been requested more often recently (TinyLFU),
+    so one-off prompts cannot flush out hot, repeated ones.
+    
+    With compression enabled, JSON results are stored as compact JSON bytes
+    and any value whose encoding reaches the threshold is zlib-compressed;
+    values are decoded transparently on read. The cache can be capped by
+    total bytes as well as by entry count.
+    """
+    
+    def __init__(self, 
+                 max_size: int = 1000, 
+                 ttl: int = 3600, 
+                 admission: bool = True,
+                 max_bytes: Optional[int] = None,
+                 compress_threshold: Optional[int] = None,
+                 compress_level: int = 6):
+        """
+        Initialize response cache
+        
+        Args:
+            max_size: Maximum number of items in cache
+            ttl: Time to live in seconds
+            admission: Filter new entries by access frequency once the cache is full
+            max_bytes: Maximum approximate memory used by cached values (None for no limit)
+            compress_threshold: Encoded size in bytes from which values are
+                zlib-compressed (None stores values as plain objects)
+            compress_level: zlib compression level
+        """
+        self.cache: "OrderedDict[str, Any]" = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.expiry_times: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self._tags: Dict[str, Set[str]] = {}  # Tag -> keys carrying it
+        self._key_tags: Dict[str, Tuple[str, ...]] = {}
+        self.sketch = FrequencySketch(max_size) if admission else None
+        self.max_bytes = max_bytes
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.sizes: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.evictions = 0
+    
+    def __len__(self) -> int:
+        return len(self.cache)
+    
+    def _remove(self, key: str) -> None:
+        """Remove a key from the cache (its heap entry becomes stale)"""
+        del self.cache[key]
+        del self.expiry_times[key]
+        self.total_bytes -= self.sizes.pop(key)
+        for tag in self._key_tags.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+    
+    def purge_expired(self) -> int:
+        """
+        Remove all expired items from the cache
+        
+        Returns:
+            Number of items removed
+        """
+        now = time.time()
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            # Skip heap entries left behind by overwritten or evicted keys
+            if self.expiry_times.get(key) == expires_at:
+                self._remove(key)
+                removed += 1
+        
+        # Stale heap entries can outnumber live ones when keys are rewritten often
+        if len(heap) > 2 * len(self.cache) + 64:
+            self._expiry_heap = [(expires_at, key) for key, expires_at in self.expiry_times.items()]
+            heapq.heapify(self._expiry_heap)
+        
+        return removed
+    
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get item from cache
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Cached item or None if not found
+        """
+        self.purge_expired()
+        if self.sketch is not None:
+            self.sketch.increment(key)
+        
+        if key in self.cache:
+            # Mark as most recently used
+            self.cache.move_to_end(key)
+            self.hits += 1
+            value = self.cache[key]
+            return value.decode() if isinstance(value, _EncodedValue) else value
+        
+        self.misses += 1
+        return None
+    
+    def set(self, key: str, value: Any, tags: Optional[List[str]] = None) -> None:
+        """
+        Set item in cache
+        
+        Args:
+            key: Cache key
+            value: Value to cache
+            tags: Tags (e.g. location or campaign ids) to invalidate the item by
+        """
+        self.purge_expired()
+        
+        is_new = key not in self.cache
+        if not is_new:
+            self._remove(key)
+        
+        stored, size = self._encode(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.rejected += 1
+            return
+        if self.cache and self._over_capacity(size):
+            lru_key = next(iter(self.cache))
+            if is_new and self.sketch is not None and self.sketch.frequency(key) <= self.sketch.frequency(lru_key):
+                # Not requested more often than the entry it would replace
+                self.rejected += 1
+                return
+            # Remove least recently used items until the new one fits
+            while self.cache and self._over_capacity(size):
+                self._remove(next(iter(self.cache)))
+                self.evictions += 1
+        self.admitted += 1
+        
+        # Add new item
+        expires_at = time.time() + self.ttl
+        self.cache[key] = stored
+        self.sizes[key] = size
+        self.total_bytes += size
+        self.expiry_times[key] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, key))
+        if tags:
+            self._key_tags[key] = tuple(tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+    
+    def invalidate_tags(self, tags: List[str]) -> int:
+        """
+        Remove every item carrying any of the given tags
+        
+        Args:
+            tags: Tags to invalidate
+            
+        Returns:
+            Number of items removed
+        """
+        keys = set()
+        for tag in tags:
+            keys.update(self._tags.get(tag, ()))
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+    
+    def _over_capacity(self, incoming_size: int) -> bool:
+        """Whether adding an entry of the given size would exceed a limit"""
+        if len(self.cache) >= self.max_size:
+            return True
+        return self.max_bytes is not None and self.total_bytes + incoming_size > self.max_bytes
+    
+    def _encode(self, value: Any) -> Tuple[Any, int]:
+        """
+        Get the stored form of a value and its approximate size in bytes
+        
+        Args:
+            value: Value to cache
+            
+        Returns:
+            Tuple of (stored value, size in bytes)
+        """
+        if self.compress_threshold is None:
+            if self.max_bytes is None:
+                return value, 0
+            if isinstance(value, str):
+                return value, sys.getsizeof(value)
+            try:
+                return value, len(json.dumps(value, separators=(",", ":")))
+            except (TypeError, ValueError):
+                return value, sys.getsizeof(value)
+        
+        if isinstance(value, str):
+            if len(value) < self.compress_threshold:
+                return value, sys.getsizeof(value)
+            stored = _EncodedValue("zstr", zlib.compress(value.encode("utf-8"), self.compress_level))
+        else:
+            try:
+                data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+            except (TypeError, ValueError):
+                return value, sys.getsizeof(value)
+            if len(data) < self.compress_threshold:
+                stored = _EncodedValue("json", data)
+            else:
+                stored = _EncodedValue("zjson", zlib.compress(data, self.compress_level))
+        return stored, sys.getsizeof(stored.payload) + sys.getsizeof(stored)
+    
+    def frequency(self, key: str) -> int:
+        """
+        Get the estimated recent request count of a key
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Estimated count (0 if admission is disabled)
+        """
+        return self.sketch.frequency(key) if self.sketch is not None else 0
+    
+    def get_stats(self, top: int = 10) -> Dict[str, Any]:
+        """
+        Get cache statistics
+        
+        Args:
+            top: Number of hottest cached keys to list with their frequencies
+            
+        Returns:
+            Size, hit, admission and eviction counters
+        """
+        lookups = self.hits + self.misses
+        stats = {
+            "entries": len(self.cache),
+            "max_size": self.max_size,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "evictions": self.evictions
+        }
+        if self.sketch is not None and top:
+            hottest = heapq.nlargest(top, ((self.sketch.frequency(key), key) for key in self.cache))
+            stats["hottest"] = [{"key": key, "frequency": frequency} for frequency, key in hottest]
+        return stats
+    
+    def clear(self) -> None:
+        """Clear the cache"""
+        self.cache.clear()
+        self.expiry_times.clear()
+        self._expiry_heap.clear()
+        self._tags.clear()
+        self._key_tags.clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+
+class DiskResponseCache:
+    """
+    Persistent second-tier response cache backed by a local SQLite file
+    
+    Survives restarts so warm deploys can serve common responses without a
+    provider round trip. Values are stored as JSON, expire after a TTL, and
+    the least recently used entries are evicted once the entry or byte limit
+    is exceeded. The async methods run the SQLite work in a thread pool so
+    the event loop is never blocked on disk I/O.
+    """
+    
+    def __init__(self, 
+                 path: str = "data/response_cache.sqlite3", 
+                 ttl: int = 86400,
+                 max_entries: int = 100000,
+                 max_bytes: Optional[int] = None):
+        """
+        Initialize disk cache
+        
+        Args:
+            path: SQLite database file
+            ttl: Time to live in seconds
+            max_entries: Maximum number of stored entries
+            max_bytes: Maximum total size of stored values (None for no limit)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes_since_trim = 0
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The timeout makes concurrent writers from other worker processes wait instead of failing
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_tags ("
+            " tag TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " PRIMARY KEY (tag, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_tags_key ON response_tags (key)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0)")
+    
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get item from disk
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Cached item or None if not found or expired
+        """
+        entry = self.get_with_tags(key)
+        return entry[0] if entry is not None else None
+    
+    def get_with_tags(self, key: str) -> Optional[Tuple[Any, List[str]]]:
+        """
+        Get item from disk together with its invalidation tags
+        
+        Args:
+            key: Cache key
+            
+        Returns:
+            Tuple of (cached item, tags), or None if not found or expired
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row[1] <= now:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    return None
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                tags = [tag for (tag,) in self._conn.execute(
+                    "SELECT tag FROM response_tags WHERE key = ?", (key,)
+                )]
+            return json.loads(row[0]), tags
+        except (sqlite3.Error, ValueError) as e:
+            logger.error(f"Error reading disk cache: {str(e)}")
+            return None
+    
+    def set(self, 
+            key: str, 
+            value: Any, 
+            ttl: Optional[float] = None, 
+            tags: Optional[List[str]] = None) -> None:
+        """
+        Set item on disk
+        
+        Args:
+            key: Cache key
+            value: JSON-serializable value to cache
+            ttl: Time to live in seconds for this entry (defaults to the store's TTL)
+            tags: Tags to invalidate the entry by
+        """
+        now = time.time()
+        try:
+            encoded = json.dumps(value, separators=(",", ":"))
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, expires_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, encoded, len(encoded), now + (self.ttl if ttl is None else ttl), now)
+                )
+                self._conn.execute("DELETE FROM response_tags WHERE key = ?", (key,))
+                if tags:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO response_tags (tag, key) VALUES (?, ?)",
+                        [(tag, key) for tag in tags]
+                    )
+                self._writes_since_trim += 1
+                # Trimming scans the table, so amortize it over many writes
+                if self._writes_since_trim >= 100:
+                    self._writes_since_trim = 0
+                    self._trim(now)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.error(f"Error writing disk cache: {str(e)}")
+    
+    def delete(self, key: str) -> None:
+        """
+        Remove an item from disk
+        
+        Args:
+            key: Cache key
+        """
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.execute("DELETE FROM response_tags WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.error(f"Error deleting from disk cache: {str(e)}")
+    
+    def invalidate_tags(self, tags: List[str]) -> int:
+        """
+        Remove every entry carrying any of the given tags
+        
+        Bumps the generation counter so other processes sharing the file
+        drop their in-memory copies.
+        
+        Args:
+            tags: Tags to invalidate
+            
+        Returns:
+            Number of entries removed
+        """
+        if not tags:
+            return 0
+        placeholders = ", ".join("?" for _ in tags)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._conn.execute(
+                    f"DELETE FROM responses WHERE key IN "
+                    f"(SELECT key FROM response_tags WHERE tag IN ({placeholders}))",
+                    list(tags)
+                ).rowcount
+                self._conn.execute(
+                    f"DELETE FROM response_tags WHERE key IN "
+                    f"(SELECT key FROM response_tags WHERE tag IN ({placeholders}))",
+                    list(tags)
+                )
+                self._conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+        return removed
+    
+    def _trim(self, now: float) -> None:
+        """Remove expired entries, then evict LRU entries beyond the limits (lock held)"""
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+        
+        count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        
+        if self.max_bytes is not None:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk entries from least recently used until enough bytes are freed
+                excess = total - self.max_bytes
+                victims = []
+                for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        
+        # Drop tags of entries that expired or were evicted
+        self._conn.execute("DELETE FROM response_tags WHERE key NOT IN (SELECT key FROM responses)")
+    
+    async def aget(self, key: str) -> Optional[Any]:
+        """Get item from disk without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, key)
+    
+    async def aget_with_tags(self, key: str) -> Optional[Tuple[Any, List[str]]]:
+        """Get item and its tags from disk without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_with_tags, key)
+    
+    async def aset(self, key: str, value: Any, tags: Optional[List[str]] = None) -> None:
+        """Set item on disk without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.set, key, value, None, tags)
+    
+    def clear(self) -> None:
+        """Remove all entries from disk and bump the generation counter"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.execute("DELETE FROM response_tags")
+                self._conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+    
+    async def aclear(self) -> None:
+        """Remove all entries from disk without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.clear)
+    
+    def generation(self) -> int:
+        """
+        Get the invalidation generation of the store
+        
+        Processes sharing the file compare it to know when another process
+        cleared the store and their in-memory copies are stale.
+        
+        Returns:
+            Generation counter
+        """
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+    
+    async def ageneration(self) -> int:
+        """Get the invalidation generation without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.generation)
+    
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    
+    def close(self) -> None:
+        """Close the SQLite connection"""
+        with self._lock:
+            self._conn.close()
+
+class SimilarityCache:
+    """
+    Near-duplicate prompt cache
+    
+    Prompts are normalized (case, punctuation, whitespace and numbers) and
+    broken into character shingles. A MinHash signature split into LSH bands
+    finds earlier prompts that are probably similar, and candidates are
+    confirmed with the exact Jaccard similarity of their shingle sets. Entries
+    are scoped, so only requests with identical backend, parameters, system
+    prompt and schema can match each other.
+    
+    Only the text that varies between requests should be matched: a long
+    shared template makes every prompt look alike, so different inputs can be
+    served each other's responses. The server matches on similarity_text
+    when given (keeping the rest of the prompt in the scope), and the default
+    threshold is deliberately strict.
+    """
+    
+    # Mersenne prime used for the MinHash permutations
+    _PRIME = (1 << 61) - 1
+    
+    def __init__(self,
+                 threshold: float = 0.9,
+                 num_perm: int = 32,
+                 bands: int = 8,
+                 shingle_size: int = 4,
+                 max_entries: int = 5000,
+                 ttl: int = 3600,
+                 seed: int = 1):
+        """
+        Initialize similarity cache
+        
+        Args:
+            threshold: Minimum Jaccard similarity for a prompt to count as a hit
+            num_perm: Number of MinHash permutations (must be divisible by bands)
+            bands: Number of LSH bands
+            shingle_size: Characters per shingle
+            max_entries: Maximum number of cached prompts
+            ttl: Time to live in seconds
+            seed: Seed for the permutation coefficients
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[int]] = {}
+        self._exact: Dict[Tuple[str, str], int] = {}
+        self._tags: Dict[str, Set[int]] = {}  # Tag -> entry ids carrying it
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        """
+        Normalize a prompt for near-duplicate matching
+        
+        Lowercases, replaces numbers with "#", drops punctuation and collapses
+        whitespace, so "I attack the goblin 2!" and "attack the goblin 3"
+        differ only by the leading "i".
+        """
+        text = prompt.lower()
+        text = re.sub(r"\d+(?:\.\d+)?", "#", text)
+        text = re.sub(r"[^\w#\s]", " ", text)
+        return " ".join(text.split())
+    
+    def _shingles(self, text: str) -> FrozenSet[int]:
+        k = self.shingle_size
+        if len(text) <= k:
+            return frozenset([hash(text)])
+        return frozenset(hash(text[i:i + k]) for i in range(len(text) - k + 1))
+    
+    def _signature(self, shingles: FrozenSet[int]) -> List[int]:
+        prime = self._PRIME
+        return [min((a * x + b) % prime for x in shingles) for a, b in self._perms]
+    
+    def _band_keys(self, scope: str, signature: List[int]) -> List[Tuple[str, int, Tuple[int, ...]]]:
+        rows = self.rows
+        return [(scope, band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+    
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        for band_key in entry["band_keys"]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
+        if self._exact.get((entry["scope"], entry["normalized"])) == entry_id:
+            del self._exact[(entry["scope"], entry["normalized"])]
+        for tag in entry["tags"]:
+            ids = self._tags.get(tag)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._tags[tag]
+    
+    def _live(self, entry_id: int, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(entry_id)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= now:
+            self._remove(entry_id)
+            return None
+        return entry
+    
+    def get(self, prompt: str, scope: str) -> Optional[Any]:
+        """
+        Find the response of a near-identical earlier prompt
+        
+        Args:
+            prompt: Input prompt
+            scope: Key identifying everything about the request except the prompt
+            
+        Returns:
+            Cached response of the most similar prompt above the threshold, or None
+        """
+        now = time.time()
+        normalized = self.normalize(prompt)
+        
+        # Fast path: identical after normalization
+        entry_id = self._exact.get((scope, normalized))
+        if entry_id is not None and self._live(entry_id, now) is not None:
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id]["value"]
+        
+        shingles = self._shingles(normalized)
+        signature = self._signature(shingles)
+        candidates: Set[int] = set()
+        for band_key in self._band_keys(scope, signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        
+        best_id, best_score = None, 0.0
+        for candidate_id in candidates:
+            entry = self._live(candidate_id, now)
+            if entry is None:
+                continue
+            other = entry["shingles"]
+            score = len(shingles & other) / len(shingles | other)
+            if score > best_score:
+                best_id, best_score = candidate_id, score
+        
+        if best_id is None or best_score < self.threshold:
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(best_id)
+        self.hits += 1
+        logger.info(f"Similarity cache hit (similarity {best_score:.2f})")
+        return self._entries[best_id]["value"]
+    
+    def set(self, prompt: str, scope: str, value: Any, tags: Optional[List[str]] = None) -> None:
+        """
+        Cache a response for near-duplicate matching
+        
+        Args:
+            prompt: Input prompt
+            scope: Key identifying everything about the request except the prompt
+            value: Response to cache
+            tags: Tags to invalidate the response by
+        """
+        normalized = self.normalize(prompt)
+        existing = self._exact.get((scope, normalized))
+        if existing is not None and existing in self._entries:
+            self._remove(existing)
+        
+        while len(self._entries) >= self.max_entries:
+            self._remove(next(iter(self._entries)))
+        
+        shingles = self._shingles(normalized)
+        band_keys = self._band_keys(scope, self._signature(shingles))
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = {
+            "scope": scope,
+            "normalized": normalized,
+            "shingles": shingles,
+            "band_keys": band_keys,
+            "value": value,
+            "expires_at": time.time() + self.ttl,
+            "tags": tuple(tags or ())
+        }
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(entry_id)
+        self._exact[(scope, normalized)] = entry_id
+        for tag in tags or ():
+            self._tags.setdefault(tag, set()).add(entry_id)
+    
+    def invalidate_tags(self, tags: List[str]) -> int:
+        """
+        Remove every response carrying any of the given tags
+        
+        Args:
+            tags: Tags to invalidate
+            
+        Returns:
+            Number of responses removed
+        """
+        entry_ids = set()
+        for tag in tags:
+            entry_ids.update(self._tags.get(tag, ()))
+        for entry_id in entry_ids:
+            self._remove(entry_id)
+        return len(entry_ids)
+    
+    def clear(self) -> None:
+        """Clear the cache"""
+        self._entries.clear()
+        self._buckets.clear()
+        self._exact.clear()
+        self._tags.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get similarity cache statistics
+        
+        Returns:
+            Entry count, hits, misses and hit ratio
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+class RequestBatcher:
+    """
+    Micro-batching stage for concurrent generate calls
+    
+    Requests are held for a short window and grouped by backend, parameters,
+    system prompt and JSON schema. Each group is sent through the backend's
+    batch method and the results are fanned back to the waiting callers.
+    Failures and token usage are tracked per prompt and copied into each
+    caller's call outcome, so breakers and usage accounting see every request.
+    """
+    
+    def __init__(self, window_ms: float = 5.0, max_batch_size: int = 16):
+        """
+        Initialize request batcher
+        
+        Args:
+            window_ms: How long to collect requests before sending a batch
+            max_batch_size: Send a batch as soon as it reaches this size
+        """
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Tuple, List[Tuple[str, asyncio.Future]]] = {}  # futures resolve to (result, outcome)
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        # Running batch tasks, referenced so they are not garbage-collected mid-flight
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches_sent = 0
+        self.requests_batched = 0
+    
+    async def submit(self, 
+                     backend_name: str, 
+                     backend: ModelBackend, 
+                     prompt: str, 
+                     params: Dict[str, Any],
+                     system_prompt: Optional[str] = None,
+                     json_schema: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Queue a request for the next batch of its group
+        
+        Args:
+            backend_name: Backend name
+            backend: Backend that will serve the batch
+            prompt: Input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt
+            json_schema: JSON schema for JSON requests, None for text requests
+            
+        Returns:
+            Generated response for this prompt
+        """
+        group_key = (
+            backend_name,
+            json.dumps(params, sort_keys=True),
+            system_prompt,
+            json.dumps(json_schema, sort_keys=True) if json_schema is not None else None
+        )
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        group = self._pending.setdefault(group_key, [])
+        if not group:
+            self._timers[group_key] = loop.call_later(
+                self.window, self._flush, group_key, backend, params, system_prompt, json_schema
+            )
+        group.append((prompt, future))
+        
+        if len(group) >= self.max_batch_size:
+            self._flush(group_key, backend, params, system_prompt, json_schema)
+        
+        result, item_outcome = await future
+        outcome = _call_outcome.get()
+        if outcome is not None:
+            if item_outcome.failed:
+                outcome.failed = True
+                outcome.error = item_outcome.error
+            outcome.mocked = outcome.mocked or item_outcome.mocked
+            if item_outcome.usage is not None:
+                outcome.usage = item_outcome.usage
+                outcome.usage_estimated = item_outcome.usage_estimated
+        return result
+    
+    def _flush(self, 
+               group_key: Tuple, 
+               backend: ModelBackend, 
+               params: Dict[str, Any],
+               system_prompt: Optional[str],
+               json_schema: Optional[Dict[str, Any]]) -> None:
+        """Send the pending requests of a group as one batch"""
+        timer = self._timers.pop(group_key, None)
+        if timer:
+            timer.cancel()
+        
+        group = self._pending.pop(group_key, None)
+        if group:
+            task = asyncio.ensure_future(self._run_batch(group, backend, params, system_prompt, json_schema))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run_batch(self, 
+                         group: List[Tuple[str, asyncio.Future]], 
+                         backend: ModelBackend, 
+                         params: Dict[str, Any],
+                         system_prompt: Optional[str],
+                         json_schema: Optional[Dict[str, Any]]) -> None:
+        """Run a batch through the backend and resolve the callers' futures"""
+        prompts = [prompt for prompt, _ in group]
+        self.batches_sent += 1
+        self.requests_batched += len(prompts)
+        
+        # This task inherited the context of the request that triggered the flush,
+        # so track the batch under its own outcomes rather than that request's, and
+        # drop that request's deadline and caller: each member enforces its own deadline
+        batch_outcome = CallOutcome()
+        outcomes = [CallOutcome() for _ in prompts]
+        outcome_token = _call_outcome.set(batch_outcome)
+        batch_token = _batch_outcomes.set(outcomes)
+        _request_deadline.set(None)
+        _request_caller.set(None)
+        try:
+            if json_schema is None:
+                results = await backend.generate_batch(prompts, params, system_prompt)
+            else:
+                results = await backend.generate_with_json_batch(prompts, json_schema, params, system_prompt)
+        except Exception as e:
+            logger.error(f"Error running batch of {len(prompts)} requests: {str(e)}")
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            _batch_outcomes.reset(batch_token)
+            _call_outcome.reset(outcome_token)
+        
+        for (_, future), result, outcome in zip(group, results, outcomes):
+            # A failure reported for the batch as a whole applies to every prompt in it
+            if batch_outcome.failed and not outcome.failed:
+                outcome.failed = True
+                outcome.error = batch_outcome.error
+            # Callers may have been cancelled while the batch was running
+            if not future.done():
+                future.set_result((result, outcome))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get batching statistics
+        
+        Returns:
+            Number of batches sent and requests they carried
+        """
+        return {
+            "batches_sent": self.batches_sent,
+            "requests_batched": self.requests_batched,
+            "average_batch_size": self.requests_batched / self.batches_sent if self.batches_sent else 0.0
+        }
+
+# Request priorities for admission control (lower values are served first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+class TokenBucket:
+    """Token bucket refilled continuously at a per-minute rate"""
+    
+    def __init__(self, rate_per_minute: float):
+        """
+        Initialize token bucket
+        
+        Args:
+            rate_per_minute: Tokens added per minute, also the bucket capacity
+        """
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float) -> float:
+        """
+        Get how long until the bucket can cover an amount
+        
+        Args:
+            amount: Tokens needed (capped at the bucket capacity)
+            
+        Returns:
+            Seconds to wait, 0.0 if the amount is available now
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def consume(self, amount: float) -> None:
+        """Take tokens from the bucket (call after wait_time() returned 0.0)"""
+        self.tokens -= min(amount, self.capacity)
+
+class BackendLimiter:
+    """
+    Admission control for a single model backend
+    
+    Bounds the number of in-flight requests and enforces requests-per-minute
+    and tokens-per-minute budgets. Waiting requests are admitted in priority
+    order, so interactive player turns go ahead of background generation.
+    """
+    
+    def __init__(self, 
+                 max_concurrency: Optional[int] = None,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None):
+        """
+        Initialize backend limiter
+        
+        Args:
+            max_concurrency: Maximum number of in-flight requests (None for no limit)
+            requests_per_minute: Request rate budget (None for no limit)
+            tokens_per_minute: Estimated token rate budget (None for no limit)
+        """
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._sequence = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.total_wait = 0.0
+    
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0) -> AsyncIterator[None]:
+        """
+        Hold an admission slot for the duration of a backend call
+        
+        Args:
+            priority: Request priority (lower is served first)
+            tokens: Estimated tokens the request will consume
+        """
+        await self.acquire(priority, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, tokens: float = 0) -> None:
+        """
+        Wait until the request is admitted
+        
+        Args:
+            priority: Request priority (lower is served first)
+            tokens: Estimated tokens the request will consume
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, tokens, future))
+        
+        started = time.monotonic()
+        self._admit()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Give the slot back if it was granted just before cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.total_wait += time.monotonic() - started
+    
+    def release(self) -> None:
+        """Return an admission slot"""
+        self.in_flight -= 1
+        self._admit()
+    
+    def _admit(self) -> None:
+        """Admit waiting requests in priority order while limits allow"""
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+        
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                return
+            
+            wait = 0.0
+            if self.request_bucket:
+                wait = max(wait, self.request_bucket.wait_time(1))
+            if self.token_bucket:
+                wait = max(wait, self.token_bucket.wait_time(tokens))
+            if wait > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._admit)
+                return
+            
+            heapq.heappop(self._waiters)
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            self.admitted += 1
+            future.set_result(None)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get admission statistics
+        
+        Returns:
+            Current load and configured limits
+        """
+        return {
+            "in_flight": self.in_flight,
+            "queued": sum(1 for waiter in self._waiters if not waiter[3].done()),
+            "admitted": self.admitted,
+            "average_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_concurrency": self.max_concurrency,
+            "requests_per_minute": self.request_bucket.capacity if self.request_bucket else None,
+            "tokens_per_minute": self.token_bucket.capacity if self.token_bucket else None
+        }
+
+class CircuitBreaker:
+    """
+    Circuit breaker and health score for a single model backend
+    
+    Tracks the outcome and latency of recent calls in a rolling window. The
+    circuit opens when too many of them failed or were slow, rejects calls
+    while open, and after a cool-down lets a limited number of probe calls
+    through (half-open) to decide whether to close again.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self,
+                 window_size: int = 20,
+                 min_calls: int = 5,
+                 failure_rate_threshold: float = 0.5,
+                 slow_call_duration: float = 20.0,
+                 slow_call_rate_threshold: float = 0.8,
+                 open_duration: float = 30.0,
+                 half_open_max_calls: int = 1):
+        """
+        Initialize circuit breaker
+        
+        Args:
+            window_size: Number of recent calls considered
+            min_calls: Calls needed in the window before the circuit can open
+            failure_rate_threshold: Failure fraction that opens the circuit
+            slow_call_duration: Calls slower than this (seconds) count as slow
+            slow_call_rate_threshold: Slow-call fraction that opens the circuit
+            open_duration: Seconds to reject calls before probing again
+            half_open_max_calls: Concurrent probe calls allowed while half-open
+        """
+        self.window: Deque[Tuple[bool, float]] = deque(maxlen=window_size)
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._probes = 0
+        self.rejected = 0
+    
+    def allow_request(self) -> bool:
+        """
+        Check whether a call may go to the backend
+        
+        Returns:
+            True if the call is allowed (and must later be recorded or cancelled)
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_duration:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probes = 0
+            logger.info("Circuit half-open, probing backend")
+        
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_max_calls:
+                self.rejected += 1
+                return False
+            self._probes += 1
+        
+        return True
+    
+    def record(self, success: bool, latency: float) -> None:
+        """
+        Record the outcome of an allowed call
+        
+        Args:
+            success: Whether the backend actually answered
+            latency: Call duration in seconds
+        """
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if success and latency < self.slow_call_duration:
+                self.state = self.CLOSED
+                self.window.clear()
+                logger.info("Circuit closed after successful probe")
+            else:
+                self._open()
+            self.window.append((success, latency))
+            return
+        
+        self.window.append((success, latency))
+        if self.state == self.CLOSED and len(self.window) >= self.min_calls:
+            if (self.failure_rate() >= self.failure_rate_threshold
+                    or self.slow_call_rate() >= self.slow_call_rate_threshold):
+                self._open()
+    
+    def cancel(self) -> None:
+        """Release an allowed call that was cancelled before completing"""
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+    
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        logger.warning(f"Circuit opened (failure rate {self.failure_rate():.2f}, "
+                       f"slow rate {self.slow_call_rate():.2f})")
+    
+    def failure_rate(self) -> float:
+        """Fraction of calls in the window that failed"""
+        if not self.window:
+            return 0.0
+        return sum(1 for success, _ in self.window if not success) / len(self.window)
+    
+    def slow_call_rate(self) -> float:
+        """Fraction of calls in the window slower than slow_call_duration"""
+        if not self.window:
+            return 0.0
+        return sum(1 for _, latency in self.window if latency >= self.slow_call_duration) / len(self.window)
+    
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """
+        Get a latency percentile over successful calls in the window
+        
+        Args:
+            percentile: Percentile between 0 and 100
+            
+        Returns:
+            Latency in seconds, or None if there are no successful calls
+        """
+        latencies = sorted(latency for success, latency in self.window if success)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(percentile / 100.0 * (len(latencies) - 1))))
+        return latencies[index]
+    
+    def health_score(self) -> float:
+        """
+        Get a health score between 0.0 (unusable) and 1.0 (healthy)
+        
+        The score is the fraction of recent calls that succeeded without being
+        slow, and is 0.0 while the circuit is open.
+        """
+        if self.state == self.OPEN:
+            return 0.0
+        if not self.window:
+            return 1.0
+        good = sum(1 for success, latency in self.window if success and latency < self.slow_call_duration)
+        return good / len(self.window)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Get circuit breaker state and health statistics
+        
+        Returns:
+            State, rolling rates, latency percentiles and health score
+        """
+        return {
+            "state": self.state,
+            "health_score": self.health_score(),
+            "failure_rate": self.failure_rate(),
+            "slow_call_rate": self.slow_call_rate(),
+            "calls_in_window": len(self.window),
+            "latency_p50": self.latency_percentile(50),
+            "latency_p95": self.latency_percentile(95),
+            "rejected": self.rejected
+        }
+
+class ContextStore:
+    """
+    Bounded, self-expiring store for agent context data
+    
+    Entries live in an OrderedDict in least- to most-recently-used order and
+    expire after a per-entry TTL. Expiry times are kept in a min-heap that a
+    background task (and every write) drains, so cleanup only touches
+    expired entries instead of scanning the store. Once the entry or byte cap
+    is exceeded the least recently used contexts are evicted, or spilled to
+    a SQLite file if one is configured and loaded back on their next read.
+    Each store spills to its own file (the pid is added to spill_path),
+    and spill I/O runs in order on a dedicated worker thread so the event
+    loop never waits on SQLite; aget() reads spilled contexts the same way.
+    """
+    
+    def __init__(self,
+                 max_entries: int = 10000,
+                 max_bytes: Optional[int] = None,
+                 ttl: float = 86400,
+                 sweep_interval: float = 60.0,
+                 spill_path: Optional[str] = None,
+                 spill_max_entries: int = 100000):
+        """
+        Initialize context store
+        
+        Args:
+            max_entries: Maximum number of contexts held in memory
+            max_bytes: Maximum approximate size of contexts held in memory (None for no limit)
+            ttl: Default time to live in seconds
+            sweep_interval: Seconds between background sweeps of expired contexts
+            spill_path: SQLite file that evicted contexts spill to (None to drop them);
+                the process id (and store id) is added to the name so workers never
+                share a file
+            spill_max_entries: Maximum number of spilled contexts
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.expiry_times: Dict[str, float] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        self.total_bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        
+        self.spill: Optional[DiskResponseCache] = None
+        self.spill_path: Optional[str] = None
+        self._spilled: Dict[str, Tuple[float, float]] = {}  # Spilled context id -> (expiry time, stored at)
+        # Recently spilled contexts, served from memory while their write may still be queued
+        self._pending_spills: Dict[str, Tuple[Any, Future]] = {}
+        self._spill_executor: Optional[ThreadPoolExecutor] = None
+        if spill_path:
+            root, extension = os.path.splitext(spill_path)
+            self.spill_path = f"{root}.{os.getpid()}-{id(self):x}{extension}"
+            self.spill = DiskResponseCache(path=self.spill_path, ttl=int(ttl), max_entries=spill_max_entries)
+            # Spilled contexts are overflow for this process, not a persistent store
+            self.spill.clear()
+            # A single worker keeps spill writes, deletes and reads in submission order
+            self._spill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-spill")
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spills = 0
+        self.spill_hits = 0
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    @staticmethod
+    def _estimate_size(data: Any) -> int:
+        """Approximate in-memory size of a context as the length of its JSON encoding"""
+        try:
+            return len(json.dumps(data, default=str))
+        except (TypeError, ValueError):
+            return 0
+    
+    def _remove(self, context_id: str) -> Dict[str, Any]:
+        """Remove a context from memory (its heap entry becomes stale)"""
+        entry = self._entries.pop(context_id)
+        del self.expiry_times[context_id]
+        self.total_bytes -= entry["size"]
+        return entry
+    
+    def _spill_write(self, context_id: str, data: Any, ttl: float) -> None:
+        """Queue a context for writing to the spill file"""
+        if len(self._pending_spills) >= 64:
+            # Forget contexts whose write has landed (the file now serves them)
+            self._pending_spills = {
+                key: pending for key, pending in self._pending_spills.items() if not pending[1].done()
+            }
+        future = self._spill_executor.submit(self.spill.set, context_id, data, ttl)
+        self._pending_spills[context_id] = (data, future)
+    
+    def _spill_delete(self, context_id: str) -> None:
+        """Queue the removal of a context from the spill file"""
+        self._pending_spills.pop(context_id, None)
+        self._spill_executor.submit(self.spill.delete, context_id)
+    
+    def _ensure_sweeper(self) -> None:
+        """Start the background sweep once an event loop is available"""
+        if self._sweeper is not None and not self._sweeper.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # No loop yet; writes still purge expired contexts
+        self._sweeper = loop.create_task(self._sweep_loop())
+    
+    async def _sweep_loop(self) -> None:
+        """Periodically drop expired contexts"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            removed = self.purge_expired()
+            if removed:
+                logger.info(f"Expired {removed} contexts")
+    
+    def purge_expired(self) -> int:
+        """
+        Remove all expired contexts, including spilled ones
+        
+        Returns:
+            Number of contexts removed
+        """
+        now = time.time()
+        removed = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, context_id = heapq.heappop(heap)
+            # Skip heap entries left behind by overwritten or deleted contexts
+            if self.expiry_times.get(context_id) == expires_at:
+                self._remove(context_id)
+                removed += 1
+            elif self._spilled.get(context_id, (None,))[0] == expires_at:
+                del self._spilled[context_id]
+                self._spill_delete(context_id)
+                removed += 1
+        
+        if len(heap) > 2 * (len(self._entries) + len(self._spilled)) + 64:
+            live = list(self.expiry_times.items()) + [
+                (context_id, spilled[0]) for context_id, spilled in self._spilled.items()
+            ]
+            self._expiry_heap = [(expires_at, context_id) for context_id, expires_at in live]
+            heapq.heapify(self._expiry_heap)
+        
+        self.expirations += removed
+        return removed
+    
+    def _evict_over_capacity(self) -> None:
+        """Evict (or spill) least recently used contexts until within the caps"""
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._entries) > 1)
+        ):
+            context_id = next(iter(self._entries))
+            expires_at = self.expiry_times[context_id]
+            entry = self._remove(context_id)
+            self.evictions += 1
+            if self.spill is not None:
+                self._spill_write(context_id, entry["data"], max(expires_at - time.time(), 0))
+                self._spilled[context_id] = (expires_at, entry["stored_at"])
+                self.spills += 1
+    
+    def set(self, context_id: str, data: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a context
+        
+        Args:
+            context_id: Context identifier
+            data: Context data (JSON-serializable if spilling is enabled)
+            ttl: Time to live in seconds for this context (defaults to the store's TTL)
+        """
+        self._ensure_sweeper()
+        self.purge_expired()
+        
+        if context_id in self._entries:
+            self._remove(context_id)
+        elif context_id in self._spilled:
+            del self._spilled[context_id]
+            self._spill_delete(context_id)
+        
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        size = self._estimate_size(data)
+        self._entries[context_id] = {"data": data, "size": size, "stored_at": now}
+        self.expiry_times[context_id] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, context_id))
+        self.total_bytes += size
+        self._evict_over_capacity()
+    
+    def get(self, context_id: str) -> Optional[Any]:
+        """
+        Get a context, loading it back from the spill file if it was evicted
+        
+        Reading a spilled context blocks on the spill file; use aget() from
+        async code.
+        
+        Args:
+            context_id: Context identifier
+            
+        Returns:
+            Context data or None if not found or expired
+        """
+        found, data = self._get_in_memory(context_id)
+        if found:
+            return data
+        
+        spilled = self._spilled.pop(context_id, None)
+        if spilled is not None:
+            # Reads queue behind pending writes on the spill worker
+            return self._restore(context_id, self._spill_executor.submit(self.spill.get, context_id).result(), *spilled)
+        
+        self.misses += 1
+        return None
+    
+    async def aget(self, context_id: str) -> Optional[Any]:
+        """
+        Get a context without blocking the event loop on the spill file
+        
+        Args:
+            context_id: Context identifier
+            
+        Returns:
+            Context data or None if not found or expired
+        """
+        found, data = self._get_in_memory(context_id)
+        if found:
+            return data
+        
+        spilled = self._spilled.pop(context_id, None)
+        if spilled is not None:
+            data = await asyncio.wrap_future(self._spill_executor.submit(self.spill.get, context_id))
+            if context_id in self._entries:
+                # Stored again while the spill file was being read
+                return self._get_in_memory(context_id)[1]
+            return self._restore(context_id, data, *spilled)
+        
+        self.misses += 1
+        return None
+    
+    def _get_in_memory(self, context_id: str) -> Tuple[bool, Optional[Any]]:
+        """
+        Look up a context in memory, including spilled contexts still being written
+        
+        Returns:
+            Tuple of (whether it was found, context data)
+        """
+        entry = self._entries.get(context_id)
+        if entry is not None:
+            if self.expiry_times[context_id] > time.time():
+                self._entries.move_to_end(context_id)
+                self.hits += 1
+                return True, entry["data"]
+            self._remove(context_id)
+            self.expirations += 1
+        
+        pending = self._pending_spills.get(context_id)
+        spilled = self._spilled.get(context_id)
+        if pending is not None and spilled is not None:
+            del self._spilled[context_id]
+            return True, self._restore(context_id, pending[0], *spilled)
+        return False, None
+    
+    def _restore(self, context_id: str, data: Optional[Any], expires_at: float, stored_at: float) -> Optional[Any]:
+        """Move a context read back from the spill file into memory"""
+        if data is None or expires_at <= time.time():
+            self._spill_delete(context_id)
+            self.misses += 1
+            return None
+        self._spill_delete(context_id)
+        self.spill_hits += 1
+        self.hits += 1
+        self.set(context_id, data, ttl=expires_at - time.time())
+        if context_id in self._entries:
+            # Keep the original age for remove_older_than()
+            self._entries[context_id]["stored_at"] = stored_at
+        return data
+    
+    def delete(self, context_id: str) -> bool:
+        """
+        Remove a context
+        
+        Args:
+            context_id: Context identifier
+            
+        Returns:
+            True if the context was stored
+        """
+        if context_id in self._entries:
+            self._remove(context_id)
+            return True
+        if self._spilled.pop(context_id, None) is not None:
+            self._spill_delete(context_id)
+            return True
+        return False
+    
+    def remove_older_than(self, max_age: float) -> int:
+        """
+        Remove contexts stored more than max_age seconds ago, including spilled ones
+        
+        Unlike expiry this has to look at every context, so prefer TTLs.
+        
+        Args:
+            max_age: Maximum age in seconds
+            
+        Returns:
+            Number of contexts removed
+        """
+        cutoff = time.time() - max_age
+        old_contexts = [
+            context_id for context_id, entry in self._entries.items()
+            if entry["stored_at"] < cutoff
+        ]
+        for context_id in old_contexts:
+            self._remove(context_id)
+        old_spilled = [
+            context_id for context_id, (_, stored_at) in self._spilled.items()
+            if stored_at < cutoff
+        ]
+        for context_id in old_spilled:
+            del self._spilled[context_id]
+            self._spill_delete(context_id)
+        return len(old_contexts) + len(old_spilled)
+    
+    def clear(self) -> None:
+        """Remove all contexts"""
+        self._entries.clear()
+        self.expiry_times.clear()
+        self._expiry_heap.clear()
+        self.total_bytes = 0
+        if self._spilled:
+            self._spilled.clear()
+            self._pending_spills.clear()
+            self._spill_executor.submit(self.spill.clear)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get context store statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "spilled": len(self._spilled),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "spills": self.spills,
+            "spill_hits": self.spill_hits
+        }
+    
+    async def close(self) -> None:
+        """Stop the background sweep, then close and remove this process's spill file"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        if self.spill is not None:
+            await asyncio.wrap_future(self._spill_executor.submit(self.spill.close))
+            self._spill_executor.shutdown(wait=False)
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.spill_path + suffix)
+                except OSError:
+                    pass
+
+class UsageTracker:
+    """Token usage counters per backend and per caller"""
+    
+    def __init__(self):
+        """Initialize empty counters"""
+        self.by_backend: Dict[str, Dict[str, int]] = {}
+        self.by_caller: Dict[str, Dict[str, int]] = {}
+    
+    @staticmethod
+    def _new_counters() -> Dict[str, int]:
+        return {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "estimated_requests": 0
+        }
+    
+    def record(self, 
+               backend_name: str, 
+               caller: Optional[str], 
+               usage: Dict[str, int], 
+               estimated: bool = False) -> None:
+        """
+        Add one backend call's usage to the counters
+        
+        Args:
+            backend_name: Backend that served the call
+            caller: Caller the request is accounted to (None if unattributed)
+            usage: Token usage of the call
+            estimated: Whether the usage was estimated rather than reported by the provider
+        """
+        for counters in (self.by_backend.setdefault(backend_name, self._new_counters()),
+                         self.by_caller.setdefault(caller or "unattributed", self._new_counters())):
+            counters["requests"] += 1
+            counters["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            counters["completion_tokens"] += usage.get("completion_tokens", 0)
+            counters["cached_tokens"] += usage.get("cached_tokens", 0)
+            if estimated:
+                counters["estimated_requests"] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get usage counters"""
+        return {
+            "backends": {name: dict(counters) for name, counters in self.by_backend.items()},
+            "callers": {name: dict(counters) for name, counters in self.by_caller.items()}
+        }
+
+class ModelProtocolServer:
+    """
+    Model Protocol Server for agent communication
+    
+    This class provides a standardized interface for agent communication with
+    various language model backends. It handles context management, caching,
+    and error handling.
+    """
+    
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        """
+        Initialize Model Protocol Server
+        
+        Args:
+            config: Configuration dictionary
+        """
+        self.config = config or {}
+        
+        # Initialize backends
+        self.backends = {}
+        self.limiters: Dict[str, BackendLimiter] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.fallbacks: Dict[str, str] = {}
+        self.hedge_policies: Dict[str, Dict[str, Any]] = {}
+        self.hedge_stats: Dict[str, Dict[str, int]] = {}
+        self._initialize_backends()
+        
+        # Initialize cache
+        shared_cache_config = dict(self.config.get("shared_cache") or {})
+        if shared_cache_config:
+            # Multi-worker mode: a small per-process L1 in front of a store shared by all workers
+            self.cache = ResponseCache(
+                max_size=shared_cache_config.pop("l1_max_size", 256),
+                ttl=shared_cache_config.pop("l1_ttl", 60),
+                admission=self.config.get("cache_admission", True),
+                max_bytes=shared_cache_config.pop("l1_max_bytes", None),
+                compress_threshold=self.config.get("cache_compress_threshold")
+            )
+            self.cache_sync_interval = shared_cache_config.pop("sync_interval", 1.0)
+            shared_cache_config.setdefault("path", "data/shared_response_cache.sqlite3")
+        else:
+            self.cache = ResponseCache(
+                max_size=self.config.get("cache_max_size", 1000),
+                ttl=self.config.get("cache_ttl", 3600),
+                admission=self.config.get("cache_admission", True),
+                max_bytes=self.config.get("cache_max_bytes"),
+                compress_threshold=self.config.get("cache_compress_threshold")
+            )
+            self.cache_sync_interval = None
+        
+        # Optional persistent (or shared) tier below the in-memory cache
+        self.disk_cache = None
+        disk_cache_config = shared_cache_config or self.config.get("disk_cache")
+        if disk_cache_config:
+            self.disk_cache = DiskResponseCache(**disk_cache_config)
+        self._pending_disk_writes: Set[asyncio.Future] = set()
+        self._cache_generation: Optional[int] = None
+        self._cache_synced_at = 0.0
+        
+        # Near-duplicate prompt tier, used only by call sites that opt in
+        self.similarity_cache = SimilarityCache(**self.config.get("similarity_cache", {}))
+        
+        # Deadline (seconds) applied to calls that do not pass their own
+        self.default_deadline = self.config.get("default_deadline")
+        
+        # Optional micro-batching of concurrent requests
+        batching_config = self.config.get("batching", {})
+        self.batcher = None
+        if batching_config.get("enabled", False):
+            self.batcher = RequestBatcher(
+                window_ms=batching_config.get("window_ms", 5.0),
+                max_batch_size=batching_config.get("max_batch_size", 16)
+            )
+        
+        # In-flight backend calls keyed by cache key, shared by identical requests
+        self.coalesce_requests = self.config.get("coalesce_requests", True)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        
+        # Token usage per backend and per caller
+        self.usage = UsageTracker()
+        
+        # Bounded, self-expiring context store
+        self.context_store = ContextStore(**self.config.get("context_store", {}))
+        
+        # JSON responses are validated against their schema; invalid fields are re-asked for
+        self.schema_validation = self.config.get("schema_validation", True)
+        self.schema_reask_attempts = self.config.get("schema_reask_attempts", 1)
+        self.schema_stats = {"validated": 0, "invalid": 0, "reasks": 0, "repaired": 0, "failed": 0}
+    
+    def _initialize_backends(self) -> None:
+        """Initialize model backends based on configuration"""
+        # Default backend configuration
+        backend_configs = self.config.get("backends", {
+            "openai": {
+                "type": "openai",
+                "api_key": app_config.openai_api_key, # Use app_config
+                "model": "gpt-4"
+            },
+            "anthropic": {
+                "type": "anthropic",
+                "api_key": app_config.anthropic_api_key, # Use app_config
+                "model": "claude-3-opus-20240229"
+            },
+            "gemini": {
+                "type": "gemini",
+                "api_key": app_config.google_api_key, # Use app_config
+                "model": "gemini-1.5-flash-latest"
+            },
+            "local": {
+                "type": "local",
+                "model_path": self.config.get("local_model_path", ""),
+                "base_url": self.config.get("local_base_url")
+            }
+        })
+
+        # Initialize each backend
+        for name, config in backend_configs.items():
+            backend_type = config.get("type", "").lower()
+            
+            if backend_type == "openai":
+                self.backends[name] = OpenAIBackend(
+                    api_key=config.get("api_key"),
+                    model=config.get("model", "gpt-4"),
+                    session_pool=HTTPSessionPool(**config.get("connection_pool", {})),
+                    retry_policy=RetryPolicy(**config.get("retry", {})),
+                    base_url=config.get("base_url")
+                )
+            elif backend_type == "anthropic":
+                self.backends[name] = AnthropicBackend(
+                    api_key=config.get("api_key"),
+                    model=config.get("model", "claude-3-opus-20240229"),
+                    session_pool=HTTPSessionPool(**config.get("connection_pool", {})),
+                    retry_policy=RetryPolicy(**config.get("retry", {})),
+                    base_url=config.get("base_url"),
+                    prompt_caching=config.get("prompt_caching", True)
+                )
+            elif backend_type == "gemini":
+                self.backends[name] = GeminiBackend(
+                    api_key=config.get("api_key"),
+                    model=config.get("model", "gemini-1.5-flash-latest"),
+                    retry_policy=RetryPolicy(**config.get("retry", {})),
+                    request_timeout=config.get("request_timeout", 60.0),
+                    model_cache_size=config.get("model_cache_size", 32)
+                )
+            elif backend_type == "synthetic":
+                self.backends[name] = SyntheticBackend(
+                    model=config.get("model", "synthetic"),
+                    latency=config.get("latency"),
+                    time_to_first_token=config.get("time_to_first_token"),
+                    tokens_per_second=config.get("tokens_per_second", 50.0),
+                    response_tokens=config.get("response_tokens"),
+                    error_rate=config.get("error_rate", 0.0),
+                    timeout_rate=config.get("timeout_rate", 0.0),
+                    timeout_duration=config.get("timeout_duration", 300.0),
+                    error_mode=config.get("error_mode", "degrade"),
+                    seed=config.get("seed", 0),
+                    max_tracked_prompts=config.get("max_tracked_prompts", 100000)
+                )
+            elif backend_type == "local":
+                self.backends[name] = LocalModelBackend(
+                    model_path=config.get("model_path", ""),
+                    base_url=config.get("base_url"),
+                    model=config.get("model"),
+                    api_key=config.get("api_key"),
+                    session_pool=HTTPSessionPool(**config.get("connection_pool", {})),
+                    retry_policy=RetryPolicy(**config.get("retry", {})),
+                    parallel_slots=config.get("parallel_slots", 4),
+                    completions_url=config.get("completions_url")
+                )
+            else:
+                logger.warning(f"Unknown backend type: {backend_type}")
+                continue
+            
+            # Context window override for the configured model
+            if config.get("context_window"):
+                self.backends[name].context_window = config["context_window"]
+            
+            # Optional admission control for this backend
+            limits = config.get("limits")
+            if limits:
+                self.limiters[name] = BackendLimiter(
+                    max_concurrency=limits.get("max_concurrency"),
+                    requests_per_minute=limits.get("requests_per_minute"),
+                    tokens_per_minute=limits.get("tokens_per_minute")
+                )
+            
+            # Circuit breaker (enabled unless explicitly set to False)
+            breaker_config = config.get("circuit_breaker", {})
+            if breaker_config is not False:
+                self.breakers[name] = CircuitBreaker(**breaker_config)
+            if config.get("fallback"):
+                self.fallbacks[name] = config["fallback"]
+            
+            # Optional hedging to a secondary backend for latency-critical calls
+            hedge_config = config.get("hedge")
+            if hedge_config and hedge_config.get("backend"):
+                self.hedge_policies[name] = {
+                    "backend": hedge_config["backend"],
+                    "percentile": hedge_config.get("percentile", 95),
+                    "min_samples": hedge_config.get("min_samples", 10),
+                    "min_delay": hedge_config.get("min_delay", 0.05),
+                    "default_delay": hedge_config.get("default_delay", 2.0)
+                }
+                self.hedge_stats[name] = {"requests": 0, "hedges_sent": 0, "hedge_wins": 0}
+        
+        # Optional record/replay of all model traffic
+        self.cassette = None
+        cassette_config = self.config.get("cassette")
+        if cassette_config:
+            mode = cassette_config.get("mode", "replay")
+            self.cassette = Cassette(cassette_config.get("path", "data/model_cassette.jsonl.gz"))
+            entries = self.cassette.load() if mode == "replay" else None
+            for name, backend in list(self.backends.items()):
+                self.backends[name] = CassetteBackend(
+                    name,
+                    self.cassette,
+                    mode,
+                    backend=backend,
+                    entries=entries,
+                    time_scale=cassette_config.get("time_scale", 1.0),
+                    on_miss=cassette_config.get("on_miss", "error")
+                )
+            logger.info(f"Cassette {mode} mode using {self.cassette.path}")
+        
+        # Set default backend
+        self.default_backend = self.config.get("default_backend", "openai")
+        if self.default_backend not in self.backends:
+            logger.warning(f"Default backend {self.default_backend} not found. Using first available backend.")
+            self.default_backend = next(iter(self.backends.keys())) if self.backends else None
+    
+    def _get_backend(self, backend_name: Optional[str] = None) -> ModelBackend:
+        """
+        Get model backend by name
+        
+        Args:
+            backend_name: Backend name
+            
+        Returns:
+            Model backend
+            
+        Raises:
+            ValueError: If backend not found
+        """
+        backend_name = backend_name or self.default_backend
+        
+        if not backend_name or backend_name not in self.backends:
+            available_backends = ", ".join(self.backends.keys())
+            raise ValueError(f"Backend '{backend_name}' not found. Available backends: {available_backends}")
+        
+        return self.backends[backend_name]
+    
+    def _get_cache_key(self, 
+                       prompt: str, 
+                       params: Dict[str, Any], 
+                       backend_name: str,
+                       system_prompt: Optional[str] = None,
+                       json_schema: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Generate cache key for a request
+        
+        Covers every input that shapes the response, so text and JSON
+        requests, and requests with different system prompts or schemas,
+        never share an entry.
+        
+        Args:
+            prompt: Input prompt
+            params: Generation parameters (including any prompt prefix)
+            backend_name: Backend name
+            system_prompt: Optional system prompt
+            json_schema: JSON schema for JSON requests, None for text requests
+            
+        Returns:
+            Cache key
+        """
+        request = json.dumps([backend_name, prompt, system_prompt, params, json_schema], sort_keys=True)
+        return hashlib.blake2b(request.encode(), digest_size=16).hexdigest()
+    
+    def _get_similarity_scope(self, 
+                              params: Dict[str, Any], 
+                              backend_name: str,
+                              system_prompt: Optional[str] = None,
+                              json_schema: Optional[Dict[str, Any]] = None,
+                              template: Optional[str] = None) -> str:
+        """
+        Generate the similarity cache scope for a request
+        
+        Args:
+            params: Generation parameters
+            backend_name: Backend name
+            system_prompt: Optional system prompt
+            json_schema: JSON schema for JSON requests, None for text requests
+            template: Fixed part of the prompt around the matched text, if any
+            
+        Returns:
+            Key covering every request input except the matched text
+        """
+        scope = json.dumps([backend_name, params, system_prompt, json_schema, template], sort_keys=True)
+        return hashlib.blake2b(scope.encode(), digest_size=16).hexdigest()
+    
+    @staticmethod
+    def _similarity_parts(prompt: str, similarity_text: Optional[str]) -> Tuple[str, Optional[str]]:
+        """
+        Split a prompt into the text to match and the template that must match exactly
+        
+        Args:
+            prompt: Input prompt
+            similarity_text: Variable part of the prompt (e.g. the player's input), if given
+            
+        Returns:
+            Tuple of (text to match, prompt with that text removed or None)
+        """
+        if similarity_text is None:
+            return prompt, None
+        return similarity_text, prompt.replace(similarity_text, "", 1)
+    
+    async def _single_flight(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a backend call, sharing it with identical concurrent requests
+        
+        The first caller for a key starts the call as a task; callers that
+        arrive while it is running await the same task instead of issuing
+        their own backend request. A cancelled caller does not cancel the
+        shared call for the others. The shared call runs without the first
+        caller's deadline or caller accounting; each waiter enforces its own
+        deadline on the shielded task.
+        
+        Args:
+            key: Cache key identifying the request
+            call: Zero-argument coroutine function performing the backend call
+            
+        Returns:
+            Result of the shared backend call
+        """
+        if not self.coalesce_requests:
+            return await call()
+        
+        async def shared() -> Any:
+            # The task copied the starting caller's context; detach it from that caller
+            _request_deadline.set(None)
+            _request_caller.set(None)
+            return await call()
+        
+        def finished(done: asyncio.Future) -> None:
+            self._in_flight.pop(key, None)
+            # Retrieve the error so it is not logged as unhandled if every waiter left
+            if not done.cancelled():
+                done.exception()
+        
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(shared())
+            self._in_flight[key] = task
+            task.add_done_callback(finished)
+        else:
+            logger.info(f"Joining in-flight request for key: {key[:8]}...")
+        
+        return await asyncio.shield(task)
+    
+    def _admission(self, 
+                   backend_name: str, 
+                   prompt: str, 
+                   params: Dict[str, Any],
+                   system_prompt: Optional[str],
+                   priority: int):
+        """
+        Get the admission context for a backend call
+        
+        Args:
+            backend_name: Backend name
+            prompt: Input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt
+            priority: Request priority (lower is served first)
+            
+        Returns:
+            Async context manager holding an admission slot, or a no-op
+            context if the backend has no limits configured
+        """
+        prompt_tokens = self._estimate_prompt_tokens(backend_name, prompt, params, system_prompt)
+        max_tokens = params.get("max_tokens", 1000)
+        context_window = self._get_backend(backend_name).context_window
+        if prompt_tokens + max_tokens > context_window:
+            logger.warning(f"Request to {backend_name} needs ~{prompt_tokens} prompt + {max_tokens} "
+                           f"completion tokens, over its {context_window} token context window")
+        
+        limiter = self.limiters.get(backend_name)
+        if limiter is None:
+            return nullcontext()
+        return limiter.slot(priority, prompt_tokens + max_tokens)
+    
+    def _estimate_prompt_tokens(self, 
+                                backend_name: str, 
+                                prompt: str, 
+                                params: Dict[str, Any],
+                                system_prompt: Optional[str] = None) -> int:
+        """
+        Estimate the prompt tokens of a request with a backend's tokenizer estimate
+        
+        Args:
+            backend_name: Backend name
+            prompt: Input prompt
+            params: Generation parameters, possibly carrying a prompt prefix
+            system_prompt: Optional system prompt
+            
+        Returns:
+            Estimated prompt tokens
+        """
+        backend = self._get_backend(backend_name)
+        return (backend.estimate_tokens(prompt)
+                + backend.estimate_tokens(system_prompt or "")
+                + backend.estimate_tokens(params.get(PROMPT_PREFIX_PARAM) or ""))
+    
+    def _estimate_usage(self, 
+                        backend_name: str, 
+                        prompt: str, 
+                        params: Dict[str, Any],
+                        system_prompt: Optional[str],
+                        response: Any,
+                        outcome: Optional[CallOutcome] = None) -> None:
+        """
+        Estimate usage for a call if the backend did not report any
+        
+        Args:
+            backend_name: Backend that served the call
+            prompt: Input prompt
+            params: Generation parameters
+            system_prompt: Optional system prompt
+            response: Text or JSON response
+            outcome: Call outcome (defaults to the current call's)
+        """
+        outcome = outcome or _call_outcome.get()
+        if outcome is None or outcome.usage is not None:
+            return
+        text = response if isinstance(response, str) else json.dumps(response)
+        outcome.usage = {
+            "prompt_tokens": self._estimate_prompt_tokens(backend_name, prompt, params, system_prompt),
+            "completion_tokens": self._get_backend(backend_name).estimate_tokens(text),
+            "cached_tokens": 0
+        }
+        outcome.usage_estimated = True
+    
+    def _route(self, backend_name: str) -> str:
+        """
+        Pick the backend that should serve a request
+        
+        Follows the configured fallback chain while circuits are open. A
+        backend returned from here has been admitted by its breaker (if any),
+        so the call must be finished with _record_call().
+        
+        Args:
+            backend_name: Requested backend name
+            
+        Returns:
+            Name of the backend to call
+            
+        Raises:
+            BackendUnavailableError: If every backend in the chain is open
+        """
+        visited = set()
+        name = backend_name
+        while name not in visited:
+            visited.add(name)
+            breaker = self.breakers.get(name)
+            if breaker is None or breaker.allow_request():
+                if name != backend_name:
+                    logger.warning(f"Circuit open for backend {backend_name}, routing to {name}")
+                return name
+            
+            name = self.fallbacks.get(name)
+            if name is None:
+                break
+            self._get_backend(name)  # Fail fast on misconfigured fallbacks
+        
+        raise BackendUnavailableError(f"Circuit open for backend '{backend_name}' and no fallback is available")
+    
+    def _record_call(self, 
+                     backend_name: str, 
+                     outcome: Optional[CallOutcome], 
+                     started: float,
+                     caller: Optional[str] = None) -> None:
+        """
+        Report a finished backend call to its circuit breaker and usage counters
+        
+        Args:
+            backend_name: Backend that served the call
+            outcome: Call outcome, or None if the call was cancelled
+            started: time.monotonic() when the call started
+            caller: Caller the call is accounted to
+        """
+        if outcome is not None and outcome.usage is not None:
+            self.usage.record(backend_name, caller, outcome.usage, outcome.usage_estimated)
+        
+        breaker = self.breakers.get(backend_name)
+        if breaker is None:
+            return
+        if outcome is None:
+            breaker.cancel()
+        else:
+            breaker.record(not outcome.failed, time.monotonic() - started)
+    
+    async def _call_backend(self, 
+                            backend_name: str, 
+                            send: Callable[[str], Awaitable[Any]],
+                            outcome: Optional[CallOutcome] = None) -> Any:
+        """
+        Call a backend through its circuit breaker
+        
+        Args:
+            backend_name: Requested backend name
+            send: Coroutine function performing the call against a backend name
+            outcome: Outcome record to fill in (a new one is used if not provided)
+            
+        Returns:
+            Tuple of (result of the call, call outcome)
+        """
+        name = self._route(backend_name)
+        outcome = outcome or CallOutcome()
+        token = _call_outcome.set(outcome)
+        started = time.monotonic()
+        finished = False
+        try:
+            result = await _await_within_deadline(send(name))
+            finished = True
+            return result, outcome
+        except Exception as e:
+            outcome.failed = True
+            outcome.error = str(e)
+            finished = True
+            raise
+        finally:
+            _call_outcome.reset(token)
+            self._record_call(name, outcome if finished else None, started, _request_caller.get())
+    
+    def _hedge_delay(self, backend_name: str, policy: Dict[str, Any]) -> float:
+        """
+        Get how long to wait for the primary backend before hedging
+        
+        Uses the primary's observed latency percentile once enough successful
+        calls have been seen, and the policy's default delay before that.
+        """
+        breaker = self.breakers.get(backend_name)
+        if breaker is not None:
+            successes = sum(1 for success, _ in breaker.window if success)
+            if successes >= policy["min_samples"]:
+                observed = breaker.latency_percentile(policy["percentile"])
+                if observed is not None:
+                    return max(policy["min_delay"], observed)
+        return policy["default_delay"]
+    
+    async def _call_hedged(self, 
+                           backend_name: str, 
+                           send: Callable[[str], Awaitable[Any]]) -> Any:
+        """
+        Call a backend, hedging to a secondary backend if it is slow
+        
+        If the primary has not answered within its observed latency
+        percentile, the same request is sent to the policy's secondary
+        backend. The first answer that did not fall back to mock output wins
+        and the other call is cancelled.
+        
+        Args:
+            backend_name: Primary backend name
+            send: Coroutine function performing the call against a backend name
+            
+        Returns:
+            Tuple of (result of the winning call, its outcome)
+        """
+        policy = self.hedge_policies.get(backend_name)
+        if policy is None:
+            return await self._call_backend(backend_name, send)
+        
+        stats = self.hedge_stats[backend_name]
+        stats["requests"] += 1
+        
+        outcomes: Dict[asyncio.Task, CallOutcome] = {}
+        
+        def start(name: str) -> asyncio.Task:
+            outcome = CallOutcome()
+            task = asyncio.ensure_future(self._call_backend(name, send, outcome))
+            outcomes[task] = outcome
+            return task
+        
+        def answered(task: asyncio.Task) -> bool:
+            return task.exception() is None and not outcomes[task].failed
+        
+        primary = start(backend_name)
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self._hedge_delay(backend_name, policy))
+            if done and answered(primary):
+                return primary.result()
+            
+            # The primary is slow (or already failed): race the secondary against it
+            logger.info(f"Hedging request from {backend_name} to {policy['backend']}")
+            stats["hedges_sent"] += 1
+            pending.add(start(policy["backend"]))
+            
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if answered(task):
+                        if task is not primary:
+                            stats["hedge_wins"] += 1
+                        return task.result()
+            
+            # Every attempt failed: prefer a degraded answer from the primary
+            for task in sorted(outcomes, key=lambda t: t is not primary):
+                if task.exception() is None:
+                    return task.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _dispatch_generate(self, 
+                                 backend_name: str, 
+                                 prompt: str, 
+                                 params: Dict[str, Any],
+                                 system_prompt: Optional[str] = None,
+                                 priority: int = PRIORITY_INTERACTIVE,
+                                 hedge: bool = False) -> Tuple[str, CallOutcome]:
+        """Send a text request through the circuit breaker, admission control and batcher, returning the response and call outcome"""
+        async def send(name: str) -> str:
+            backend = self._get_backend(name)
+            async with self._admission(name, prompt, params, system_prompt, priority):
+                if self.batcher:
+                    response = await self.batcher.submit(name, backend, prompt, params, system_prompt)
+                else:
+                    response = await backend.generate(prompt, params, system_prompt)
+            self._estimate_usage(name, prompt, params, system_prompt, response)
+            return response
+        
+        if hedge:
+            return await self._call_hedged(backend_name, send)
+        return await self._call_backend(backend_name, send)
     
-    def clear(self) -> None:
-        """Clear the cache"""
-        self.cache.clear()
-        self.access_times.clear()
-
-class ModelProtocolServer:
-    """
-    Model Protocol Server for agent communication
-    
-    This class provides a standardized interface for agent communication with
-    various language model backends. It handles context management, caching,
-    and error handling.
-    """
+    async def _dispatch_generate_with_json(self, 
+                                           backend_name: str, 
+                                           prompt: str, 
+                                           json_schema: Dict[str, Any],
+                                           params: Dict[str, Any],
+                                           system_prompt: Optional[str] = None,
+                                           priority: int = PRIORITY_INTERACTIVE,
+                                           hedge: bool = False) -> Tuple[Dict[str, Any], CallOutcome]:
+        """Send a JSON request through the circuit breaker, admission control and batcher, returning the response and call outcome"""
+        async def send(name: str) -> Dict[str, Any]:
+            backend = self._get_backend(name)
+            async with self._admission(name, prompt, params, system_prompt, priority):
+                if self.batcher:
+                    response = await self.batcher.submit(name, backend, prompt, params, system_prompt, json_schema)
+                else:
+                    response = await backend.generate_with_json(prompt, json_schema, params, system_prompt)
+            self._estimate_usage(name, prompt, params, system_prompt, response)
+            return response
+        
+        if hedge:
+            return await self._call_hedged(backend_name, send)
+        return await self._call_backend(backend_name, send)
     
-    def __init__(self, config: Optional[Dict[str, Any]] = None):
+    async def _enforce_schema(self, 
+                              backend_name: str, 
+                              prompt: str, 
+                              json_schema: Dict[str, Any],
+                              params: Dict[str, Any],
+                              system_prompt: Optional[str],
+                              priority: int,
+                              response: Any,
+                              outcome: CallOutcome) -> Any:
         """
-        Initialize Model Protocol Server
+        Validate a JSON response, re-asking for only the fields that failed
+        
+        A re-ask sends the original prompt with the validation errors and a
+        schema restricted to the failing fields, then merges the answer into
+        the response. Fields still invalid afterwards are dropped unless the
+        schema requires them, so malformed values do not reach callers. Mock
+        output is passed through unchanged, since re-asking a backend that
+        could not answer only doubles the calls.
         
         Args:
-            config: Configuration dictionary
+            backend_name: Backend the response came from
+            prompt: Input prompt
+            json_schema: JSON schema for the response
+            params: Generation parameters
+            system_prompt: Optional system prompt
+            priority: Admission priority
+            response: Parsed response
+            outcome: Outcome of the call that produced the response
+            
+        Returns:
+            Validated response, or the best available one
         """
-        self.config = config or {}
+        if not self.schema_validation or not json_schema or outcome.failed or outcome.mocked:
+            return response
+        compiled = _compile_schema(json_schema)
+        errors = compiled.validate(response)
+        self.schema_stats["validated"] += 1
+        if not errors:
+            return response
+        self.schema_stats["invalid"] += 1
         
-        # Initialize backends
-        self.backends = {}
-        self._initialize_backends()
-        
-        # Initialize cache
-        self.cache = ResponseCache(
-            max_size=self.config.get("cache_max_size", 1000),
-            ttl=self.config.get("cache_ttl", 3600)
-        )
+        for _ in range(self.schema_reask_attempts):
+            fields = compiled.error_fields(errors)
+            problems = "\n".join(f"- {path or 'response'}: {message}" for path, message in errors[:20])
+            if fields:
+                reask_prompt = (f"{prompt}\n\nYour previous JSON response had these problems:\n{problems}\n\n"
+                                f"Respond with only the corrected fields: {', '.join(fields)}")
+                reask_schema = compiled.subschema(fields)
+            else:
+                reask_prompt = f"{prompt}\n\nYour previous JSON response had these problems:\n{problems}"
+                reask_schema = json_schema
+            self.schema_stats["reasks"] += 1
+            try:
+                patch, patch_outcome = await self._dispatch_generate_with_json(
+                    backend_name, reask_prompt, reask_schema, params, system_prompt, priority
+                )
+            except ModelProtocolError as e:
+                logger.warning(f"Schema re-ask to {backend_name} failed: {str(e)}")
+                break
+            if patch_outcome.failed or patch_outcome.mocked:
+                # Never merge mock values into a real response
+                break
+            
+            if not fields:
+                response = patch
+            elif isinstance(patch, dict):
+                response = {**response, **{field: patch[field] for field in fields if field in patch}}
+            errors = compiled.validate(response)
+            if not errors:
+                self.schema_stats["repaired"] += 1
+                return response
         
-        # Initialize context store
-        self.context_store = {}
+        if isinstance(response, dict):
+            dropped = set(compiled.error_fields(errors)) - set(compiled.required)
+            if dropped:
+                logger.info(f"Dropping invalid optional fields from {backend_name} response: {sorted(dropped)}")
+                response = {key: value for key, value in response.items() if key not in dropped}
+                errors = compiled.validate(response)
+        if errors:
+            self.schema_stats["failed"] += 1
+            logger.warning(f"JSON response from {backend_name} fails its schema: {errors[:5]}")
+        else:
+            self.schema_stats["repaired"] += 1
+        return response
     
-    def _initialize_backends(self) -> None:
-        """Initialize model backends based on configuration"""
-        # Default backend configuration
-        backend_configs = self.config.get("backends", {
-            "openai": {
-                "type": "openai",
-                "api_key": app_config.openai_api_key, # Use app_config
-                "model": "gpt-4"
-            },
-            "anthropic": {
-                "type": "anthropic",
-                "api_key": app_config.anthropic_api_key, # Use app_config
-                "model": "claude-3-opus-20240229"
-            },
-            "gemini": {
-                "type": "gemini",
-                "api_key": app_config.google_api_key, # Use app_config
-                "model": "gemini-1.5-flash-latest"
-            },
-            "local": {
-                "type": "local",
-                "model_path": self.config.get("local_model_path", "")
-            }
-        })
-
-        # Initialize each backend
-        for name, config in backend_configs.items():
-            backend_type = config.get("type", "").lower()
-            
-            if backend_type == "openai":
-                self.backends[name] = OpenAIBackend(
-                    api_key=config.get("api_key"),
-                    model=config.get("model", "gpt-4")
-                )
-            elif backend_type == "anthropic":
-                self.backends[name] = AnthropicBackend(
-                    api_key=config.get("api_key"),
-                    model=config.get("model", "claude-3-opus-20240229")
-                )
-            elif backend_type == "gemini":
-                self.backends[name] = GeminiBackend(
-                    api_key=config.get("api_key"),
-                    model=config.get("model", "gemini-1.5-flash-latest")
-                )
-            elif backend_type == "local":
-                self.backends[name] = LocalModelBackend(
-                    model_path=config.get("model_path", "")
-                )
-            else:
-                logger.warning(f"Unknown backend type: {backend_type}")
+    async def _sync_shared_cache(self) -> None:
+        """Drop the local L1 if another worker has cleared the shared cache"""
+        now = time.monotonic()
+        if now - self._cache_synced_at < self.cache_sync_interval:
+            return
+        self._cache_synced_at = now
         
-        # Set default backend
-        self.default_backend = self.config.get("default_backend", "openai")
-        if self.default_backend not in self.backends:
-            logger.warning(f"Default backend {self.default_backend} not found. Using first available backend.")
-            self.default_backend = next(iter(self.backends.keys())) if self.backends else None
+        generation = await self.disk_cache.ageneration()
+        if self._cache_generation is not None and generation != self._cache_generation:
+            logger.info("Shared cache was cleared by another worker, dropping local cache")
+            self.cache.clear()
+        self._cache_generation = generation
     
-    def _get_backend(self, backend_name: Optional[str] = None) -> ModelBackend:
+    async def _cache_get(self, cache_key: str) -> Optional[Any]:
         """
-        Get model backend by name
+        Look up a response in memory, then on disk
+        
+        Disk hits are promoted to the in-memory cache with their tags, so
+        tag invalidation also reaches the promoted copy.
         
         Args:
-            backend_name: Backend name
+            cache_key: Cache key
             
         Returns:
-            Model backend
-            
-        Raises:
-            ValueError: If backend not found
+            Cached response or None
         """
-        backend_name = backend_name or self.default_backend
+        if self.cache_sync_interval is not None:
+            await self._sync_shared_cache()
         
-        if not backend_name or backend_name not in self.backends:
-            available_backends = ", ".join(self.backends.keys())
-            raise ValueError(f"Backend '{backend_name}' not found. Available backends: {available_backends}")
+        cached_response = self.cache.get(cache_key)
+        if cached_response or self.disk_cache is None:
+            return cached_response
         
-        return self.backends[backend_name]
+        entry = await self.disk_cache.aget_with_tags(cache_key)
+        if entry is None:
+            return None
+        cached_response, tags = entry
+        if cached_response:
+            self.cache.set(cache_key, cached_response, tags)
+        return cached_response
     
-    def _get_cache_key(self, prompt: str, params: Dict[str, Any], backend_name: str) -> str:
+    def _cache_set(self, cache_key: str, response: Any, tags: Optional[List[str]] = None) -> None:
         """
-        Generate cache key for a request
+        Store a response in memory and, in the background, on disk
         
         Args:
-            prompt: Input prompt
-            params: Generation parameters
-            backend_name: Backend name
-            
-        Returns:
-            Cache key
+            cache_key: Cache key
+            response: Response to cache
+            tags: Tags to invalidate the response by
         """
-        # Create a string representation of the request
-        request_str = f"{backend_name}:{prompt}:{json.dumps(params, sort_keys=True)}"
-        
-        # Generate hash
-        return hashlib.md5(request_str.encode()).hexdigest()
+        self.cache.set(cache_key, response, tags)
+        if self.disk_cache is not None:
+            write = asyncio.ensure_future(self.disk_cache.aset(cache_key, response, tags))
+            self._pending_disk_writes.add(write)
+            write.add_done_callback(self._pending_disk_writes.discard)
     
     async def generate(self, 
                      prompt: str, 
                      params: Optional[Dict[str, Any]] = None, 
                      backend_name: Optional[str] = None,
                      system_prompt: Optional[str] = None,
-                     use_cache: bool = True) -> str:
+                     use_cache: bool = True,
+                     priority: int = PRIORITY_INTERACTIVE,
+                     hedge: bool = False,
+                     deadline: Optional[float] = None,
+                     use_similarity_cache: bool = False,
+                     prompt_prefix: Optional[str] = None,
+                     caller: Optional[str] = None,
+                     cache_tags: Optional[List[str]] = None,
+                     similarity_text: Optional[str] = None) -> str:
         """
         Generate a response from a model
         
@@ -926,42 +5487,190 @@ class ModelProtocolServer:
             backend_name: Backend to use
             system_prompt: Optional system prompt
             use_cache: Whether to use cache
+            priority: Admission priority (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND)
+            hedge: Hedge to the backend's secondary if it is slow (latency-critical calls)
+            deadline: Seconds the call may take before it is cancelled
+            use_similarity_cache: Also match near-identical earlier prompts
+            prompt_prefix: Stable leading context shared across turns (e.g. world
+                state), sent ahead of the prompt and marked cacheable by
+                backends that support provider-side prompt caching
+            caller: Name the request's token usage is accounted to (e.g. the agent)
+            cache_tags: Tags (e.g. location or campaign ids) that invalidate_cache_tags()
+                can later drop the cached response by
+            similarity_text: Part of the prompt that varies between requests (e.g.
+                the player's input). The similarity cache matches only this text
+                and requires the rest of the prompt to be identical; without it
+                the whole prompt is matched, so a long shared template can make
+                different inputs look alike
             
         Returns:
             Generated text response
+            
+        Raises:
+            ModelTimeoutError: If the deadline expires before a response arrives
         """
         params = params or {}
+        if prompt_prefix:
+            params = {**params, PROMPT_PREFIX_PARAM: prompt_prefix}
         backend_name = backend_name or self.default_backend
-        backend = self._get_backend(backend_name)
+        self._get_backend(backend_name)  # Fail fast on unknown backends
         
         # Check cache if enabled
         if use_cache:
-            cache_key = self._get_cache_key(prompt, params, backend_name)
-            cached_response = self.cache.get(cache_key)
+            cache_key = self._get_cache_key(prompt, params, backend_name, system_prompt)
+            cached_response = await self._cache_get(cache_key)
             if cached_response:
                 logger.info(f"Cache hit for key: {cache_key[:8]}...")
                 return cached_response
+            
+            if use_similarity_cache:
+                similarity_query, template = self._similarity_parts(prompt, similarity_text)
+                similarity_scope = self._get_similarity_scope(params, backend_name, system_prompt, None, template)
+                similar_response = self.similarity_cache.get(similarity_query, similarity_scope)
+                if similar_response:
+                    return similar_response
         
         # Generate response
-        response = await backend.generate(prompt, params, system_prompt)
+        if deadline is None:
+            deadline = self.default_deadline
+        with _deadline_scope(deadline), _caller_scope(caller):
+            if use_cache:
+                response, outcome = await _await_within_deadline(self._single_flight(
+                    cache_key, lambda: self._dispatch_generate(backend_name, prompt, params, system_prompt, priority, hedge)
+                ))
+            else:
+                response, outcome = await _await_within_deadline(
+                    self._dispatch_generate(backend_name, prompt, params, system_prompt, priority, hedge)
+                )
         
-        # Cache response if enabled
-        if use_cache:
-            cache_key = self._get_cache_key(prompt, params, backend_name)
-            self.cache.set(cache_key, response)
+        # Cache response if enabled, unless it is a mock fallback from a failed call
+        if use_cache and not outcome.failed:
+            self._cache_set(cache_key, response, cache_tags)
+            if use_similarity_cache:
+                self.similarity_cache.set(similarity_query, similarity_scope, response, cache_tags)
         
         return response
     
+    async def generate_stream(self, 
+                            prompt: str, 
+                            params: Optional[Dict[str, Any]] = None, 
+                            backend_name: Optional[str] = None,
+                            system_prompt: Optional[str] = None,
+                            use_cache: bool = True,
+                            priority: int = PRIORITY_INTERACTIVE,
+                            deadline: Optional[float] = None,
+                            prompt_prefix: Optional[str] = None,
+                            caller: Optional[str] = None,
+                            cache_tags: Optional[List[str]] = None) -> AsyncIterator[str]:
+        """
+        Generate a response from a model as a stream of text chunks
+        
+        A cached response is yielded as a single chunk. Otherwise chunks are
+        passed through as they arrive, and the assembled response is cached
+        once the stream completes, sharing the cache entry with generate().
+        
+        Args:
+            prompt: Input prompt
+            params: Generation parameters
+            backend_name: Backend to use
+            system_prompt: Optional system prompt
+            use_cache: Whether to use cache
+            priority: Admission priority (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND)
+            deadline: Seconds the whole stream may take before it is cancelled
+            prompt_prefix: Stable leading context shared across turns, sent
+                ahead of the prompt and marked cacheable where supported
+            caller: Name the request's token usage is accounted to (e.g. the agent)
+            cache_tags: Tags (e.g. location or campaign ids) that invalidate_cache_tags()
+                can later drop the cached response by
+            
+        Yields:
+            Text chunks in generation order
+        """
+        params = params or {}
+        if prompt_prefix:
+            params = {**params, PROMPT_PREFIX_PARAM: prompt_prefix}
+        backend_name = backend_name or self.default_backend
+        self._get_backend(backend_name)  # Fail fast on unknown backends
+        
+        # Check cache if enabled
+        if use_cache:
+            cache_key = self._get_cache_key(prompt, params, backend_name, system_prompt)
+            cached_response = await self._cache_get(cache_key)
+            if cached_response:
+                logger.info(f"Cache hit for key: {cache_key[:8]}...")
+                yield cached_response
+                return
+        
+        # Stream response, keeping the chunks for the cache
+        if deadline is None:
+            deadline = self.default_deadline
+        stream_deadline = _request_deadline.get()
+        if deadline is not None:
+            own_deadline = time.monotonic() + deadline
+            stream_deadline = own_deadline if stream_deadline is None else min(stream_deadline, own_deadline)
+        serving_name = self._route(backend_name)
+        backend = self._get_backend(serving_name)
+        outcome = CallOutcome()
+        started = time.monotonic()
+        finished = False
+        chunks = []
+        try:
+            async with self._admission(serving_name, prompt, params, system_prompt, priority):
+                stream = backend.generate_stream(prompt, params, system_prompt)
+                try:
+                    while True:
+                        # Track the outcome only while the backend is producing a chunk,
+                        # since the consumer may run in a different context between chunks
+                        token = _call_outcome.set(outcome)
+                        deadline_token = _request_deadline.set(stream_deadline)
+                        try:
+                            chunk = await _await_within_deadline(stream.__anext__())
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            _request_deadline.reset(deadline_token)
+                            _call_outcome.reset(token)
+                        chunks.append(chunk)
+                        yield chunk
+                finally:
+                    await stream.aclose()
+            finished = True
+            self._estimate_usage(serving_name, prompt, params, system_prompt, "".join(chunks), outcome)
+        except Exception:
+            outcome.failed = True
+            finished = True
+            raise
+        finally:
+            self._record_call(serving_name, outcome if finished else None, started, caller)
+        
+        # Cache the assembled response once the stream has completed, unless it is a mock fallback
+        if use_cache and chunks and not outcome.failed:
+            self._cache_set(cache_key, "".join(chunks), cache_tags)
+    
     async def generate_with_json(self, 
                                prompt: str, 
                                json_schema: Dict[str, Any],
                                params: Optional[Dict[str, Any]] = None, 
                                backend_name: Optional[str] = None,
                                system_prompt: Optional[str] = None,
-                               use_cache: bool = True) -> Dict[str, Any]:
+                               use_cache: bool = True,
+                               priority: int = PRIORITY_INTERACTIVE,
+                               hedge: bool = False,
+                               deadline: Optional[float] = None,
+                               use_similarity_cache: bool = False,
+                               prompt_prefix: Optional[str] = None,
+                               caller: Optional[str] = None,
+                               cache_tags: Optional[List[str]] = None,
+                               similarity_text: Optional[str] = None) -> Dict[str, Any]:
         """
         Generate a JSON response from a model
         
+        The response is validated against the schema (compiled once per
+        schema). If fields are missing or invalid, the model is re-asked for
+        just those fields rather than the whole object. The best result after
+        re-asking is cached like any other, so a model that keeps leaving out
+        a field is not re-asked on every request. Mock output is not re-asked.
+        
         Args:
             prompt: Input prompt
             json_schema: JSON schema for the expected response
@@ -969,80 +5678,353 @@ class ModelProtocolServer:
             backend_name: Backend to use
             system_prompt: Optional system prompt
             use_cache: Whether to use cache
+            priority: Admission priority (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND)
+            hedge: Hedge to the backend's secondary if it is slow (latency-critical calls)
+            deadline: Seconds the call may take before it is cancelled
+            use_similarity_cache: Also match near-identical earlier prompts
+            prompt_prefix: Stable leading context shared across turns (e.g. world
+                state), sent ahead of the prompt and marked cacheable by
+                backends that support provider-side prompt caching
+            caller: Name the request's token usage is accounted to (e.g. the agent)
+            cache_tags: Tags (e.g. location or campaign ids) that invalidate_cache_tags()
+                can later drop the cached response by
+            similarity_text: Part of the prompt that varies between requests (e.g.
+                the player's input). The similarity cache matches only this text
+                and requires the rest of the prompt to be identical; without it
+                the whole prompt is matched, so a long shared template can make
+                different inputs look alike
             
         Returns:
             Generated JSON response
+            
+        Raises:
+            ModelTimeoutError: If the deadline expires before a response arrives
         """
         params = params or {}
+        if prompt_prefix:
+            params = {**params, PROMPT_PREFIX_PARAM: prompt_prefix}
         backend_name = backend_name or self.default_backend
-        backend = self._get_backend(backend_name)
+        self._get_backend(backend_name)  # Fail fast on unknown backends
         
         # Check cache if enabled
         if use_cache:
-            cache_key = self._get_cache_key(prompt, params, backend_name) + ":json"
-            cached_response = self.cache.get(cache_key)
+            cache_key = self._get_cache_key(prompt, params, backend_name, system_prompt, json_schema)
+            cached_response = await self._cache_get(cache_key)
             if cached_response:
                 logger.info(f"Cache hit for key: {cache_key[:8]}...")
                 return cached_response
+            
+            if use_similarity_cache:
+                similarity_query, template = self._similarity_parts(prompt, similarity_text)
+                similarity_scope = self._get_similarity_scope(params, backend_name, system_prompt, json_schema, template)
+                similar_response = self.similarity_cache.get(similarity_query, similarity_scope)
+                if similar_response:
+                    return similar_response
+        
+        async def generate_validated() -> Tuple[Dict[str, Any], CallOutcome]:
+            response, outcome = await self._dispatch_generate_with_json(backend_name, prompt, json_schema, params, system_prompt, priority, hedge)
+            response = await self._enforce_schema(backend_name, prompt, json_schema, params, system_prompt, priority, response, outcome)
+            return response, outcome
         
         # Generate response
-        response = await backend.generate_with_json(prompt, json_schema, params, system_prompt)
+        if deadline is None:
+            deadline = self.default_deadline
+        with _deadline_scope(deadline), _caller_scope(caller):
+            if use_cache:
+                response, outcome = await _await_within_deadline(self._single_flight(cache_key, generate_validated))
+            else:
+                response, outcome = await _await_within_deadline(generate_validated())
         
-        # Cache response if enabled
-        if use_cache:
-            cache_key = self._get_cache_key(prompt, params, backend_name) + ":json"
-            self.cache.set(cache_key, response)
+        # Cache response if enabled, unless it is a mock fallback from a failed call
+        if use_cache and not outcome.failed:
+            self._cache_set(cache_key, response, cache_tags)
+            if use_similarity_cache:
+                self.similarity_cache.set(similarity_query, similarity_scope, response, cache_tags)
         
         return response
     
-    def store_context(self, context_id: str, context_data: Dict[str, Any]) -> None:
+    async def generate_with_json_stream(self, 
+                                        prompt: str, 
+                                        json_schema: Dict[str, Any],
+                                        params: Optional[Dict[str, Any]] = None, 
+                                        backend_name: Optional[str] = None,
+                                        system_prompt: Optional[str] = None,
+                                        use_cache: bool = True,
+                                        priority: int = PRIORITY_INTERACTIVE,
+                                        deadline: Optional[float] = None,
+                                        prompt_prefix: Optional[str] = None,
+                                        caller: Optional[str] = None,
+                                        cache_tags: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Generate a JSON response from a model as a stream of completed top-level fields
+        
+        Each top-level field is yielded as soon as its value closes, so callers
+        can act on early fields (e.g. parsed_intent) while later ones (e.g.
+        narrative) are still being generated. A cached response is yielded
+        field by field at once. Once the stream completes the object is
+        validated against the schema as in generate_with_json(), and fields
+        corrected by a re-ask are yielded again with their new values. The
+        assembled object is cached, sharing the cache entry with
+        generate_with_json().
+        
+        Args:
+            prompt: Input prompt
+            json_schema: JSON schema for the expected response
+            params: Generation parameters
+            backend_name: Backend to use
+            system_prompt: Optional system prompt
+            use_cache: Whether to use cache
+            priority: Admission priority (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND)
+            deadline: Seconds the whole stream may take before it is cancelled
+            prompt_prefix: Stable leading context shared across turns, sent
+                ahead of the prompt and marked cacheable where supported
+            caller: Name the request's token usage is accounted to (e.g. the agent)
+            cache_tags: Tags (e.g. location or campaign ids) that invalidate_cache_tags()
+                can later drop the cached response by
+            
+        Yields:
+            (field name, value) pairs in completion order
+        """
+        params = params or {}
+        if prompt_prefix:
+            params = {**params, PROMPT_PREFIX_PARAM: prompt_prefix}
+        backend_name = backend_name or self.default_backend
+        self._get_backend(backend_name)  # Fail fast on unknown backends
+        
+        # Check cache if enabled
+        if use_cache:
+            cache_key = self._get_cache_key(prompt, params, backend_name, system_prompt, json_schema)
+            cached_response = await self._cache_get(cache_key)
+            if cached_response:
+                logger.info(f"Cache hit for key: {cache_key[:8]}...")
+                for field in cached_response.items():
+                    yield field
+                return
+        
+        # Stream fields, assembling the object for the cache
+        if deadline is None:
+            deadline = self.default_deadline
+        stream_deadline = _request_deadline.get()
+        if deadline is not None:
+            own_deadline = time.monotonic() + deadline
+            stream_deadline = own_deadline if stream_deadline is None else min(stream_deadline, own_deadline)
+        serving_name = self._route(backend_name)
+        backend = self._get_backend(serving_name)
+        outcome = CallOutcome()
+        started = time.monotonic()
+        finished = False
+        response: Dict[str, Any] = {}
+        try:
+            async with self._admission(serving_name, prompt, params, system_prompt, priority):
+                stream = backend.generate_with_json_stream(prompt, json_schema, params, system_prompt)
+                try:
+                    while True:
+                        token = _call_outcome.set(outcome)
+                        deadline_token = _request_deadline.set(stream_deadline)
+                        try:
+                            key, value = await _await_within_deadline(stream.__anext__())
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            _request_deadline.reset(deadline_token)
+                            _call_outcome.reset(token)
+                        response[key] = value
+                        yield key, value
+                finally:
+                    await stream.aclose()
+            finished = True
+            self._estimate_usage(serving_name, prompt, params, system_prompt, response, outcome)
+        except Exception:
+            outcome.failed = True
+            finished = True
+            raise
+        finally:
+            self._record_call(serving_name, outcome if finished else None, started, caller)
+        
+        # Validate the assembled object, yielding the fields a re-ask corrected
+        if self.schema_validation and response:
+            deadline_token = _request_deadline.set(stream_deadline)
+            try:
+                with _caller_scope(caller):
+                    validated = await _await_within_deadline(self._enforce_schema(
+                        serving_name, prompt, json_schema, params, system_prompt, priority, response, outcome
+                    ))
+            finally:
+                _request_deadline.reset(deadline_token)
+            corrected = [(key, value) for key, value in validated.items() if key not in response or response[key] != value]
+            response = validated
+            for key, value in corrected:
+                yield key, value
+        
+        # Cache the assembled response once the stream has completed, unless it is a mock fallback
+        if use_cache and response and not outcome.failed:
+            self._cache_set(cache_key, response, cache_tags)
+    
+    def fit_context(self, 
+                    sections: List[Dict[str, Any]], 
+                    prompt: str = "",
+                    params: Optional[Dict[str, Any]] = None, 
+                    backend_name: Optional[str] = None,
+                    system_prompt: Optional[str] = None,
+                    budget_tokens: Optional[int] = None) -> str:
+        """
+        Assemble context sections into a prompt prefix that fits the token budget
+        
+        The budget is the backend's context window less the completion's
+        max_tokens, the system prompt and the prompt itself, optionally capped
+        further by budget_tokens. Sections are admitted in priority order
+        (lower first). A section that does not fit is replaced by its summary
+        if it has one that fits, otherwise trimmed, and dropped once the
+        budget is used up. Admitted sections keep their original order.
+        
+        Args:
+            sections: Context sections, each a dict with "text" and optionally
+                "priority" (default 0), "summary" (shorter stand-in text) and
+                "required" (never trimmed or dropped)
+            prompt: The per-turn prompt the context will be sent with
+            params: Generation parameters
+            backend_name: Backend the request will be sent to
+            system_prompt: Optional system prompt
+            budget_tokens: Optional cap on context tokens, below the window limit
+            
+        Returns:
+            Section texts that fit, joined by blank lines (usable as prompt_prefix)
+            
+        Raises:
+            ContextBudgetError: If the required sections alone do not fit
+        """
+        params = params or {}
+        backend_name = backend_name or self.default_backend
+        backend = self._get_backend(backend_name)
+        
+        available = (backend.context_window 
+                     - params.get("max_tokens", 1000)
+                     - self._estimate_prompt_tokens(backend_name, prompt, params, system_prompt))
+        if budget_tokens is not None:
+            available = min(available, budget_tokens)
+        
+        order = sorted(range(len(sections)), 
+                       key=lambda i: (not sections[i].get("required", False), sections[i].get("priority", 0), i))
+        kept: Dict[int, str] = {}
+        for i in order:
+            section = sections[i]
+            text = section.get("text") or ""
+            tokens = backend.estimate_tokens(text)
+            if tokens <= available:
+                kept[i] = text
+                available -= tokens
+                continue
+            if section.get("required", False):
+                raise ContextBudgetError(
+                    f"Required context needs ~{tokens} tokens but only {max(available, 0)} are available on {backend_name}"
+                )
+            
+            summary = section.get("summary")
+            if summary and backend.estimate_tokens(summary) <= available:
+                kept[i] = summary
+                available -= backend.estimate_tokens(summary)
+                continue
+            
+            trimmed = self._trim_to_tokens(backend, text, available)
+            if trimmed:
+                kept[i] = trimmed
+                available -= backend.estimate_tokens(trimmed)
+        
+        dropped = len(sections) - len(kept)
+        if dropped:
+            logger.info(f"Dropped {dropped} context section(s) to fit the {backend_name} token budget")
+        return "\n\n".join(kept[i] for i in sorted(kept))
+    
+    @staticmethod
+    def _trim_to_tokens(backend: ModelBackend, text: str, max_tokens: int, min_tokens: int = 32) -> str:
+        """
+        Cut text down to an estimated token budget at a word boundary
+        
+        Args:
+            backend: Backend whose token estimate applies
+            text: Text to trim
+            max_tokens: Token budget for the trimmed text
+            min_tokens: Budgets smaller than this drop the text entirely
+            
+        Returns:
+            Trimmed text ending in a marker, or "" if the budget is too small
+        """
+        marker = " [...]"
+        budget = max_tokens - backend.estimate_tokens(marker)
+        if budget < min_tokens:
+            return ""
+        
+        cut = int(len(text) * budget / max(backend.estimate_tokens(text), 1))
+        while cut > 0 and backend.estimate_tokens(text[:cut]) > budget:
+            cut = int(cut * 0.9)
+        boundary = max(text.rfind(" ", 0, cut), text.rfind("\n", 0, cut))
+        if boundary > cut // 2:
+            cut = boundary
+        return text[:cut].rstrip() + marker
+    
+    def store_context(self, 
+                      context_id: str, 
+                      context_data: Dict[str, Any], 
+                      ttl: Optional[float] = None) -> None:
         """
         Store context data for future use
         
         Args:
             context_id: Context identifier
             context_data: Context data to store
+            ttl: Seconds to keep the context (defaults to the store's TTL)
         """
-        self.context_store[context_id] = {
-            "data": context_data,
-            "timestamp": datetime.now()
-        }
+        self.context_store.set(context_id, context_data, ttl)
     
     def get_context(self, context_id: str) -> Optional[Dict[str, Any]]:
         """
         Get stored context data
         
+        Reading a context spilled to disk blocks on the spill file; use
+        aget_context() from async code.
+        
         Args:
             context_id: Context identifier
             
         Returns:
             Stored context data or None if not found
         """
-        if context_id in self.context_store:
-            return self.context_store[context_id]["data"]
-        return None
+        return self.context_store.get(context_id)
+    
+    async def aget_context(self, context_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get stored context data, reading contexts spilled to disk off the event loop
+        
+        Args:
+            context_id: Context identifier
+            
+        Returns:
+            Stored context data or None if not found
+        """
+        return await self.context_store.aget(context_id)
     
     def clear_old_contexts(self, max_age_hours: int = 24) -> None:
         """
         Clear contexts older than specified age
         
+        Contexts also expire on their own after their TTL; this is only
+        needed to cut the age limit further.
+        
         Args:
             max_age_hours: Maximum age in hours
         """
-        cutoff_time = datetime.now() - timedelta(hours=max_age_hours)
-        
-        # Find old contexts
-        old_contexts = [
-            context_id for context_id, context in self.context_store.items()
-            if context["timestamp"] < cutoff_time
-        ]
-        
-        # Remove old contexts
-        for context_id in old_contexts:
-            del self.context_store[context_id]
+        removed = self.context_store.remove_older_than(max_age_hours * 3600)
+        if removed:
+            logger.info(f"Cleared {removed} old contexts")
+    
+    def get_context_stats(self) -> Dict[str, Any]:
+        """
+        Get context store statistics
         
-        if old_contexts:
-            logger.info(f"Cleared {len(old_contexts)} old contexts")
+        Returns:
+            Entry, size, hit and eviction counters
+        """
+        return self.context_store.get_stats()
     
     def get_available_backends(self) -> List[str]:
         """
@@ -1066,16 +6048,131 @@ class ModelProtocolServer:
         backend_name = backend_name or self.default_backend
         backend = self._get_backend(backend_name)
         
-        return {
+        info = {
             "name": backend_name,
             "type": backend.__class__.__name__,
-            "model": getattr(backend, "model", "unknown")
+            "model": getattr(backend, "model", "unknown"),
+            "context_window": backend.context_window
+        }
+        
+        if backend_name in self.usage.by_backend:
+            info["usage"] = dict(self.usage.by_backend[backend_name])
+        if hasattr(backend, "get_profile"):
+            info["profile"] = backend.get_profile()
+        if backend_name in self.limiters:
+            info["limits"] = self.limiters[backend_name].get_stats()
+        if backend_name in self.breakers:
+            info["circuit_breaker"] = self.breakers[backend_name].get_stats()
+        if backend_name in self.fallbacks:
+            info["fallback"] = self.fallbacks[backend_name]
+        if backend_name in self.hedge_policies:
+            info["hedging"] = dict(
+                self.hedge_stats[backend_name],
+                backend=self.hedge_policies[backend_name]["backend"],
+                delay=self._hedge_delay(backend_name, self.hedge_policies[backend_name])
+            )
+        
+        return info
+    
+    def get_usage_stats(self) -> Dict[str, Any]:
+        """
+        Get token usage per backend and per caller
+        
+        Returns:
+            Usage counters keyed by backend name and by caller
+        """
+        return self.usage.get_stats()
+    
+    def get_schema_stats(self) -> Dict[str, int]:
+        """
+        Get JSON schema validation counters
+        
+        Returns:
+            Counts of validated, invalid, re-asked, repaired and failed responses
+        """
+        return dict(self.schema_stats)
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """
+        Get response cache statistics
+        
+        Returns:
+            In-memory cache counters (including the hottest keys and their
+            request frequencies) and similarity cache counters
+        """
+        return {
+            "memory": self.cache.get_stats(),
+            "similarity": self.similarity_cache.get_stats()
         }
     
+    async def invalidate_cache_tags(self, *tags: str) -> int:
+        """
+        Drop cached responses carrying any of the given tags
+        
+        Lets a world change (e.g. a location being altered) invalidate only
+        the responses that depended on it. Covers the in-memory, similarity
+        and disk tiers; other workers sharing the disk cache drop their
+        in-memory copies on their next sync.
+        
+        Args:
+            tags: Tags to invalidate
+            
+        Returns:
+            Number of entries removed, counted per tier
+        """
+        tag_list = list(tags)
+        removed = self.cache.invalidate_tags(tag_list) + self.similarity_cache.invalidate_tags(tag_list)
+        if self.disk_cache is not None:
+            # Let queued writes land so they cannot resurrect invalidated entries
+            if self._pending_disk_writes:
+                await asyncio.gather(*self._pending_disk_writes, return_exceptions=True)
+            loop = asyncio.get_running_loop()
+            removed += await loop.run_in_executor(None, self.disk_cache.invalidate_tags, tag_list)
+        if removed:
+            logger.info(f"Invalidated {removed} cached responses for tags {tag_list}")
+        return removed
+    
     def clear_cache(self) -> None:
-        """Clear the response cache"""
+        """
+        Clear the response cache (both tiers)
+        
+        Clearing the disk tier blocks on SQLite, and disk writes still queued
+        may land afterwards; use aclear_cache() from async code.
+        """
         self.cache.clear()
+        self.similarity_cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.clear()
         logger.info("Response cache cleared")
+    
+    async def aclear_cache(self) -> None:
+        """Clear the response cache (both tiers) without blocking the event loop"""
+        self.cache.clear()
+        self.similarity_cache.clear()
+        if self.disk_cache is not None:
+            # Let queued writes land so they cannot resurrect cleared entries
+            if self._pending_disk_writes:
+                await asyncio.gather(*self._pending_disk_writes, return_exceptions=True)
+            await self.disk_cache.aclear()
+        logger.info("Response cache cleared")
+    
+    async def close(self) -> None:
+        """Close all backends and release their pooled connections"""
+        for name, backend in self.backends.items():
+            try:
+                await backend.close()
+            except Exception as e:
+                logger.error(f"Error closing backend {name}: {str(e)}")
+        
+        await self.context_store.close()
+        if self.cassette is not None:
+            self.cassette.close()
+        
+        if self.disk_cache is not None:
+            # Let queued writes land before closing the database
+            if self._pending_disk_writes:
+                await asyncio.gather(*self._pending_disk_writes, return_exceptions=True)
+            self.disk_cache.close()
 
 # Singleton instance
 _instance = None
@@ -1096,3 +6193,12 @@ def get_model_server(config: Optional[Dict[str, Any]] = None) -> ModelProtocolSe
         _instance = ModelProtocolServer(config)
     
     return _instance
+
+async def shutdown_model_server() -> None:
+    """
+    Close the ModelProtocolServer singleton if it was created
+    
+    Intended to be registered as a FastAPI shutdown handler.
+    """
+    if _instance is not None:
+        await _instance.close()
@@ -0,0 +1,56 @@
+"""
+Tests for the model protocol server
+"""
+
+import asyncio
+import json
+import unittest
+
+from aiohttp import web
+
+from model_protocol_server import ModelProtocolServer
+
+class TruncatedStreamTest(unittest.TestCase):
+    """A stream that breaks off mid-response must not be cached"""
+
+    async def _serve_truncated_stream(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for text in ["The goblin", " falls"]:
+            event = {"choices": [{"delta": {"content": text}}]}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write(b"data: {not json\n\n")
+        await response.write_eof()
+        return response
+
+    async def _stream_once(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._serve_truncated_stream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        server = ModelProtocolServer({
+            "backends": {
+                "local": {"type": "local", "base_url": f"http://127.0.0.1:{port}/v1/chat/completions"}
+            },
+            "default_backend": "local"
+        })
+        try:
+            first = [chunk async for chunk in server.generate_stream("Attack the goblin")]
+            cache_key = server._get_cache_key("Attack the goblin", {}, "local", None)
+            cached = await server._cache_get(cache_key)
+        finally:
+            await server.close()
+            await runner.cleanup()
+        return first, cached
+
+    def test_truncated_stream_is_not_cached(self):
+        chunks, cached = asyncio.run(self._stream_once())
+        self.assertEqual("".join(chunks), "The goblin falls")
+        self.assertIsNone(cached)
+
+if __name__ == "__main__":
+    unittest.main()